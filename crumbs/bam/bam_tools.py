@@ -1,47 +1,318 @@
-
+from __future__ import division
 import os.path
 from subprocess import check_call, CalledProcessError
 import shutil
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 import sys
+import struct
+from collections import Counter
+from itertools import chain
+from multiprocessing import Pool
+
 import pysam
 
 from crumbs.bam.flag import create_flag
 from crumbs.settings import get_setting
 from crumbs.utils.bin_utils import get_num_threads
+from crumbs.utils.compression import read_bgzf_raw_block, BGZF_EOF
 
 # pylint: disable=C0111
 
 
-def filter_bam(in_fpath, out_fpath, min_mapq=0, required_flag_tags=None,
-               filtering_flag_tags=None, regions=None):
-    cmd = ['-bh']
-
-    # The following line:
-    cmd.append('-o' + out_fpath)
-    # should be
-    # cmd.extend(['-o', out_fpath])
-    # but it is a workaround, take a look at:
-    # https://groups.google.com/forum/#!msg/pysam-user-group/ooHgIiNVe4c/CcY06d45rzQJ
-
+# predicate names, they are also the keys of the rejection counters
+MIN_MAPQ = 'min_mapq'
+REQUIRED_FLAG = 'required_flag'
+FILTERING_FLAG = 'filtering_flag'
+MAX_EDIT_DISTANCE = 'max_edit_distance'
+MAX_SOFT_CLIP_FRACTION = 'max_soft_clip_fraction'
+READ_GROUPS = 'read_groups'
+MIN_INSERT_SIZE = 'min_insert_size'
+MAX_INSERT_SIZE = 'max_insert_size'
+
+_SOFT_CLIP = 4
+# number of filtering jobs for every worker process
+_JOBS_PER_PROCESS = 4
+
+
+def _soft_clip_fraction(alig_read):
+    cigar = alig_read.cigartuples
+    if not cigar:
+        return 0
+    soft_clipped = 0
+    read_len = 0
+    for operation, length in cigar:
+        if operation == _SOFT_CLIP:
+            soft_clipped += length
+        if operation in (0, 1, 4, 7, 8):
+            read_len += length
+    return soft_clipped / read_len if read_len else 0
+
+
+def _compile_predicate(min_mapq=0, required_flag=None, filtering_flag=None,
+                       max_edit_distance=None, max_soft_clip_fraction=None,
+                       read_groups=None, min_insert_size=None,
+                       max_insert_size=None):
+    '''It returns a function that checks an alignment with all predicates.
+
+    The function returns None for the alignments that pass and the name of
+    the first predicate that fails for the rejected ones. The cheapest
+    checks go first.
+    '''
+    checks = []
+    if required_flag:
+        checks.append((REQUIRED_FLAG,
+                       lambda read: read.flag & required_flag == required_flag))
+    if filtering_flag:
+        checks.append((FILTERING_FLAG,
+                       lambda read: not read.flag & filtering_flag))
     if min_mapq:
-        cmd.extend(['-q', str(min_mapq)])
-
-    if required_flag_tags:
-        flag = create_flag(required_flag_tags)
-        cmd.extend(['-f', str(flag)])
+        checks.append((MIN_MAPQ,
+                       lambda read: read.mapping_quality >= min_mapq))
+    # The insert size is only checked for the pairs with both mates in the
+    # same reference, the other ones have a template length of 0
+    if min_insert_size is not None:
+        def _check_min_insert_size(read):
+            insert_size = abs(read.template_length)
+            return not insert_size or insert_size >= min_insert_size
+        checks.append((MIN_INSERT_SIZE, _check_min_insert_size))
+    if max_insert_size is not None:
+        def _check_max_insert_size(read):
+            return abs(read.template_length) <= max_insert_size
+        checks.append((MAX_INSERT_SIZE, _check_max_insert_size))
+    if read_groups is not None:
+        read_groups = set(read_groups)
+
+        def _check_read_group(read):
+            return (read.has_tag('RG') and
+                    read.get_tag('RG') in read_groups)
+        checks.append((READ_GROUPS, _check_read_group))
+    if max_edit_distance is not None:
+        def _check_edit_distance(read):
+            # The reads with no NM tag can not be checked
+            return (not read.has_tag('NM') or
+                    read.get_tag('NM') <= max_edit_distance)
+        checks.append((MAX_EDIT_DISTANCE, _check_edit_distance))
+    if max_soft_clip_fraction is not None:
+        def _check_soft_clip(read):
+            return _soft_clip_fraction(read) <= max_soft_clip_fraction
+        checks.append((MAX_SOFT_CLIP_FRACTION, _check_soft_clip))
+
+    def predicate(alig_read):
+        for name, check in checks:
+            if not check(alig_read):
+                return name
+        return None
+    return predicate
+
+
+def _filter_alignments(in_sam, alig_reads, out_fpath, predicate):
+    out_sam = pysam.AlignmentFile(out_fpath, 'wb', template=in_sam)
+    rejected = Counter()
+    try:
+        for alig_read in alig_reads:
+            failed_predicate = predicate(alig_read)
+            if failed_predicate is None:
+                out_sam.write(alig_read)
+            else:
+                rejected[failed_predicate] += 1
+    finally:
+        out_sam.close()
+    return rejected
+
+
+def _region_alignments(in_sam, region):
+    '''It yields the alignments that start in the region.
+
+    The alignments that overlap the previous region in the same reference
+    have already been written by that region.
+    '''
+    ref, start, end, prev_end = region
+    if ref == '*':
+        # htslib takes the region '*' as the reads with no coordinates
+        alig_reads = in_sam.fetch(region='*')
+    elif start is None:
+        # the reference names could look like regions, e.g. chr1:1-10
+        alig_reads = in_sam.fetch(contig=ref)
+    if start is None:
+        for alig_read in alig_reads:
+            yield alig_read
+        return
+    for alig_read in in_sam.fetch(ref, start, end):
+        if prev_end is not None and alig_read.reference_start < prev_end:
+            continue
+        yield alig_read
 
-    if filtering_flag_tags:
-        flag = create_flag(filtering_flag_tags)
-        cmd.extend(['-F', str(flag)])
 
-    cmd.extend([in_fpath])
+def _filter_regions(args):
+    in_fpath, regions, out_fpath, predicate_params = args
+    predicate = _compile_predicate(**predicate_params)
+    in_sam = pysam.AlignmentFile(in_fpath)
+    try:
+        alig_reads = chain.from_iterable(_region_alignments(in_sam, region)
+                                         for region in regions)
+        return _filter_alignments(in_sam, alig_reads, out_fpath, predicate)
+    finally:
+        in_sam.close()
+
+
+def _get_regions_to_filter(in_sam, regions=None):
+    '''It returns the regions in which the filtering job is split.
+
+    Every region is a (reference, start, end, previous_region_end) tuple.
+    Without regions a job is created for every reference and another one
+    for the unmapped reads with no coordinates.
+    '''
+    if regions is None:
+        jobs = [(ref, None, None, None) for ref in in_sam.references]
+        jobs.append(('*', None, None, None))
+        return jobs
+
+    # the regions are given in samtools 1-based coordinates
+    by_ref = {}
+    for ref, start, end in regions.segments:
+        by_ref.setdefault(ref, []).append((start - 1, end))
+    jobs = []
+    for ref in in_sam.references:
+        if ref not in by_ref:
+            continue
+        merged = []
+        for start, end in sorted(by_ref[ref]):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        prev_end = None
+        for start, end in merged:
+            jobs.append((ref, start, end, prev_end))
+            prev_end = end
+    return jobs
+
+
+def _group_regions(in_sam, regions, num_jobs):
+    '''It groups the consecutive regions in jobs of similar length.
+
+    The regions keep their order, so the shards of the jobs can be
+    concatenated.
+    '''
+    ref_lengths = dict(zip(in_sam.references, in_sam.lengths))
+
+    def _get_length(region):
+        ref, start, end = region[:3]
+        if ref == '*':
+            return 0
+        if start is None:
+            return ref_lengths[ref]
+        return end - start
+
+    job_length = sum(_get_length(region) for region in regions) / num_jobs
+    jobs = [[]]
+    length = 0
+    for region in regions:
+        region_length = _get_length(region)
+        # the unmapped reads go with the last reference
+        if (jobs[-1] and region_length and
+                length >= job_length * len(jobs)):
+            jobs.append([])
+        jobs[-1].append(region)
+        length += region_length
+    return jobs
+
+
+def _concat_bams(in_fpaths, out_fpath):
+    '''It concatenates bams with the same header without recompressing them.
+
+    The bgzf blocks that follow the header of every bam are copied, htslib
+    writes the header in its own blocks.
+    '''
+    with open(out_fpath, 'wb') as out_fhand:
+        for index, in_fpath in enumerate(in_fpaths):
+            in_sam = pysam.AlignmentFile(in_fpath)
+            first_read_offset = in_sam.tell()
+            in_sam.close()
+            if first_read_offset & 0xffff:
+                msg = 'The header of the bam is not in its own bgzf blocks: '
+                raise ValueError(msg + in_fpath)
+            with open(in_fpath, 'rb') as in_fhand:
+                if index:
+                    in_fhand.seek(first_read_offset >> 16)
+                for block in iter(lambda: read_bgzf_raw_block(in_fhand),
+                                  None):
+                    # the empty blocks are end of file markers
+                    if struct.unpack('<I', block[-4:])[0]:
+                        out_fhand.write(block)
+        out_fhand.write(BGZF_EOF)
 
-    if regions:
-        regions = ['{0}:{1}-{2}'.format(*s) for s in regions.segments]
-        cmd.extend(regions)
 
-    pysam.view(*cmd)
+def filter_bam(in_fpath, out_fpath, min_mapq=0, required_flag_tags=None,
+               filtering_flag_tags=None, regions=None, max_edit_distance=None,
+               max_soft_clip_fraction=None, read_groups=None,
+               min_insert_size=None, max_insert_size=None, processes=1):
+    '''It filters the alignments of a bam and it returns the rejected counts.
+
+    The alignments are checked in process with a predicate compiled once.
+    If the bam is indexed the references (or the given regions) are
+    grouped in a few jobs for every worker process, balanced by length, and
+    the bam shards are concatenated in the output, that keeps the input
+    sort order.
+    The counts of rejected alignments are returned by predicate.
+    '''
+    predicate_params = {'min_mapq': min_mapq,
+                        'max_edit_distance': max_edit_distance,
+                        'max_soft_clip_fraction': max_soft_clip_fraction,
+                        'read_groups': read_groups,
+                        'min_insert_size': min_insert_size,
+                        'max_insert_size': max_insert_size}
+    if required_flag_tags:
+        predicate_params['required_flag'] = create_flag(required_flag_tags)
+    if filtering_flag_tags:
+        predicate_params['filtering_flag'] = create_flag(filtering_flag_tags)
+
+    in_sam = pysam.AlignmentFile(in_fpath)
+    if not in_sam.has_index():
+        if regions:
+            msg = 'The bam file should be indexed to filter by region'
+            raise ValueError(msg)
+        predicate = _compile_predicate(**predicate_params)
+        try:
+            alig_reads = in_sam.fetch(until_eof=True)
+            return _filter_alignments(in_sam, alig_reads, out_fpath,
+                                      predicate)
+        finally:
+            in_sam.close()
+
+    num_jobs = processes * _JOBS_PER_PROCESS if processes > 1 else 1
+    jobs_regions = _group_regions(in_sam,
+                                  _get_regions_to_filter(in_sam, regions),
+                                  num_jobs)
+    in_sam.close()
+
+    shards_dir = mkdtemp(prefix='filter_bam_',
+                         dir=os.path.dirname(os.path.abspath(out_fpath)))
+    try:
+        jobs = []
+        for index, job_regions in enumerate(jobs_regions):
+            shard_fpath = os.path.join(shards_dir, '{:06d}.bam'.format(index))
+            jobs.append((in_fpath, job_regions, shard_fpath,
+                         predicate_params))
+
+        if processes > 1:
+            workers = Pool(processes=processes)
+            counters = workers.map(_filter_regions, jobs)
+            workers.close()
+        else:
+            counters = map(_filter_regions, jobs)
+        rejected = Counter()
+        for counter in counters:
+            rejected.update(counter)
+
+        shard_fpaths = [job[2] for job in jobs]
+        if len(shard_fpaths) == 1:
+            shutil.move(shard_fpaths[0], out_fpath)
+        else:
+            _concat_bams(shard_fpaths, out_fpath)
+    finally:
+        shutil.rmtree(shards_dir)
+    return rejected
 
 
 def sort_bam(in_bam_fpath, out_bam_fpath=None):
@@ -1,39 +1,36 @@
-import pysam
+from bisect import bisect_right
+from array import array
 from collections import Counter, namedtuple
 
+import numpy
+import pysam
 
-def pos_counter_by_pos(bam_fpath, positions):
-    alignmentfile = pysam.AlignmentFile(bam_fpath)
-    ref_name_index = {}
-    for pileup_col in alignmentfile.pileup():
-        ref_id = pileup_col.reference_id
-        ref_pos = pileup_col.reference_pos
-        ref_name = ref_name_index.get(ref_id, alignmentfile.getrname(ref_id))
-        position = (ref_name, ref_pos)
-        if position in positions:
-            pos_counter = Counter()
-            print position
-            for pileup_read in pileup_col.pileups:
-                alignement = pileup_read.alignment
-                blocks = alignement.get_blocks()
-
-                if pileup_read.alignment.is_reverse:
-                    base_pos = (pileup_read.alignment.query_length -
-                                pileup_read.query_position - 1)
-                else:
-                    base_pos = pileup_read.query_position
-#
-#                 base_pos = pileup_read.query_position
-                print base_pos, pileup_read.alignment.qname
-                pos_counter[base_pos] += 1
-            yield pos_counter
+# the array('l') items and the numpy arrays should share the item size
+_LONG_DTYPE = numpy.dtype('l')
+
+# unmapped, secondary, qcfail and duplicated reads, as the pileup does
+_PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# positions closer than this are fetched from the bam in the same region
+_MAX_GAP_IN_REGION = 1000
 
 
 Block = namedtuple('Block', ['ref_start', 'ref_stop',
                              'read_start', 'read_stop'])
 
 
+# read position used in the block arrays when there is no read base aligned
+# to the reference position (deletions and skipped regions)
+NO_READ_POS = -1
+
+
 class ReadRefCoord(object):
+    '''It maps reference positions to read positions for an aligned read.
+
+    The cigar is walked only once, the aligned blocks are stored as compact
+    arrays sorted by reference position and the queries are solved by binary
+    search.
+    '''
     def __init__(self, alig_read, sam, hard_clip_as_soft=False):
         self._alig_read = alig_read
         self._sam = sam
@@ -41,24 +38,40 @@ class ReadRefCoord(object):
         self._blocks = None
         self._read_len = None
         self._last_position = None
+        self._chrom = None
+        # block arrays sorted by reference start
+        self._ref_starts = None
+        self._ref_stops = None
+        self._read_starts = None
+        self._np_arrays = None
 
     @property
     def read_len(self):
         if self._read_len is None:
-            self.blocks
+            self._build_blocks()
         return self._read_len
 
     @property
     def blocks(self):
+        if self._blocks is None:
+            self._build_blocks()
+        return self._blocks
+
+    @property
+    def chrom(self):
+        if self._chrom is None:
+            self._chrom = self._sam.getrname(self._alig_read.reference_id)
+        return self._chrom
+
+    @property
+    def alig_read(self):
+        return self._alig_read
+
+    def _build_blocks(self):
         alig_read = self._alig_read
-        if self._blocks is not None:
-            return self._block
         ref_start = alig_read.reference_start
 
-        cigar_tuples = alig_read.cigartuples
         is_fwd = not(alig_read.is_reverse)
-        if not is_fwd:
-            cigar_tuples = reversed(cigar_tuples)
 
         read_pos = 0  # if is reversed this is not true, but we fixed later
         read_len = 0
@@ -121,55 +134,199 @@ class ReadRefCoord(object):
                               blk_read_end)
                 rev_blocks.append(block)
             blocks = rev_blocks
-        self._block = blocks
+
+        # Only the blocks with reference coordinates can be hit by a reference
+        # position. They are already sorted because the cigar walks the
+        # reference from left to right.
+        ref_starts = array('l')
+        ref_stops = array('l')
+        read_starts = array('l')
+        for block in blocks:
+            if block.ref_start is None:
+                continue
+            ref_starts.append(block.ref_start)
+            ref_stops.append(block.ref_stop)
+            if block.read_start is None:
+                read_starts.append(NO_READ_POS)
+            else:
+                read_starts.append(block.read_start)
+        self._ref_starts = ref_starts
+        self._ref_stops = ref_stops
+        self._read_starts = read_starts
+        self._blocks = blocks
         self._read_len = read_len
-        return blocks
+
+    def _check_chrom(self, chrom):
+        if chrom != self.chrom:
+            msg = 'The aligned read is not aligned to the given chrom: '
+            msg += self.chrom
+            raise ValueError(msg)
 
     def get_read_pos(self, ref_pos):
         if (self._last_position is not None and
             self._last_position[0] == ref_pos):
             return self._last_position[1]
-        alig_read = self._alig_read
-        sam = self._sam
-        chrom = sam.getrname(alig_read.reference_id)
-        if chrom != ref_pos[0]:
-            msg = 'The aligned read is not aligned to the given chrom: '
-            msg += chrom
-            raise ValueError(msg)
-        ref_pos = ref_pos[1]
-
-        blocks = self.blocks
+        self._check_chrom(ref_pos[0])
+        pos = ref_pos[1]
 
-        block_with_ref_pos = None
-        for block in blocks:
-            if block.ref_start <= ref_pos <= block.ref_stop:
-                block_with_ref_pos = block
-                break
-        if block_with_ref_pos is None:
-            read_pos = None
-        else:
-            read_start = block_with_ref_pos.read_start
-            read_stop = block_with_ref_pos.read_stop
-
-            if read_start is None or read_stop is None:
-                read_pos = None
-            else:
-                ref_start = block_with_ref_pos.ref_start
-                ref_stop = block_with_ref_pos.ref_stop
+        if self._ref_starts is None:
+            self._build_blocks()
 
-                if alig_read.is_reverse:
-                    read_pos = read_start - (ref_pos - ref_start)
+        read_pos = None
+        index = bisect_right(self._ref_starts, pos) - 1
+        if index >= 0 and pos <= self._ref_stops[index]:
+            read_start = self._read_starts[index]
+            if read_start != NO_READ_POS:
+                offset = pos - self._ref_starts[index]
+                if self._alig_read.is_reverse:
+                    read_pos = read_start - offset
                 else:
-                    read_pos = read_stop - (ref_stop - ref_pos)
+                    read_pos = read_start + offset
 
         self._last_position = ref_pos, read_pos
         return read_pos
 
     def get_read_pos_counting_from_end(self, ref_pos):
-        if self._last_position is None:
+        if self._last_position is None or self._last_position[0] != ref_pos:
             read_pos = self.get_read_pos(ref_pos)
         else:
             read_pos = self._last_position[1]
         read_len = self.read_len
         if read_pos is not None:
             return read_pos - read_len
+
+    def _get_np_arrays(self):
+        if self._np_arrays is None:
+            if self._ref_starts is None:
+                self._build_blocks()
+            self._np_arrays = tuple(numpy.frombuffer(array_,
+                                                     dtype=_LONG_DTYPE)
+                                    for array_ in (self._ref_starts,
+                                                   self._ref_stops,
+                                                   self._read_starts))
+        return self._np_arrays
+
+    def get_read_positions(self, chrom, ref_positions):
+        '''It returns the read positions for many reference positions at once.
+
+        The positions with no read base aligned get NO_READ_POS.
+        '''
+        self._check_chrom(chrom)
+        ref_positions = numpy.asarray(ref_positions, dtype=_LONG_DTYPE)
+        ref_starts, ref_stops, read_starts = self._get_np_arrays()
+
+        read_positions = numpy.empty(ref_positions.shape, dtype=_LONG_DTYPE)
+        read_positions.fill(NO_READ_POS)
+        if not len(ref_starts):
+            return read_positions
+
+        indexes = numpy.searchsorted(ref_starts, ref_positions,
+                                     side='right') - 1
+        in_blocks = indexes >= 0
+        safe_indexes = numpy.where(in_blocks, indexes, 0)
+        in_blocks &= ref_positions <= ref_stops[safe_indexes]
+        blk_read_starts = read_starts[safe_indexes]
+        in_blocks &= blk_read_starts != NO_READ_POS
+
+        offsets = ref_positions - ref_starts[safe_indexes]
+        if self._alig_read.is_reverse:
+            offsets = -offsets
+        read_positions[in_blocks] = (blk_read_starts + offsets)[in_blocks]
+        return read_positions
+
+
+def iter_read_positions(read_coords, chrom, ref_positions):
+    '''It yields the read positions for many reads and reference positions.
+
+    The reference positions should be sorted. For every read the positions
+    found inside its alignment span are queried and a tuple with the read
+    coord, the indexes of the positions and its read positions is yielded.
+    '''
+    ref_positions = numpy.asarray(ref_positions, dtype=_LONG_DTYPE)
+    for read_coord in read_coords:
+        alig_read = read_coord.alig_read
+        first = numpy.searchsorted(ref_positions, alig_read.reference_start,
+                                   side='left')
+        last = numpy.searchsorted(ref_positions, alig_read.reference_end,
+                                  side='left')
+        if first == last:
+            continue
+        positions = ref_positions[first:last]
+        read_positions = read_coord.get_read_positions(chrom, positions)
+        yield read_coord, numpy.arange(first, last), read_positions
+
+
+def _split_in_regions(positions, max_gap):
+    'It yields the start and end indexes of the clusters of close positions'
+    if not len(positions):
+        return
+    breaks = numpy.nonzero(numpy.diff(positions) > max_gap)[0] + 1
+    starts = [0] + list(breaks)
+    ends = list(breaks) + [len(positions)]
+    for start, end in zip(starts, ends):
+        yield start, end
+
+
+def sweep_read_positions(sam, chrom, positions, hard_clip_as_soft=False,
+                         max_gap=_MAX_GAP_IN_REGION):
+    '''It walks the sorted positions and the alignments of a chrom together.
+
+    Close positions are fetched from the bam in one region and every
+    alignment is read and its cigar converted only once, even when it
+    spans several regions. For every alignment it yields its ReadRefCoord,
+    the indexes of the positions covered by a read base and the read
+    positions.
+    '''
+    positions = numpy.asarray(positions, dtype=_LONG_DTYPE)
+    # the reads already processed that could be fetched again
+    active_reads = {}
+    for first, last in _split_in_regions(positions, max_gap):
+        region_start = int(positions[first])
+        region_end = int(positions[last - 1]) + 1
+        active_reads = {key: end for key, end in active_reads.viewitems()
+                        if end > region_start}
+        for alig_read in sam.fetch(chrom, region_start, region_end):
+            if alig_read.flag & _PILEUP_SKIP_FLAGS:
+                continue
+            key = (alig_read.query_name, alig_read.flag,
+                   alig_read.reference_start)
+            if key in active_reads:
+                continue
+            active_reads[key] = alig_read.reference_end
+
+            coord = ReadRefCoord(alig_read, sam, hard_clip_as_soft)
+            hits = iter_read_positions([coord], chrom, positions)
+            for coord, pos_idxs, read_poss in hits:
+                with_base = read_poss != NO_READ_POS
+                if with_base.any():
+                    yield coord, pos_idxs[with_base], read_poss[with_base]
+
+
+def pos_counter_by_pos(bam_fpath, positions):
+    '''It counts the read positions found in the given reference positions.
+
+    The positions are (chrom, pos) tuples and a Counter with the read
+    positions, counted from the read 5' end, is yielded for every covered
+    position in the bam coordinate order.
+    '''
+    alignmentfile = pysam.AlignmentFile(bam_fpath)
+    positions_by_chrom = {}
+    for chrom, pos in positions:
+        if chrom not in positions_by_chrom:
+            positions_by_chrom[chrom] = []
+        positions_by_chrom[chrom].append(pos)
+
+    for chrom in alignmentfile.references:
+        if chrom not in positions_by_chrom:
+            continue
+        chrom_poss = sorted(set(positions_by_chrom[chrom]))
+        counters = [None] * len(chrom_poss)
+        for _, pos_idxs, read_poss in sweep_read_positions(alignmentfile,
+                                                           chrom, chrom_poss):
+            for pos_idx, read_pos in zip(pos_idxs, read_poss):
+                if counters[pos_idx] is None:
+                    counters[pos_idx] = Counter()
+                counters[pos_idx][int(read_pos)] += 1
+        for counter in counters:
+            if counter is not None:
+                yield counter
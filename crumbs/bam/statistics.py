@@ -1,11 +1,12 @@
 from __future__ import division
 
 import os.path
+import hashlib
 from subprocess import Popen, PIPE
 from operator import itemgetter
 from itertools import izip
 from array import array
-from numpy import histogram, zeros, median, sum as np_sum
+from numpy import histogram, zeros, median, asarray, sum as np_sum
 
 import pysam
 try:
@@ -18,6 +19,7 @@ from crumbs.statistics import (draw_histogram_ascii, IntCounter, LABELS,
 from crumbs.settings import get_setting
 from crumbs.bam.flag import SAM_FLAG_BINARIES, SAM_FLAGS
 from crumbs.utils.bin_utils import get_binary_path
+from crumbs.utils.file_utils import evict_cache_files, touch_cache_file
 from collections import Counter
 
 # pylint: disable=C0111
@@ -132,34 +134,27 @@ class ReferenceStats(object):
     def _count_reads(self):
         nreferences = self._bams[0].nreferences
         rpks = zeros(nreferences)
-        references = []
+        references = None
         length_counts = IntCounter()
 
-        first_bam = True
         n_reads = 0
         for bam in self._bams:
             if bam.nreferences != nreferences:
                 msg = 'BAM files should have the same references'
                 raise ValueError(msg)
-            for index, count in enumerate(get_reference_counts(bam.filename)):
-                n_reads += count['unmapped_reads'] + count['mapped_reads']
-                if count['reference'] is None:
-                    # some non-mapped reads have reference = None
-                    continue
-                kb_len = count['length'] / 1000
-                rpk = count['mapped_reads'] / kb_len
-                rpks[index] += rpk
-                if first_bam:
-                    # For the reference lengths we use the first BAM to make
-                    references.append(count['reference'])
-                    length_counts[count['length']] += 1
-                else:
-                    # the bams should be sorted with the references in the same
-                    # order
-                    if references[index] != count['reference']:
-                        msg = 'The reference lengths do not match in the bams'
-                        raise RuntimeError(msg)
-            first_bam = False
+            counts = ReferenceCounts(bam.filename)
+            n_reads += counts.n_reads
+            rpks += counts.mapped_reads / (counts.lengths / 1000)
+            if references is None:
+                # For the reference lengths we use the first BAM to make
+                references = counts.references
+                for length in counts.lengths:
+                    length_counts[int(length)] += 1
+            elif references != counts.references:
+                # the bams should be sorted with the references in the same
+                # order
+                msg = 'The reference lengths do not match in the bams'
+                raise RuntimeError(msg)
 
         million_reads = n_reads / 1e6
         rpks /= million_reads  # rpkms
@@ -249,11 +244,11 @@ class CoverageCounter(IntCounter):
                 self[len(column.pileups)] += 1
 
 
-def get_reference_counts_dict(bam_fpaths):
+def get_reference_counts_dict(bam_fpaths, cache_dir=None):
     'It gets a list of bams and returns a dict indexed by reference'
     counts = {}
     for bam_fpath in bam_fpaths:
-        for line in get_reference_counts(bam_fpath):
+        for line in get_reference_counts(bam_fpath, cache_dir):
             ref_name = line['reference']
             length = line['length']
             mapped_reads = line['mapped_reads']
@@ -267,14 +262,84 @@ def get_reference_counts_dict(bam_fpaths):
     return counts
 
 
-def get_reference_counts(bam_fpath):
-    'Using samtools idxstats it generates dictionaries with read counts'
-    cmd = [get_binary_path('samtools'), 'idxstats', bam_fpath]
-    idx_process = Popen(cmd, stdout=PIPE)
-    # we're not using pysam.idxstats here because the stdout differed
-    # depending on how the tests were run
-    for line in idx_process.stdout:
-        ref_name, ref_length, mapped_reads, unmapped_reads = line.split()
+def _get_bam_key(bam_fpath):
+    stat = os.stat(bam_fpath)
+    return '{}\t{}\t{}'.format(os.path.abspath(bam_fpath), stat.st_size,
+                                 stat.st_mtime)
+
+
+def _get_cache_fpath(bam_fpath, cache_dir):
+    fname = hashlib.sha1(os.path.abspath(bam_fpath)).hexdigest()
+    return os.path.join(cache_dir, fname)
+
+
+def _read_cached_reference_counts(bam_fpath, cache_dir):
+    cache_fpath = _get_cache_fpath(bam_fpath, cache_dir)
+    try:
+        fhand = open(cache_fpath)
+    except IOError:
+        return None
+    with fhand:
+        if fhand.readline().rstrip('\n') != _get_bam_key(bam_fpath):
+            return None
+        counts = [line.split('\t') for line in fhand]
+    touch_cache_file(cache_fpath)
+    return counts
+
+
+def _write_cached_reference_counts(bam_fpath, counts, cache_dir, max_size):
+    cache_fpath = _get_cache_fpath(bam_fpath, cache_dir)
+    tmp_fpath = '{}.{}.tmp'.format(cache_fpath, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_fpath, 'w') as fhand:
+            fhand.write(_get_bam_key(bam_fpath) + '\n')
+            for count in counts:
+                fhand.write('\t'.join(map(str, count)) + '\n')
+        os.rename(tmp_fpath, cache_fpath)
+    except (IOError, OSError):
+        # the cache is not required
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        return
+    evict_cache_files(cache_dir, max_size)
+
+
+def _get_index_statistics(bam_fpath, cache_dir=None, max_size=None):
+    '''It returns the idxstats lines taking them from the bam index.
+
+    The result is cached in the REF_COUNTS_CACHE_DIR and it is reused while
+    the bam path, size and modification time do not change. Above max_size
+    bytes, by default REF_COUNTS_CACHE_MAX_SIZE, the least recently used
+    counts are removed.
+    '''
+    if cache_dir is None:
+        cache_dir = get_setting('REF_COUNTS_CACHE_DIR')
+    if cache_dir:
+        counts = _read_cached_reference_counts(bam_fpath, cache_dir)
+        if counts is not None:
+            return counts
+    bam = pysam.AlignmentFile(bam_fpath)
+    lengths = dict(zip(bam.references, bam.lengths))
+    counts = []
+    for stat in bam.get_index_statistics():
+        counts.append((stat.contig, lengths[stat.contig], stat.mapped,
+                       stat.unmapped))
+    counts.append(('*', 0, 0, bam.nocoordinate))
+    bam.close()
+    if cache_dir:
+        if max_size is None:
+            max_size = get_setting('REF_COUNTS_CACHE_MAX_SIZE')
+        _write_cached_reference_counts(bam_fpath, counts, cache_dir,
+                                       int(max_size))
+    return counts
+
+
+def get_reference_counts(bam_fpath, cache_dir=None, max_size=None):
+    'Using the bam index it generates dictionaries with read counts'
+    for ref_name, ref_length, mapped_reads, unmapped_reads in \
+                         _get_index_statistics(bam_fpath, cache_dir, max_size):
         if ref_name == '*':
             ref_name = None
             ref_length = None
@@ -285,6 +350,40 @@ def get_reference_counts(bam_fpath):
                'unmapped_reads': int(unmapped_reads)}
 
 
+def calc_rpkms(mapped_reads, lengths, n_reads):
+    '''It calculates the RPKMs for all references at once.
+
+    mapped_reads and lengths should be arrays with a value per reference and
+    n_reads the total number of reads in the library.
+    '''
+    kb_lens = asarray(lengths, dtype=float) / 1000
+    return asarray(mapped_reads, dtype=float) / kb_lens / (n_reads / 1e6)
+
+
+class ReferenceCounts(object):
+    'The read counts by reference of a bam as arrays'
+    def __init__(self, bam_fpath, cache_dir=None):
+        references = []
+        lengths = array('l')
+        mapped_reads = array('l')
+        n_reads = 0
+        for count in get_reference_counts(bam_fpath, cache_dir):
+            n_reads += count['mapped_reads'] + count['unmapped_reads']
+            if count['reference'] is None:
+                continue
+            references.append(count['reference'])
+            lengths.append(count['length'])
+            mapped_reads.append(count['mapped_reads'])
+        self.references = references
+        self.lengths = asarray(lengths)
+        self.mapped_reads = asarray(mapped_reads)
+        self.n_reads = n_reads
+
+    @property
+    def rpkms(self):
+        return calc_rpkms(self.mapped_reads, self.lengths, self.n_reads)
+
+
 MAPQS_TO_CALCULATE = (0, 20, 30, 40)
 
 
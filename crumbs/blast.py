@@ -16,17 +16,29 @@
 import os.path
 import subprocess
 import tempfile
+import hashlib
+import glob
+import sqlite3
+import threading
+from collections import deque
+from multiprocessing import cpu_count, current_process
+from multiprocessing.managers import BaseManager
+from cStringIO import StringIO
 
 from crumbs.utils.optional_modules import NCBIWWW
 from crumbs.seq.seqio import seqio, guess_seq_type, write_seqs
 from crumbs.utils.bin_utils import (check_process_finishes, popen,
                                     get_binary_path)
 from crumbs.utils.tags import NUCL, PROT
-from crumbs.seq.alignment_result import (filter_alignments, ELONGATED, QUERY,
+from crumbs.seq.alignment_result import (filter_alignments,
                                          covered_segments_from_match_parts,
-                                         elongate_match_parts_till_global,
+                                         index_match_parts_by_subject,
+                                         covered_segments_in_subject,
                                          TabularBlastParser, BlastParser)
 from crumbs.utils.file_utils import TemporaryDir
+from crumbs.utils.index_cache import get_index_cache, get_tool_version
+from crumbs.utils.sqlite_utils import open_sqlite_cache
+from crumbs.seq.seq import get_name, get_str_seq
 from crumbs.settings import get_setting
 
 
@@ -43,6 +55,10 @@ TASKS = {'blastn': ('megablast', 'blastn', 'blastn-short', 'dc-megablast',
 
 REMOTE_BLAST_DBS = ['nt', 'nr']
 
+DEFAULT_BLAST_FORMAT = ['query', 'subject', 'query_length', 'subject_length',
+                        'query_start', 'query_end', 'subject_start',
+                        'subject_end', 'expect', 'identity']
+
 
 def generate_tabblast_format(fmt):
     'Given a list with fields with our names it return one with the blast ones'
@@ -84,11 +100,22 @@ def _blastdb_exists(dbpath, dbtype=None):
     return any([os.path.exists(dbpath + ext) for ext in exts])
 
 
-def get_or_create_blastdb(blastdb_or_path, dbtype=None, directory=None):
+def _create_blastdb(seq_fpath, dbpath, dbtype=None):
+    if seq_fpath != dbpath:
+        seqio([open(seq_fpath)], open(dbpath, 'w'), out_format='fasta',
+              copy_if_same_format=False)
+    if dbtype is None:
+        dbtype = guess_seq_type(open(dbpath))
+    _makeblastdb_plus(dbpath, dbtype)
+
+
+def get_or_create_blastdb(blastdb_or_path, dbtype=None, directory=None,
+                          use_index_cache=True):
     '''it returns a blast database.
 
     If it does not exists it creates and if you give it a directory it will
-    create it in that directory if it does not exist yet
+    create it in that directory if it does not exist yet. If no directory is
+    given the database is taken from the index cache.
     '''
     seq_fpath = _get_abs_blastdb_path(blastdb_or_path, dbtype)
     if directory:
@@ -101,12 +128,17 @@ def get_or_create_blastdb(blastdb_or_path, dbtype=None, directory=None):
         if not os.path.exists(seq_fpath):
             msg = 'An input sequence is required to create a blastdb'
             raise RuntimeError(msg)
-        if seq_fpath != dbpath:
-            seqio([open(seq_fpath)], open(dbpath, 'w'), out_format='fasta',
-                  copy_if_same_format=False)
-        if dbtype is None:
-            dbtype = guess_seq_type(open(dbpath))
-        _makeblastdb_plus(dbpath, dbtype)
+        index_cache = get_index_cache() if use_index_cache else None
+        if not directory and index_cache is not None:
+            binary = get_binary_path('makeblastdb')
+            version = get_tool_version(binary, ['-version'])
+            kind = 'blastdb' if dbtype is None else 'blastdb_' + dbtype
+
+            def builder(seq_fpath, dbpath):
+                _create_blastdb(seq_fpath, dbpath, dbtype=dbtype)
+            return index_cache.get_or_create(seq_fpath, kind, builder,
+                                             version=version)
+        _create_blastdb(seq_fpath, dbpath, dbtype=dbtype)
     return dbpath
 
 
@@ -177,6 +209,14 @@ def do_blast(query_fpath, db_fpath, program, out_fpath, params=None,
 
 def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
     'It does a blast'
+    cmd = _get_blast_cmd(query_fpath, db_fpath, program, out_fpath,
+                         params=params)
+    process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    check_process_finishes(process, binary=cmd[0])
+
+
+def _get_blast_cmd(query_fpath, db_fpath, program, out_fpath, params=None):
+    'It returns the command line for a local blast'
     if not params:
         params = {}
     evalue, task = _parse_blast_params(params, program)
@@ -197,12 +237,11 @@ def _do_blast_local(query_fpath, db_fpath, program, out_fpath, params=None):
     if params:
         for key, value in params.viewitems():
             cmd.extend(('-' + key, str(value)))
-    process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    check_process_finishes(process, binary=cmd[0])
+    return cmd
 
 
 def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
-                params=None, remote=False):
+                params=None, remote=False, use_index_cache=True):
     '''It returns an alignment result with the blast.
 
     It is an alternative interface to the one based on fpaths.
@@ -219,11 +258,10 @@ def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
         blastdb = db_fpath
         fmt = 'XML' if blast_format is None else blast_format.upper()
     else:
-        blastdb = get_or_create_blastdb(db_fpath, dbtype=dbtype)
+        blastdb = get_or_create_blastdb(db_fpath, dbtype=dbtype,
+                                        use_index_cache=use_index_cache)
         if blast_format is None:
-            blast_format = ['query', 'subject', 'query_length', 'subject_length',
-                            'query_start', 'query_end', 'subject_start',
-                            'subject_end', 'expect', 'identity', ]
+            blast_format = DEFAULT_BLAST_FORMAT
         fmt = generate_tabblast_format(blast_format)
 
     if params is None:
@@ -241,6 +279,290 @@ def _do_blast_2(db_fpath, queries, program, dbtype=None, blast_format=None,
     return blasts, blast_fhand
 
 
+def _get_blastdb_key(blastdb):
+    'It returns a key that changes when the blast database changes'
+    sha1 = hashlib.sha1(os.path.abspath(blastdb))
+    for fpath in sorted(glob.glob(blastdb + '.*')):
+        stat = os.stat(fpath)
+        sha1.update('\t'.join([os.path.basename(fpath), str(stat.st_size),
+                               str(stat.st_mtime)]))
+    return sha1.hexdigest()
+
+
+class _BlastRequest(object):
+    'The queries of a search that are waiting for their blast results'
+    def __init__(self, num_queries):
+        self.results = {}
+        self.error = None
+        self.done = threading.Event()
+        self._missing = num_queries
+
+    def deliver(self, key, lines, error=None):
+        'It stores the results of a query and it wakes the search when done'
+        if error is None:
+            self.results[key] = lines
+        else:
+            self.error = error
+        self._missing -= 1
+        if not self._missing or error is not None:
+            self.done.set()
+
+
+def _get_blast_parser(seqs, lines_by_seq):
+    'It returns a parser for the result lines of every seq, without query'
+    out_fhand = StringIO()
+    for seq, lines in zip(seqs, lines_by_seq):
+        name = get_name(seq)
+        for line in lines:
+            out_fhand.write(name + '\t' + line)
+    return TabularBlastParser(out_fhand, DEFAULT_BLAST_FORMAT)
+
+
+class BlastRunner(object):
+    '''It runs local blast searches against a database.
+
+    The queries of all the searches are put in a queue. A fixed set of
+    worker threads, max_processes, take from it batches of up to batch_size
+    queries, so the queries of the packets searched at the same time are
+    blasted together, and each worker runs one blast process at a time.
+    The results are sent back to the searches waiting for them.
+    If cache_fpath is given the results are cached by query sequence, so
+    the sequences already searched in this or in previous runs are not
+    blasted again.
+    '''
+    def __init__(self, blastdb, program, dbtype=None, params=None,
+                 batch_size=None, max_processes=None, cache_fpath=None):
+        if batch_size is None:
+            batch_size = get_setting('BLAST_BATCH_SIZE')
+        if max_processes is None:
+            max_processes = get_setting('BLAST_MAX_PROCESSES')
+        if cache_fpath is None:
+            cache_fpath = get_setting('BLAST_RESULTS_CACHE')
+        self.batch_size = int(batch_size)
+        self.max_processes = int(max_processes)
+        self.blastdb = get_or_create_blastdb(blastdb, dbtype=dbtype)
+        self.program = program
+
+        params = {} if params is None else dict(params)
+        search_params = sorted((key, str(value))
+                               for key, value in params.viewitems()
+                               if key not in ('num_threads', 'outfmt'))
+        if 'num_threads' not in params:
+            params['num_threads'] = max(1, cpu_count() // self.max_processes)
+        params['outfmt'] = generate_tabblast_format(DEFAULT_BLAST_FORMAT)
+        self._params = params
+
+        search_key = [program, _get_blastdb_key(self.blastdb)]
+        search_key.extend('{}={}'.format(*param) for param in search_params)
+        self._search_key = '\t'.join(search_key)
+
+        # the sqlite connections can only be used by the thread that opens
+        # them, every searching thread opens its own
+        self._cache_fpath = cache_fpath
+        self._thread_data = threading.local()
+
+        self._pid = None
+        self._lock = None
+        self._pending = None
+        self._waiting = None
+
+    def _get_cache(self):
+        'It returns the results cache of the current thread or None'
+        if not self._cache_fpath:
+            return None
+        thread_data = self._thread_data
+        try:
+            return thread_data.cache
+        except AttributeError:
+            # if the cache can not be opened the results will not be cached
+            thread_data.cache = open_sqlite_cache(self._cache_fpath)
+            return thread_data.cache
+
+    def _get_query_key(self, str_seq):
+        return hashlib.sha1(self._search_key + '\t' + str_seq).hexdigest()
+
+    def _start_workers(self):
+        'It starts the worker threads, once per process'
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Condition()
+        self._pending = deque()     # (key, str_seq) not taken by a worker
+        self._waiting = {}          # the requests waiting for every key
+        for _ in range(self.max_processes):
+            worker = threading.Thread(target=self._run_batches)
+            worker.daemon = True
+            worker.start()
+
+    def _start_blast(self, queries):
+        query_fhand = tempfile.NamedTemporaryFile(suffix='.fasta')
+        for key, str_seq in queries:
+            query_fhand.write('>' + key + '\n' + str_seq + '\n')
+        query_fhand.flush()
+        out_fhand = tempfile.NamedTemporaryFile(suffix='.blast')
+        cmd = _get_blast_cmd(query_fhand.name, self.blastdb, self.program,
+                             out_fhand.name, params=dict(self._params))
+        process = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process, cmd[0], query_fhand, out_fhand
+
+    @staticmethod
+    def _collect_blast(blast, results):
+        process, binary, query_fhand, out_fhand = blast
+        check_process_finishes(process, binary=binary)
+        for line in open(out_fhand.name):
+            key, line = line.split('\t', 1)
+            results[key].append(line)
+        query_fhand.close()
+        out_fhand.close()
+
+    def _take_batch(self):
+        'It waits for pending queries and it takes a batch of them'
+        with self._lock:
+            while not self._pending:
+                self._lock.wait()
+            pending = self._pending
+            return [pending.popleft()
+                    for _ in range(min(self.batch_size, len(pending)))]
+
+    def _run_batches(self):
+        'It blasts the queries of all the waiting searches, batch by batch'
+        while True:
+            batch = self._take_batch()
+            results = {key: [] for key, _ in batch}
+            error = None
+            try:
+                self._collect_blast(self._start_blast(batch), results)
+            except Exception, error:
+                # the searches waiting for this batch will raise it
+                pass
+            with self._lock:
+                for key, _ in batch:
+                    for request in self._waiting.pop(key):
+                        request.deliver(key, results[key], error)
+
+    def _blast(self, queries):
+        'It queues the given {key: str_seq} queries and it waits for them'
+        self._start_workers()
+        request = _BlastRequest(len(queries))
+        with self._lock:
+            for key, str_seq in queries.viewitems():
+                waiting = self._waiting.get(key)
+                if waiting is None:
+                    self._waiting[key] = [request]
+                    self._pending.append((key, str_seq))
+                else:
+                    # other search is already waiting for this sequence
+                    waiting.append(request)
+            self._lock.notify_all()
+        # a wait without timeout would not let the main thread be interrupted
+        while not request.done.wait(1):
+            pass
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def get_lines(self, str_seqs):
+        '''It returns the tabular blast result lines of every sequence.
+
+        The query field is removed from the lines.
+        '''
+        keys = [self._get_query_key(str_seq) for str_seq in str_seqs]
+        cache = self._get_cache()
+        results = {}
+        queries = {}
+        for key, str_seq in zip(keys, str_seqs):
+            if key in results or key in queries:
+                continue
+            lines = None if cache is None else cache[key]
+            if lines is None:
+                queries[key] = str_seq
+            else:
+                results[key] = lines
+
+        if queries:
+            new_results = self._blast(queries)
+            results.update(new_results)
+            if cache is not None:
+                try:
+                    cache.update(new_results.viewitems())
+                except sqlite3.Error:
+                    # other process could be writing the cache
+                    pass
+        return [results[key] for key in keys]
+
+    def search(self, seqs):
+        'It returns the alignments for the given sequences'
+        seqs = list(seqs)
+        lines = self.get_lines([get_str_seq(seq) for seq in seqs])
+        return _get_blast_parser(seqs, lines)
+
+
+class _BlastManager(BaseManager):
+    'It serves the blast runners shared by the worker processes'
+    pass
+
+
+_BlastManager.register('BlastRunner', BlastRunner, exposed=('get_lines',))
+
+
+class SharedBlastRunner(object):
+    '''It searches with a BlastRunner served by a manager process.
+
+    It can be pickled and sent to the worker processes, the queries of the
+    packets that all of them search at the same time are batched together.
+    '''
+    def __init__(self, runner_proxy):
+        self._runner = runner_proxy
+
+    def search(self, seqs):
+        'It returns the alignments for the given sequences'
+        seqs = list(seqs)
+        lines = self._runner.get_lines([get_str_seq(seq) for seq in seqs])
+        return _get_blast_parser(seqs, lines)
+
+
+_BLAST_RUNNERS = {}
+_BLAST_MANAGERS = {}
+
+
+def _get_blast_manager():
+    'It returns the blast manager of this process, it starts it if needed'
+    pid = os.getpid()
+    try:
+        manager = _BLAST_MANAGERS[pid]
+    except KeyError:
+        manager = _BlastManager()
+        manager.start()
+        _BLAST_MANAGERS[pid] = manager
+    return manager
+
+
+def get_blast_runner(blastdb, program, dbtype=None, params=None):
+    '''It returns a blast runner for the given database and parameters.
+
+    The runners are shared by the packets processed by a process. The
+    processes that can have children serve the runner from a manager
+    process, so it is shared as well by the worker processes to which it
+    is sent. The worker processes of a Pool can not have children, if they
+    ask for a runner they get one of their own.
+    '''
+    params = {} if params is None else params
+    key = (os.getpid(), blastdb, program, dbtype,
+           tuple(sorted((key, str(value)) for key, value in params.items())))
+    try:
+        return _BLAST_RUNNERS[key]
+    except KeyError:
+        pass
+    if current_process().daemon:
+        runner = BlastRunner(blastdb, program, dbtype=dbtype, params=params)
+    else:
+        proxy = _get_blast_manager().BlastRunner(blastdb, program,
+                                                 dbtype=dbtype, params=params)
+        runner = SharedBlastRunner(proxy)
+    _BLAST_RUNNERS[key] = runner
+    return runner
+
+
 class BlasterForFewSubjects(object):
     '''It matches the given SeqRecords against the reads in the file.
 
@@ -280,30 +602,18 @@ class BlasterForFewSubjects(object):
         seqio([open(seq_fpath)], open(dbpath, 'w'), out_format='fasta',
               copy_if_same_format=False)
 
+        # The reads change in every packet, it is useless to cache their db
         blasts, blast_fhand = _do_blast_2(dbpath, oligos, params=self.params,
                                           program=self.program,
-                                          dbtype=seqs_type)
+                                          dbtype=seqs_type,
+                                          use_index_cache=False)
         if self.filters is not None:
             blasts = filter_alignments(blasts, config=self.filters)
 
         # Which are the regions covered in each sequence?
-        indexed_match_parts = {}
-        for blast in blasts:
-            oligo = blast['query']
-            for match in blast['matches']:
-                read = match['subject']
-                if self.elongate_for_global:
-                    elongate_match_parts_till_global(match['match_parts'],
-                                                 query_length=oligo['length'],
-                                                 subject_length=read['length'],
-                                                 align_completely=QUERY)
-
-                # match_parts = [m['match_parts'] for m in blast['matches']]
-                match_parts = match['match_parts']
-                try:
-                    indexed_match_parts[read['name']].extend(match_parts)
-                except KeyError:
-                    indexed_match_parts[read['name']] = match_parts
+        elongate = self.elongate_for_global
+        indexed_match_parts = index_match_parts_by_subject(blasts,
+                                                  elongate_for_global=elongate)
 
         temp_dir.close()
         blast_fhand.close()
@@ -319,25 +629,21 @@ class BlasterForFewSubjects(object):
         except KeyError:
             # There was no match in the blast
             return None
-
-        # Any of the match_parts has been elongated?
-        elongated_match = False
-        for m_p in match_parts:
-            if ELONGATED in m_p and m_p[ELONGATED] > ignore_elongation_shorter:
-                elongated_match = True
-        segments = covered_segments_from_match_parts(match_parts,
-                                                     in_query=False)
-        return segments, elongated_match
+        return covered_segments_in_subject(match_parts,
+                                           ignore_elongation_shorter)
 
 
 class Blaster(object):
     '''It matches the given SeqRecords against a blast database.
     It needs iterable with seqrecords and a blast dabatase
+    The local searches are done by the given runner or by the one returned
+    by get_blast_runner.
     '''
 
     def __init__(self, seqrecords, blastdb, program, dbtype=None, params=None,
-                 filters=None, remote=False):
+                 filters=None, remote=False, runner=None):
         self.program = program
+        self._runner = runner
         if params is None:
             params = {}
         self.params = params
@@ -352,15 +658,22 @@ class Blaster(object):
 
     def _look_for_blast_matches(self, seqrecords, blastdb, dbtype):
         'it makes the blast and filters the results'
-        blasts, blast_fhand = _do_blast_2(blastdb, seqrecords, self.program,
-                                          params=self.params, dbtype=dbtype,
-                                          remote=self._remote)
-        # print open(blast_fhand.name).read()
+        if self._remote:
+            blasts, blast_fhand = _do_blast_2(blastdb, seqrecords,
+                                              self.program, params=self.params,
+                                              dbtype=dbtype, remote=True)
+        else:
+            runner = self._runner
+            if runner is None:
+                runner = get_blast_runner(blastdb, self.program,
+                                          dbtype=dbtype, params=self.params)
+            blasts, blast_fhand = runner.search(seqrecords), None
         if self.filters is not None:
             blasts = filter_alignments(blasts, config=self.filters)
 
         blasts = {blast['query']['name']: blast for blast in blasts}
-        blast_fhand.close()
+        if blast_fhand is not None:
+            blast_fhand.close()
         return blasts
 
     def get_matched_segments(self, seqrecord_name):
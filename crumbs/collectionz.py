@@ -14,6 +14,12 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 from bisect import bisect
+from itertools import islice
+from hashlib import sha1
+
+import numpy
+
+_HASH_CHUNK_SIZE = 1000000
 
 
 class OrderedSet(object):
@@ -74,3 +80,66 @@ class KeyedSet(object):
 
     def __len__(self):
         return len(self._items)
+
+
+def _hash_names(names):
+    '''It returns an array with the 64 bit hashes of the names.
+
+    The hash is the first 8 bytes of the sha1 digest, so it does not depend
+    on the platform or the python build.
+    '''
+    if not names:
+        return numpy.array([], dtype=numpy.int64)
+    digests = ''.join([sha1(name).digest()[:8] for name in names])
+    return numpy.frombuffer(digests, dtype='<i8').astype(numpy.int64)
+
+
+class HashedNameSet(object):
+    '''A compact set of names that keeps only a 64 bit hash of every name.
+
+    The hashes are kept in a sorted numpy array, so the set takes 8 bytes
+    per name and the names can be streamed into it. Two names could share
+    a hash, if exact is True the names are also kept and every hit is
+    confirmed against them.
+    '''
+    def __init__(self, names=None, exact=False):
+        self._exact_names = set() if exact else None
+        self._hashes = numpy.array([], dtype=numpy.int64)
+        if names is not None:
+            self.update(names)
+
+    def update(self, names):
+        'It adds the names, they are read in chunks'
+        names = iter(names)
+        exact_names = self._exact_names
+        chunks = [self._hashes]
+        while True:
+            chunk = list(islice(names, _HASH_CHUNK_SIZE))
+            if not chunk:
+                break
+            if exact_names is not None:
+                exact_names.update(chunk)
+            chunks.append(numpy.unique(_hash_names(chunk)))
+        if len(chunks) > 1:
+            self._hashes = numpy.unique(numpy.concatenate(chunks))
+
+    def contains_batch(self, names):
+        'It returns a boolean array with the membership of every name'
+        hashes = self._hashes
+        query_hashes = _hash_names(names)
+        if not len(hashes):
+            return numpy.zeros(len(query_hashes), dtype=numpy.bool_)
+        idxs = numpy.searchsorted(hashes, query_hashes)
+        idxs[idxs == len(hashes)] = 0
+        found = hashes[idxs] == query_hashes
+        exact_names = self._exact_names
+        if exact_names is not None:
+            for idx in numpy.flatnonzero(found):
+                found[idx] = names[idx] in exact_names
+        return found
+
+    def __contains__(self, name):
+        return bool(self.contains_batch([name])[0])
+
+    def __len__(self):
+        return len(self._hashes)
@@ -110,3 +110,8 @@ class ItemsNotSortedError(Exception):
 class IsSingleLineFastqError(Exception):
     'File format is single line'
     pass
+
+
+class NotIndexableError(Exception):
+    'The records of the file can not be located by their offsets'
+    pass
@@ -13,63 +13,61 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import random
+from math import exp, log, log1p, floor
 from itertools import izip_longest, islice, tee, izip
 import cPickle as pickle
 from tempfile import NamedTemporaryFile
-import sqlite3
 from collections import namedtuple
 
 from crumbs.utils.optional_modules import merge_sorted
 from crumbs.exceptions import SampleSizeError
+from crumbs.utils.sqlite_utils import SqliteStore
+
+_END = object()
 
 
 class _ListLikeDb(object):
-    def __init__(self):
+    'A list kept in a temporary sqlite store'
+    def __init__(self, commit_every=1000):
         self._db_fhand = NamedTemporaryFile(suffix='.sqlite.db')
-        self._conn = sqlite3.connect(self._db_fhand.name)
-        create = 'CREATE TABLE items(idx INTEGER PRIMARY KEY, item BLOB);'
-        self._conn.execute(create)
-        self._conn.commit()
-        self._last_item_returned = None
+        # it is a temporary file, we do not need a journal
+        self._store = SqliteStore(self._db_fhand.name, table='items',
+                                  key_type='INTEGER',
+                                  commit_every=commit_every,
+                                  journal_mode='OFF', synchronous='OFF')
+        self._len = 0
 
     def __len__(self):
-        conn = self._conn
-        cursor = conn.execute('SELECT COUNT(*) FROM items;')
-        return cursor.fetchone()[0]
+        return self._len
 
     def append(self, item):
-        conn = self._conn
-        insert = "INSERT INTO items(item) VALUES (?)"
-        conn.execute(insert, (pickle.dumps(item),))
-        conn.commit()
+        self._store.set(self._len, item)
+        self._len += 1
 
     def __setitem__(self, key, item):
-        update = "UPDATE items SET item=? WHERE idx=?"
-        conn = self._conn
-        conn.execute(update, (pickle.dumps(item), key))
-        conn.commit()
+        if key < 0 or key >= self._len:
+            raise IndexError('list assignment index out of range')
+        self._store.set(key, item)
+
+    def __getitem__(self, key):
+        if key < 0 or key >= self._len:
+            raise IndexError('list index out of range')
+        return self._store.get(key)
 
     def __iter__(self):
-        return self
+        self._store.commit()
+        for _, item in self._store.items(order_by='key'):
+            yield item
 
-    def next(self):
-        if self._last_item_returned is None:
-            idx = 1
-        else:
-            idx = self._last_item_returned + 1
-        select = 'SELECT item FROM items WHERE idx=?'
-        conn = self._conn
-        cursor = conn.execute(select, (idx, ))
-        item = cursor.fetchone()
-        if item is None:
-            raise StopIteration()
-
-        item = str(item[0])
-
-        item = pickle.loads(str(item))
-        self._last_item_returned = idx
-        return item
+
+def _random_open_unit():
+    'It returns a random number in the (0, 1) interval'
+    while True:
+        number = random.random()
+        if number:
+            return number
 
 
 def sample(iterator, sample_size, in_disk=False):
@@ -79,28 +77,33 @@ def sample(iterator, sample_size, in_disk=False):
     Since it does not know before hand the size of the iterator it has to
     keep a buffer as large as the sample size in memory (default) or in disk.
     '''
-    # This implementation holds the sampled items in memory
-    # Example of the algorithm seen in:
-    # http://nedbatchelder.com/blog/201208/selecting_randomly_from_an_unknown_
-    # sequence.html
-    # See also:
-    # http://stackoverflow.com/questions/12128948/python-random-lines-from-
-    # subfolders/
+    # This is the Algorithm L of the reservoir sampling, instead of drawing
+    # a random number per item it calculates how many items to skip until
+    # the next one that enters the sample.
+    # Li, K. H. (1994) Reservoir-Sampling Algorithms of Time Complexity
+    # O(n(1+log(N/n))). ACM Trans. Math. Softw. 20, 4, 481-493.
+    if sample_size <= 0:
+        raise SampleSizeError('No items to sample')
 
+    iterator = iter(iterator)
     if in_disk:
         sample_ = _ListLikeDb()
     else:
         sample_ = []
-    too_big_sample = True
-    for index, elem in enumerate(iterator):
-        if len(sample_) < sample_size:
-            sample_.append(elem)
-        else:
-            too_big_sample = False
-            if random.randint(0, index) < sample_size:
-                sample_[random.randint(0, sample_size - 1)] = elem
-    if too_big_sample:
+    for elem in islice(iterator, sample_size):
+        sample_.append(elem)
+    if len(sample_) < sample_size:
         raise SampleSizeError('Sample larger than population')
+
+    weight = exp(log(_random_open_unit()) / sample_size)
+    while True:
+        skip = floor(log(_random_open_unit()) / log1p(-weight))
+        skip = int(min(skip, sys.maxsize))
+        elem = next(islice(iterator, skip, None), _END)
+        if elem is _END:
+            break
+        sample_[random.randrange(sample_size)] = elem
+        weight *= exp(log(_random_open_unit()) / sample_size)
     return iter(sample_)
 
 
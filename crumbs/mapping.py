@@ -13,10 +13,15 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 import os.path
+import sys
 import shutil
 from subprocess import PIPE
 from tempfile import NamedTemporaryFile
 import tempfile
+from threading import Thread
+from itertools import chain
+from Queue import Queue
+from contextlib import contextmanager
 
 import pysam
 
@@ -24,12 +29,13 @@ from crumbs.utils.bin_utils import (check_process_finishes, get_binary_path,
                                     popen, get_num_threads)
 from crumbs.settings import get_setting
 from crumbs.utils.file_utils import TemporaryDir
+from crumbs.utils.index_cache import get_index_cache, get_tool_version
 
 from crumbs.seq.utils.file_formats import get_format
 from crumbs.seq.seq import SeqItem, SeqWrapper, get_str_seq, get_name
 from crumbs.utils.tags import SEQITEM
 from crumbs.iterutils import sorted_items
-from crumbs.seq.seqio import read_seqs
+from crumbs.seq.seqio import read_seqs, write_seqs
 
 
 def _bwa_index_exists(index_path):
@@ -37,24 +43,42 @@ def _bwa_index_exists(index_path):
     return os.path.exists('{}.bwt'.format(index_path))
 
 
-def _create_bwa_index(index_fpath):
+def _create_bwa_index(index_fpath, prefix=None):
     binary = get_binary_path('bwa')
     # how many sequences do we have?
     n_seqs = [l for l in open(index_fpath) if l[0] == '>']
     algorithm = 'bwtsw' if n_seqs > 10000 else 'is'
-    cmd = [binary, 'index', '-a', algorithm, index_fpath]
+    cmd = [binary, 'index', '-a', algorithm]
+    if prefix is not None:
+        cmd.extend(['-p', prefix])
+    cmd.append(index_fpath)
     process = popen(cmd, stdout=PIPE, stderr=PIPE)
     check_process_finishes(process, binary=cmd[0])
 
 
-def get_or_create_bwa_index(fpath, directory=None):
-    'It creates the bwa index for the given reference'
+def _build_cached_bwa_index(fpath, index_fpath):
+    # only the index files are kept in the cache, not the reference
+    _create_bwa_index(fpath, prefix=index_fpath)
+
+
+def _get_or_create_bwa_index(fpath, directory=None):
+    'It returns the index path and the index cache if it has been used'
     fpath = os.path.abspath(fpath)
     if directory is not None:
         index_fpath = os.path.join(directory, os.path.basename(fpath))
     else:
         index_fpath = fpath
 
+    index_cache = get_index_cache()
+    if (directory is None and index_cache is not None and
+        not _bwa_index_exists(index_fpath)):
+        binary = get_binary_path('bwa')
+        version = get_tool_version(binary, [])
+        index_fpath = index_cache.get_or_create(fpath, 'bwa',
+                                                _build_cached_bwa_index,
+                                                version=version)
+        return index_fpath, index_cache
+
     if not _bwa_index_exists(index_fpath):
         if os.path.exists(index_fpath):
             temp_dir = TemporaryDir()
@@ -71,13 +95,40 @@ def get_or_create_bwa_index(fpath, directory=None):
             os.symlink(fpath, index_fpath)
             _create_bwa_index(index_fpath)
 
-    return index_fpath
+    return index_fpath, None
+
+
+def get_or_create_bwa_index(fpath, directory=None):
+    '''It creates the bwa index for the given reference
+
+    If no directory is given and the index does not exist next to the
+    reference it is taken from the index cache. The cached index is locked
+    until the process ends, use_bwa_index releases it when it is no longer
+    used.
+    '''
+    return _get_or_create_bwa_index(fpath, directory=directory)[0]
+
+
+@contextmanager
+def use_bwa_index(fpath, directory=None):
+    'It yields the bwa index path, a cached index is released at the end'
+    index_fpath, index_cache = _get_or_create_bwa_index(fpath,
+                                                        directory=directory)
+    try:
+        yield index_fpath
+    finally:
+        if index_cache is not None:
+            index_cache.release(index_fpath)
 
 
 def map_with_bwamem(index_fpath, unpaired_fpath=None, paired_fpaths=None,
                     interleave_fpath=None, threads=None, log_fpath=None,
-                    extra_params=None, readgroup=None):
-    'It maps with bwa mem algorithm'
+                    extra_params=None, readgroup=None, stdin=None):
+    '''It maps with bwa mem algorithm
+
+    With a '-' as the reads path and stdin=PIPE the reads are given by the
+    stdin.
+    '''
     interleave = False
     num_called_fpaths = 0
     in_fpaths = []
@@ -121,7 +172,7 @@ def map_with_bwamem(index_fpath, unpaired_fpath=None, paired_fpaths=None,
     else:
         stderr = open(log_fpath, 'w')
     #raw_input(' '.join(cmd))
-    bwa = popen(cmd, stderr=stderr, stdout=PIPE)
+    bwa = popen(cmd, stderr=stderr, stdout=PIPE, stdin=stdin)
     return bwa
 
 TOPHAT_RG_TRANSLATOR = {'LB': 'library', 'SM': 'sample', 'ID': 'id',
@@ -184,28 +235,67 @@ def _bowtie2_index_exists(index_path):
     return os.path.exists('{}.1.bt2'.format(index_path))
 
 
-def get_or_create_bowtie2_index(fpath, directory=None):
-    "it creates the bowtie2 index"
+def _create_bowtie2_index(fpath, index_fpath):
     binary = get_binary_path('bowtie2-build')
+    cmd = [binary, '-f', fpath, index_fpath]
+    process = popen(cmd, stdout=PIPE, stderr=PIPE)
+    check_process_finishes(process, binary=cmd[0])
+
+
+def _get_or_create_bowtie2_index(fpath, directory=None):
+    'It returns the index path and the index cache if it has been used'
     if directory is not None:
         index_fpath = os.path.join(directory, os.path.basename(fpath))
     else:
         index_fpath = fpath
-    if not _bowtie2_index_exists(index_fpath):
-        cmd = [binary, '-f', fpath, index_fpath]
-        process = popen(cmd, stdout=PIPE, stderr=PIPE)
-        check_process_finishes(process, binary=cmd[0])
-    return index_fpath
+    if _bowtie2_index_exists(index_fpath):
+        return index_fpath, None
+
+    index_cache = get_index_cache()
+    if directory is None and index_cache is not None:
+        binary = get_binary_path('bowtie2-build')
+        version = get_tool_version(binary, ['--version'])
+        index_fpath = index_cache.get_or_create(fpath, 'bowtie2',
+                                                _create_bowtie2_index,
+                                                version=version)
+        return index_fpath, index_cache
+    _create_bowtie2_index(fpath, index_fpath)
+    return index_fpath, None
+
+
+def get_or_create_bowtie2_index(fpath, directory=None):
+    '''it creates the bowtie2 index
+
+    If no directory is given and the index does not exist next to the
+    reference it is taken from the index cache. The cached index is locked
+    until the process ends, use_bowtie2_index releases it when it is no
+    longer used.
+    '''
+    return _get_or_create_bowtie2_index(fpath, directory=directory)[0]
+
+
+@contextmanager
+def use_bowtie2_index(fpath, directory=None):
+    'It yields the bowtie2 index path, a cached index is released at the end'
+    index_fpath, index_cache = _get_or_create_bowtie2_index(fpath,
+                                                           directory=directory)
+    try:
+        yield index_fpath
+    finally:
+        if index_cache is not None:
+            index_cache.release(index_fpath)
 
 
 def map_with_bowtie2(index_fpath, paired_fpaths=None,
                      unpaired_fpath=None, readgroup=None, threads=None,
                      log_fpath=None, preset='very-sensitive-local',
-                     extra_params=None):
+                     extra_params=None, stdin=None):
     '''It maps with bowtie2.
 
     paired_seqs is a list of tuples, in which each tuple are paired seqs
     unpaired_seqs is a list of files
+    With a '-' as unpaired_fpath and stdin=PIPE the reads are given by the
+    stdin.
     '''
     if readgroup is None:
         readgroup = {}
@@ -241,7 +331,7 @@ def map_with_bowtie2(index_fpath, paired_fpaths=None,
     else:
         stderr = open(log_fpath, 'w')
 
-    bowtie2 = popen(cmd, stderr=stderr, stdout=PIPE)
+    bowtie2 = popen(cmd, stderr=stderr, stdout=PIPE, stdin=stdin)
     # print bowtie2.stdout.read()
     return bowtie2
 
@@ -282,6 +372,140 @@ def map_process_to_sortedbam(map_process, out_fpath, key='coordinate',
     sort.communicate()
 
 
+def _identity(item):
+    return item
+
+
+class MappingSession(object):
+    '''It maps a stream of read packets with a single aligner process.
+
+    The aligner reads the seqs from its stdin and writes SAM to its stdout,
+    so the index is loaded only once. The packets are written by a thread
+    while the SAM text is being read, so the aligner can buffer as many
+    reads as it needs. The aligner has to keep the input order (bowtie2
+    requires --reorder), the packet boundaries are found by counting the
+    primary records, there is one per read. The secondary and supplementary
+    records that follow the last primary one go with its packet.
+    '''
+    def __init__(self, map_process, file_format=None, binary='aligner'):
+        self._process = map_process
+        self._file_format = file_format
+        self._binary = binary
+        self._packets = Queue()
+        self._error = None
+        self.header_lines = []
+
+    def _feed(self, packets, get_seqs):
+        stdin = self._process.stdin
+        try:
+            for packet in packets:
+                seqs = get_seqs(packet)
+                self._packets.put((packet, len(seqs)))
+                write_seqs(seqs, stdin, self._file_format)
+                stdin.flush()
+        except IOError, error:
+            # The pipe could be already closed, the reader will complain
+            if 'Broken pipe' not in str(error):
+                self._error = sys.exc_info()
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._packets.put(None)
+            try:
+                stdin.close()
+            except IOError:
+                pass
+
+    def _raise_error(self):
+        if self._error is not None:
+            exc_type, exc_value, traceback = self._error
+            self._error = None
+            raise exc_type, exc_value, traceback
+
+    def _read_records(self):
+        stdout = self._process.stdout
+        in_header = True
+        # readline does not wait for a full read ahead buffer
+        for line in iter(stdout.readline, ''):
+            if in_header:
+                if line.startswith('@'):
+                    self.header_lines.append(line)
+                    continue
+                in_header = False
+            yield line
+
+    def _finish(self, feeder, records):
+        # the aligner can not finish while its output is not read
+        extra_lines = sum(1 for _ in records)
+        feeder.join()
+        self._raise_error()
+        # the feeder has already closed the stdin
+        self._process.stdin = None
+        check_process_finishes(self._process, binary=self._binary)
+        if extra_lines:
+            msg = '{:s} returned more alignments than reads'
+            raise RuntimeError(msg.format(self._binary))
+
+    def map_packets(self, packets, get_seqs=None):
+        '''It yields every packet with the SAM lines of its seqs.
+
+        get_seqs takes the list of seqs from a packet, by default the packets
+        are lists of seqs.
+        '''
+        if get_seqs is None:
+            get_seqs = _identity
+        feeder = Thread(target=self._feed, args=(packets, get_seqs))
+        feeder.daemon = True
+        feeder.start()
+
+        records = self._read_records()
+        next_line = None
+        while True:
+            item = self._packets.get()
+            if item is None:
+                break
+            packet, n_reads = item
+            sam_lines = []
+            n_primary = 0
+            while n_primary < n_reads:
+                if next_line is None:
+                    line = next(records, None)
+                else:
+                    line, next_line = next_line, None
+                if line is None:
+                    self._finish(feeder, records)
+                    msg = '{:s} returned fewer alignments than reads'
+                    raise RuntimeError(msg.format(self._binary))
+                sam_lines.append(line)
+                if not int(line.split('\t', 2)[1]) & 0x900:
+                    # neither secondary nor supplementary
+                    n_primary += 1
+            # bwa mem writes the supplementary records after the primary one
+            if sam_lines:
+                last_qname = sam_lines[-1].split('\t', 1)[0]
+                for line in records:
+                    qname, flag = line.split('\t', 2)[:2]
+                    if qname != last_qname or not int(flag) & 0x900:
+                        next_line = line
+                        break
+                    sam_lines.append(line)
+            yield packet, sam_lines
+        if next_line is not None:
+            records = chain([next_line], records)
+        self._finish(feeder, records)
+
+
+def get_mapped_names_from_sam(sam_lines, min_mapq=None):
+    'It yields the names of the mapped reads found in the SAM lines'
+    for line in sam_lines:
+        qname, flag, _, _, mapq = line.split('\t', 5)[:5]
+        if int(flag) & 4:
+            continue
+        if min_mapq and int(mapq) <= min_mapq:
+            continue
+        yield qname
+
+
 # this should probably be placed somewhere else
 def _reverse(sequence):
     reverse_seq = ''
@@ -34,6 +34,8 @@ match_part is a dict:
                   'subject_strand' : 1 or -1
                   'scores'         :a dict with the scores
             }
+The tabular blast parser yields MatchPart instances instead of dicts, they
+can be used as dicts, but they take much less memory.
 Iprscan has several evidences generated by different programs and databases
 for every match. Every evidence is similar to a match.
 '''
@@ -216,79 +218,151 @@ DEFAULT_TABBLAST_FORMAT = ('query', 'subject', 'identity', 'alignment_length',
                            'query_end', 'subject_start', 'subject_end',
                            'expect', 'score')
 
+_LOCATION_FIELDS = ('query_start', 'query_end', 'subject_start',
+                    'subject_end')
+_SCORE_FIELDS = ('expect', 'score', 'identity')
+
+
+class MatchPart(object):
+    '''A match_part (an hsp) that stores its fields in slots.
+
+    It behaves like the match_part dict described in the module docstring,
+    but it takes much less memory, so it is used by the parsers that can
+    yield millions of them.
+    '''
+    __slots__ = ('query_start', 'query_end', 'query_strand', 'subject_start',
+                 'subject_end', 'subject_strand', 'scores', ELONGATED)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.viewitems():
+            self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            getattr(self, key)
+        except (AttributeError, TypeError):
+            return False
+        return True
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MatchPart({})'.format(dict(self.items()))
+
+    def __getstate__(self):
+        return self.items()
+
+    def __setstate__(self, state):
+        for key, value in state:
+            setattr(self, key, value)
+
 
 def _lines_for_every_tab_blast(fhand, line_format):
     'It returns the lines for every query in the tabular blast'
+    field_index = {field: index for index, field in enumerate(line_format)}
+    n_fields = len(line_format)
+    query_idx = field_index['query']
+    subject_idx = field_index['subject']
+    query_len_idx = field_index.get('query_length')
+    subject_len_idx = field_index.get('subject_length')
+    location_idxs = [(field, field_index[field]) for field in _LOCATION_FIELDS
+                                                 if field in field_index]
+    score_idxs = [(field, field_index[field]) for field in _SCORE_FIELDS
+                                              if field in field_index]
 
     ongoing_query = None
+    ongoing_query_len = None
     match_parts = []
     for line in fhand:
-        items = line.strip().split()
-        if len(line_format) != len(items):
+        items = line.split()
+        if n_fields != len(items):
             msg = 'Malformed line. The line has an unexpected number of items.'
             msg += '\nExpected format was: ' + ' '.join(line_format) + '\n'
             msg += 'Line was: ' + line + '\n'
             raise RuntimeError(msg)
-        items = dict(zip(line_format, items))
 
-        query = items['query']
-        subject = items['subject']
-        if 'query_length' in items:
-            query_len = int(items['query_length'])
-        else:
+        query = items[query_idx]
+        subject = items[subject_idx]
+        if query_len_idx is None:
             query_len = None
-        if 'subject_length' in items:
-            subject_len = int(items['subject_length'])
         else:
+            query_len = int(items[query_len_idx])
+        if subject_len_idx is None:
             subject_len = None
-
-        locations = ('query_start', 'query_end', 'subject_start',
-                     'subject_end')
-        match_part = {}
-        for field in locations:
-            if field in items:
-                match_part[field] = int(items[field]) - 1
-
-        score_fields = ('expect', 'score', 'identity')
-        scores = {}
-        for field in score_fields:
-            if field in items:
-                scores[field] = float(items[field])
-        if scores:
-            match_part['scores'] = scores
-
-        if ongoing_query is None:
-            ongoing_query = query
-            match_parts.append({'subject': subject, 'match_part': match_part,
-                                'subject_length': subject_len})
-        elif query == ongoing_query:
-            match_parts.append({'subject': subject, 'match_part': match_part,
-                                'subject_length': subject_len})
         else:
-            yield ongoing_query, query_len, match_parts
-            match_parts = [{'subject':subject, 'match_part':match_part,
-                            'subject_length': subject_len}]
-            ongoing_query = query
+            subject_len = int(items[subject_len_idx])
+
+        match_part = MatchPart()
+        for field, index in location_idxs:
+            setattr(match_part, field, int(items[index]) - 1)
+        if score_idxs:
+            match_part.scores = {field: float(items[index])
+                                 for field, index in score_idxs}
+
+        if ongoing_query is not None and query != ongoing_query:
+            yield ongoing_query, ongoing_query_len, match_parts
+            match_parts = []
+        ongoing_query = query
+        ongoing_query_len = query_len
+        match_parts.append((subject, subject_len, match_part))
     if ongoing_query:
-        yield ongoing_query, query_len, match_parts
+        yield ongoing_query, ongoing_query_len, match_parts
 
 
 def _group_match_parts_by_subject(match_parts):
     'It yields lists of match parts that share the subject'
     parts = []
     ongoing_subject = None
-    for match_part in match_parts:
-        subject = match_part['subject']
-        subject_length = match_part['subject_length']
+    for subject, subject_length, match_part in match_parts:
         if ongoing_subject is None:
-            parts.append(match_part['match_part'])
+            parts.append(match_part)
             ongoing_subject = subject
             ongoing_subject_length = subject_length
         elif ongoing_subject == subject:
-            parts.append(match_part['match_part'])
+            parts.append(match_part)
         else:
             yield ongoing_subject, ongoing_subject_length, parts
-            parts = [match_part['match_part']]
+            parts = [match_part]
             ongoing_subject = subject
             ongoing_subject_length = subject_length
     else:
@@ -853,7 +927,7 @@ def _create_scores_mapper_(score_key, score_tolerance=None,
         log_tolerance = None
 
     def map_(alignment):
-        '''It returns an alignment with the best matches'''
+        '''It returns a new alignment with the best matches'''
         if alignment is None:
             return None
         if log_tolerance is None:
@@ -878,16 +952,15 @@ def _create_scores_mapper_(score_key, score_tolerance=None,
                 if _score_above_threshold(score, min_score, max_score,
                                           log_tolerance, log_best_score):
                     filtered_match_parts.append(match_part)
-            match['match_parts'] = filtered_match_parts
-            if not len(match['match_parts']):
+            if not filtered_match_parts:
                 continue
+            match = dict(match, match_parts=filtered_match_parts)
             # is this match ok?
             match_score = get_match_score(match, score_key)
             if _score_above_threshold(match_score, min_score, max_score,
                                       log_tolerance, log_best_score):
                 filtered_matches.append(match)
-        alignment['matches'] = filtered_matches
-        return alignment
+        return dict(alignment, matches=filtered_matches)
     return map_
 
 
@@ -973,15 +1046,15 @@ def _fix_matches(alignment, score_keys=None):
     new_matches = []
     for match in alignment['matches']:
         if len(match['match_parts']):
+            # the given match is not modified
+            match = dict(match)
             if score_keys:
                 _fix_match_scores(match, score_keys)
             _fix_match_start_end(match)
             new_matches.append(match)
     if not new_matches:
         return None
-    else:
-        alignment['matches'] = new_matches
-    return alignment
+    return dict(alignment, matches=new_matches)
 
 
 def _create_fix_matches_mapper():
@@ -1109,6 +1182,42 @@ def elongate_match_parts_till_global(match_parts, query_length,
                                                          for mp in match_parts]
 
 
+def index_match_parts_by_subject(alignments, elongate_for_global=False):
+    '''It returns a dict with the match_parts found in every subject.
+
+    If elongate_for_global is True the match_parts are stretched to align
+    the queries completely.
+    '''
+    indexed_match_parts = {}
+    for alignment in alignments:
+        query = alignment['query']
+        for match in alignment['matches']:
+            subject = match['subject']
+            if elongate_for_global:
+                elongate_match_parts_till_global(match['match_parts'],
+                                                 query['length'],
+                                                 subject['length'],
+                                                 align_completely=QUERY)
+            match_parts = match['match_parts']
+            try:
+                indexed_match_parts[subject['name']].extend(match_parts)
+            except KeyError:
+                indexed_match_parts[subject['name']] = match_parts
+    return indexed_match_parts
+
+
+def covered_segments_in_subject(match_parts, ignore_elongation_shorter):
+    '''It returns the segments covered in the subject and if any of them
+    has been elongated more than the given number of residues'''
+    elongated_match = False
+    for m_p in match_parts:
+        if ELONGATED in m_p and m_p[ELONGATED] > ignore_elongation_shorter:
+            elongated_match = True
+    segments = covered_segments_from_match_parts(match_parts,
+                                                 in_query=False)
+    return segments, elongated_match
+
+
 def _match_length(match, length_from_query):
     '''It returns the match length.
 
@@ -1196,10 +1305,10 @@ def _create_min_length_mapper(length_in_query, min_num_residues=None,
                                                        length_in_query)
                     if match_part_ok:
                         filtered_match_parts.append(match_part)
-                match['match_parts'] = filtered_match_parts
-                if not len(match['match_parts']):
+                if not filtered_match_parts:
                     continue
-                filtered_matches.append(match)
+                filtered_matches.append(dict(match,
+                                             match_parts=filtered_match_parts))
             else:
                 match_length = _match_length(match, length_in_query)
                 match_ok = _match_long_enough(match_length, mol_length,
@@ -1208,8 +1317,7 @@ def _create_min_length_mapper(length_in_query, min_num_residues=None,
                                                   length_in_query)
                 if match_ok:
                     filtered_matches.append(match)
-        alignment['matches'] = filtered_matches
-        return alignment
+        return dict(alignment, matches=filtered_matches)
     return map_
 
 
@@ -1236,24 +1344,38 @@ FILTER_COLLECTION = {'best_scores':
                     }
 
 
+def _create_pipeline(config):
+    '''It composes the filters and mappers in a function.
+
+    The function returns the mapped alignment or None if it has been
+    filtered out, it stops as soon as one step discards the alignment.
+    '''
+    steps = []
+    for conf in config:
+        conf = dict(conf)
+        filter_ = FILTER_COLLECTION[conf.pop('kind')]
+        steps.append((filter_['kind'], filter_['funct_factory'](**conf)))
+
+    def pipeline(alignment):
+        'It runs the alignment through every step'
+        for kind, function in steps:
+            if kind == MAPPER:
+                alignment = function(alignment)
+                if alignment is None:
+                    return None
+            elif not function(alignment):
+                return None
+        return alignment
+    return pipeline
+
+
 def filter_alignments(alignments, config):
     '''It filters and maps the given alignments.
 
     The filters and maps to use will be decided based on the configuration.
+    The given alignments are not modified, the mappers create new
+    alignments and matches, but the match_parts are shared with the given
+    ones.
     '''
-    config = copy.deepcopy(config)
-    config.insert(0, {'kind': 'deepcopy'})
-    config.append({'kind': 'fix_matches'})
-    config.append({'kind': 'filter_empty'})
-
-    # create the pipeline
-    for conf in config:
-        funct_fact = FILTER_COLLECTION[conf['kind']]['funct_factory']
-        kind = FILTER_COLLECTION[conf['kind']]['kind']
-        del conf['kind']
-        function = funct_fact(**conf)
-        if kind == MAPPER:
-            alignments = itertools.imap(function, alignments)
-        else:
-            alignments = itertools.ifilter(function, alignments)
-    return alignments
+    pipeline = _create_pipeline(list(config) + [{'kind': 'fix_matches'}])
+    return itertools.ifilter(None, itertools.imap(pipeline, alignments))
@@ -17,6 +17,8 @@ import os.path
 from tempfile import NamedTemporaryFile
 from random import randint
 
+import numpy
+
 from crumbs.utils.optional_modules import SeqFeature, FeatureLocation
 
 from crumbs.utils.bin_utils import (get_binary_path, popen,
@@ -24,11 +26,13 @@ from crumbs.utils.bin_utils import (get_binary_path, popen,
 from crumbs.utils.tags import FIVE_PRIME, THREE_PRIME
 from crumbs.seq.seq import get_description, get_name, get_str_seq
 from crumbs.seq.seqio import write_seqs, read_seqs
-from crumbs.blast import Blaster
+from crumbs.blast import Blaster, get_blast_runner
 from crumbs.settings import get_setting
 
 # pylint: disable=R0903
 
+_POLYA_SCAN_WINDOW = 32
+
 
 def _run_estscan(seqs, pep_out_fpath, dna_out_fpath, matrix_fpath):
     'It runs estscan in the input seqs'
@@ -108,87 +112,156 @@ class EstscanOrfAnnotator(object):
         return seqs
 
 
-def _detect_polya_tail(seq, location, min_len, max_cont_mismatches):
-    '''It detects 3' poylA or 5' polyT tails.
+def _previous_positions(mask, seq_starts):
+    '''It returns the last position, up to every position, in which the mask
+    is True.
+
+    The position will be the previous one to the sequence start if there is
+    no True position in the sequence.
+    '''
+    positions = numpy.where(mask, numpy.arange(mask.size), -1)
+    return numpy.maximum(numpy.maximum.accumulate(positions), seq_starts - 1)
+
+
+def _scan_tails(tail_ends, tail_nucl, min_len, max_cont_mismatches):
+    '''It looks for the tails at the beginning of the given strings.
+
+    It returns the tail lengths and if the end of every tail has been found.
+    The tails are found with the cumulative counts of the tail nucleotides
+    and the mismatches of all the strings joined in one array.
+    '''
+    nucls = numpy.frombuffer(''.join(tail_ends).upper(), dtype=numpy.uint8)
+    seq_lens = numpy.array([len(tail_end) for tail_end in tail_ends],
+                           dtype=int)
+    seq_ends = numpy.cumsum(seq_lens)
+    seq_starts = seq_ends - seq_lens
+    seq_starts_by_nucl = numpy.repeat(seq_starts, seq_lens)
+
+    is_tail = nucls == ord(tail_nucl)
+    is_mismatch = numpy.logical_not(is_tail | (nucls == ord('N')))
+    # the cumulative counts are shifted by one, cum_counts[i] has the count
+    # up to i - 1
+    cum_tails = numpy.concatenate(([0], numpy.cumsum(is_tail)))
+    cum_mismatches = numpy.concatenate(([0], numpy.cumsum(is_mismatch)))
+
+    # the tail nucleotides since the last mismatch (the Ns do not count)
+    last_mismatches = _previous_positions(is_mismatch, seq_starts_by_nucl)
+    poly_counts = cum_tails[1:] - cum_tails[last_mismatches + 1]
+    # the mismatches since the last tail nucleotide
+    last_tails = _previous_positions(is_tail, seq_starts_by_nucl)
+    mismatch_counts = cum_mismatches[1:] - cum_mismatches[last_tails + 1]
+
+    # the tail ends at the first position with too many mismatches
+    too_many = mismatch_counts > max_cont_mismatches
+    cum_too_many = numpy.concatenate(([0], numpy.cumsum(too_many)))
+    stopped = cum_too_many[:-1] > cum_too_many[seq_starts_by_nucl]
+    tail_finished = cum_too_many[seq_ends] > cum_too_many[seq_starts]
+
+    in_tail = (poly_counts >= min_len) & numpy.logical_not(stopped)
+    tail_lens = numpy.where(in_tail,
+                            numpy.arange(nucls.size) - seq_starts_by_nucl + 1,
+                            0)
+    results = [0] * seq_lens.size
+    not_empty = numpy.flatnonzero(seq_lens)
+    if not_empty.size:
+        max_tail_lens = numpy.maximum.reduceat(tail_lens,
+                                               seq_starts[not_empty])
+        for index, tail_len in zip(not_empty.tolist(),
+                                   max_tail_lens.tolist()):
+            results[index] = tail_len
+    return results, tail_finished.tolist()
+
+
+def _detect_polya_tails(str_seqs, location, min_len, max_cont_mismatches):
+    '''It detects 3' poylA or 5' polyT tails in many sequences at once.
 
     This function is a re-implementation of the EMBOSS's trimest code.
-    It will return the position of a poly-A in 3' or a poly-T in 5'.
-    It returns the start and end of the tail. The nucleotide in the end
-    position won't be included in the poly-A.
+    It will return the position of a poly-A in 3' or a poly-T in 5' for
+    every sequence.
+    Only the sequence ends are scanned, they are extended for the sequences
+    in which the tail could go on.
+    It returns the start and end of the tails or None. The nucleotide in the
+    end position won't be included in the poly-A.
     '''
     if location == FIVE_PRIME:
         tail_nucl = 'T'
-        inc = 1
-        start = 0
-        end = len(seq)
+        get_tail_end = lambda seq, window: seq[:window]
     elif location == THREE_PRIME:
         tail_nucl = 'A'
-        inc = -1
-        start = -1
-        end = -len(seq) - 1
+        # the 3' end is read backwards
+        get_tail_end = lambda seq, window: seq[:-window - 1:-1]
     else:
         msg = 'location should be five or three prime'
         raise ValueError(msg)
 
-    mismatch_count = 0
-    poly_count = 0
-    tail_len = 0
-    result = 0
-
-    for index in range(start, end, inc):
-        nucl = seq[index].upper()
-        if nucl == tail_nucl:
-            poly_count += 1
-            mismatch_count = 0
-        elif nucl == 'N':
-            pass
+    tail_lens = [0] * len(str_seqs)
+    window = _POLYA_SCAN_WINDOW
+    to_scan = range(len(str_seqs))
+    while to_scan:
+        tail_ends = [get_tail_end(str_seqs[index], window)
+                                                       for index in to_scan]
+        results, finished = _scan_tails(tail_ends, tail_nucl, min_len,
+                                        max_cont_mismatches)
+        not_finished = []
+        for index, tail_len, finished_ in zip(to_scan, results, finished):
+            tail_lens[index] = tail_len
+            if not finished_ and len(str_seqs[index]) > window:
+                not_finished.append(index)
+        to_scan = not_finished
+        window *= 4
+
+    tails = []
+    for tail_len, seq in zip(tail_lens, str_seqs):
+        if not tail_len:
+            tails.append(None)
+        elif location == FIVE_PRIME:
+            tails.append((0, tail_len))
         else:
-            poly_count = 0
-            mismatch_count += 1
-        if poly_count >= min_len:
-            result = tail_len + 1
-        if mismatch_count > max_cont_mismatches:
-            break
-        tail_len += 1
-    if result and location == FIVE_PRIME:
-        start = 0
-        end = result
-        result = start, end
-    elif result and location == THREE_PRIME:
-        end = len(seq)
-        start = end - result
-        result = start, end
-    else:
-        result = None
-    return result
+            tails.append((len(seq) - tail_len, len(seq)))
+    return tails
 
 
-def _annotate_polya(seq, min_len, max_cont_mismatches):
-    'It annotates the polyA with the EMBOSS trimest method'
-    str_seq = get_str_seq(seq)
-    polya = _detect_polya_tail(str_seq, THREE_PRIME, min_len,
-                               max_cont_mismatches)
-    polyt = _detect_polya_tail(str_seq, FIVE_PRIME, min_len,
-                               max_cont_mismatches)
-    a_len = polya[1] - polya[0] if polya else 0
-    t_len = polyt[1] - polyt[0] if polyt else 0
-    chosen_tail = None
-    if a_len > t_len:
-        chosen_tail = 'A'
-    elif t_len > a_len:
-        chosen_tail = 'T'
-    elif a_len and a_len == t_len:
-        if randint(0, 1):
+def _detect_polya_tail(seq, location, min_len, max_cont_mismatches):
+    '''It detects 3' poylA or 5' polyT tails.
+
+    It returns the start and end of the tail. The nucleotide in the end
+    position won't be included in the poly-A.
+    '''
+    return _detect_polya_tails([seq], location, min_len,
+                               max_cont_mismatches)[0]
+
+
+def get_polya_tails(str_seqs, min_len, max_cont_mismatches):
+    '''It returns the poly-A or poly-T tails with the EMBOSS trimest method.
+
+    For every sequence it returns the start, end and strand of the tail or
+    None. The strand is 1 for the poly-A and -1 for the poly-T.
+    '''
+    polyas = _detect_polya_tails(str_seqs, THREE_PRIME, min_len,
+                                 max_cont_mismatches)
+    polyts = _detect_polya_tails(str_seqs, FIVE_PRIME, min_len,
+                                 max_cont_mismatches)
+    tails = []
+    for polya, polyt in zip(polyas, polyts):
+        a_len = polya[1] - polya[0] if polya else 0
+        t_len = polyt[1] - polyt[0] if polyt else 0
+        chosen_tail = None
+        if a_len > t_len:
             chosen_tail = 'A'
-        else:
+        elif t_len > a_len:
             chosen_tail = 'T'
-    if chosen_tail:
-        strand = 1 if chosen_tail == 'A' else -1
-        start, end = polya if chosen_tail == 'A' else polyt
-        feat = SeqFeature(location=FeatureLocation(start, end, strand),
-                          type='polyA_sequence')
-        # We're assuming that the seq has a SeqRecord in it
-        seq.object.features.append(feat)
+        elif a_len and a_len == t_len:
+            if randint(0, 1):
+                chosen_tail = 'A'
+            else:
+                chosen_tail = 'T'
+        if chosen_tail == 'A':
+            tails.append((polya[0], polya[1], 1))
+        elif chosen_tail == 'T':
+            tails.append((polyt[0], polyt[1], -1))
+        else:
+            tails.append(None)
+    return tails
 
 
 class PolyaAnnotator(object):
@@ -209,8 +282,16 @@ class PolyaAnnotator(object):
         max_cont_mismatches = self._max_cont_mismatches
         min_len = self._min_len
 
-        for seq in seqrecords:
-            _annotate_polya(seq, min_len, max_cont_mismatches)
+        tails = get_polya_tails([get_str_seq(seq) for seq in seqrecords],
+                                min_len, max_cont_mismatches)
+        for seq, tail in zip(seqrecords, tails):
+            if tail is None:
+                continue
+            start, end, strand = tail
+            feat = SeqFeature(location=FeatureLocation(start, end, strand),
+                              type='polyA_sequence')
+            # We're assuming that the seq has a SeqRecord in it
+            seq.object.features.append(feat)
         return seqrecords
 
 
@@ -225,6 +306,13 @@ class BlastAnnotator(object):
         self._params = params
         self._dbtype = dbtype
         self._remote = remote
+        # it is taken here, so the packets of all the worker processes share
+        # the runner
+        if remote:
+            self._runner = None
+        else:
+            self._runner = get_blast_runner(blastdb, program, dbtype=dbtype,
+                                            params=params)
 
     def __call__(self, seqrecords):
         'It does the work'
@@ -232,7 +320,8 @@ class BlastAnnotator(object):
             return seqrecords
         matcher = Blaster(seqrecords, self.blastdb, self._program,
                                self._dbtype, filters=self._filters,
-                               params=self._params, remote=self._remote)
+                               params=self._params, remote=self._remote,
+                               runner=self._runner)
         blasts = matcher.blasts
         blastdb = os.path.basename(self.blastdb)
         for seqrecord in seqrecords:
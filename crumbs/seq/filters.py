@@ -16,7 +16,10 @@
 # pylint: disable=C0111
 
 from __future__ import division
-from tempfile import NamedTemporaryFile
+from itertools import chain
+from subprocess import PIPE
+
+import numpy
 
 try:
     from pysam import Samfile
@@ -25,16 +28,18 @@ except ImportError:
     pass
 
 from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, SEQITEM,
-                               SEQRECORD)
+                               SEQRECORD, MATE_FILTERED_OUT)
 from crumbs.seq.utils.seq_utils import uppercase_length, get_uppercase_segments
 from crumbs.seq.seq import get_name, get_file_format, get_str_seq, get_length
 from crumbs.exceptions import WrongFormatError
-from crumbs.blast import Blaster, BlasterForFewSubjects
+from crumbs.blast import Blaster, get_blast_runner
+from crumbs.seq.oligo_matcher import OligoMatcher
 from crumbs.statistics import calculate_dust_score
 from crumbs.settings import get_setting
-from crumbs.mapping import map_with_bowtie2, map_process_to_bam
-from crumbs.seq.seqio import write_seqs
+from crumbs.mapping import (map_with_bowtie2, MappingSession,
+                            get_mapped_names_from_sam)
 from crumbs.seq.pairs import group_pairs, group_pairs_by_name
+from crumbs.collectionz import HashedNameSet
 
 
 def seq_to_filterpackets(seq_packets, group_paired_reads=False):
@@ -65,6 +70,9 @@ class _BaseFilter(object):
 
     def __call__(self, filterpacket):
         self._setup_checks(filterpacket)
+        return self._filter_packet(filterpacket)
+
+    def _filter_packet(self, filterpacket):
         reverse = self.reverse
         failed_drags_pair = self.failed_drags_pair
         seqs_passed = []
@@ -86,6 +94,30 @@ class _BaseFilter(object):
 
         return {SEQS_PASSED: seqs_passed, SEQS_FILTERED_OUT: filtered_out}
 
+    def filter_mates(self, mate_packet):
+        '''It marks the mates of the pairs that do not pass in a MatePacket.
+
+        Only the pairs with both mates kept are checked, the orphans left
+        by the trimmers are not filtered.
+        '''
+        to_check = numpy.flatnonzero(mate_packet.kept_pairs)
+        mates1, mates2 = mate_packet.mates
+        seqs1 = [mates1[index] for index in to_check.tolist()]
+        seqs2 = [mates2[index] for index in to_check.tolist()]
+        self._setup_checks({SEQS_PASSED: [seqs1 + seqs2],
+                            SEQS_FILTERED_OUT: []})
+        do_check = self._do_check
+        checks = numpy.array([map(do_check, seqs1), map(do_check, seqs2)],
+                             dtype=bool).reshape(2, len(to_check))
+        if self.reverse:
+            checks = ~checks
+        if self.failed_drags_pair:
+            pairs_passed = checks.all(axis=0)
+        else:
+            pairs_passed = checks.any(axis=0)
+        mate_packet.status[:, to_check[~pairs_passed]] = MATE_FILTERED_OUT
+        return mate_packet
+
 
 class FilterByFeatureTypes(_BaseFilter):
     'It filters out sequences not annotated with the given feature types'
@@ -114,20 +146,22 @@ class FilterByRpkm(_BaseFilter):
             - values should be dicts with length, mapped_reads and
             unmmapped_reads, counts
         '''
-        self._read_counts = read_counts
         self._min_rpkm = min_rpkm
         total_reads = sum([v['mapped_reads'] + v['unmapped_reads'] for v in read_counts.values()])
-        self._million_reads = total_reads / 1e6
+        million_reads = total_reads / 1e6
+        # the rpkms are calculated once and not for every read
+        self._rpkms = {}
+        for ref_name, count in read_counts.viewitems():
+            if not count['length']:
+                continue
+            kb_len = count['length'] / 1000
+            rpk = count['mapped_reads'] / kb_len  # rpks
+            self._rpkms[ref_name] = rpk / million_reads  # rpkms
         super(FilterByRpkm, self).__init__(reverse=reverse,
                                            failed_drags_pair=failed_drags_pair)
 
     def _do_check(self, seq):
-        count = self._read_counts[get_name(seq)]
-
-        kb_len = count['length'] / 1000
-        rpk = count['mapped_reads'] / kb_len  # rpks
-        rpkm = rpk / self._million_reads  # rpkms
-
+        rpkm = self._rpkms[get_name(seq)]
         return True if rpkm >= self._min_rpkm else False
 
 
@@ -164,37 +198,45 @@ class FilterByLength(_BaseFilter):
 
 class FilterById(_BaseFilter):
     'It removes the sequences not found in the given set'
-    def __init__(self, seq_ids, failed_drags_pair=True, reverse=False):
+    def __init__(self, seq_ids, failed_drags_pair=True, reverse=False,
+                 exact=False):
         '''The initiator.
 
         seq_ids - An iterator with the sequence ids to keep
         reverse - if True keep the sequences not found on the list
+        exact - if True the hash hits are confirmed with the ids
         '''
-        if not isinstance(seq_ids, set):
-            seq_ids = set(seq_ids)
+        if not isinstance(seq_ids, HashedNameSet):
+            seq_ids = HashedNameSet(seq_ids, exact=exact)
         self.seq_ids = seq_ids
         super(FilterById, self).__init__(failed_drags_pair=failed_drags_pair,
                                               reverse=reverse)
 
+    def _setup_checks(self, filterpacket):
+        names = [get_name(s) for seqs in filterpacket[SEQS_PASSED]
+                 for s in seqs]
+        found = self.seq_ids.contains_batch(names)
+        self._found_names = dict(zip(names, found.tolist()))
+
     def _do_check(self, seq):
-        return True if get_name(seq) in self.seq_ids else False
+        return self._found_names[get_name(seq)]
 
 
 def _get_mapped_reads(bam_fpath, min_mapq=0):
     bam = Samfile(bam_fpath)
-    return [read.qname for read in bam if not read.is_unmapped and (not min_mapq or read.mapq > min_mapq)]
+    return (read.qname for read in bam if not read.is_unmapped and (not min_mapq or read.mapq > min_mapq))
 
 
 class FilterByBam(FilterById):
     'It filters the reads not mapped in the given BAM files'
-    def __init__(self, bam_fpaths, min_mapq=0, reverse=False):
-        seq_ids = self._get_mapped_reads(bam_fpaths, min_mapq)
+    def __init__(self, bam_fpaths, min_mapq=0, reverse=False, exact=False):
+        seq_ids = self._get_mapped_reads(bam_fpaths, min_mapq, exact)
         super(FilterByBam, self).__init__(seq_ids, reverse=reverse)
 
-    def _get_mapped_reads(self, bam_fpaths, min_mapq):
-        mapped_reads = []
+    def _get_mapped_reads(self, bam_fpaths, min_mapq, exact=False):
+        mapped_reads = HashedNameSet(exact=exact)
         for fpath in bam_fpaths:
-            mapped_reads.extend(_get_mapped_reads(fpath, min_mapq=min_mapq))
+            mapped_reads.update(_get_mapped_reads(fpath, min_mapq=min_mapq))
         return mapped_reads
 
 
@@ -240,19 +282,13 @@ class FilterBlastShort(_BaseFilter):
     def _setup_checks(self, filterpacket):
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
 
-        # we create a blastdb for these reads and then we use the oligos
-        # as the blast query
-        db_fhand = write_seqs(seqs, file_format='fasta')
-        db_fhand.flush()
-        params = {'task': 'blastn-short', 'expect': '0.0001'}
+        # the reads are the subjects and the oligos the queries
         filters = [{'kind': 'score_threshold', 'score_key': 'identity',
                     'min_score': 87},
                    {'kind': 'min_length', 'min_num_residues': 13,
                     'length_in_query': False}]
-        self._matcher = BlasterForFewSubjects(db_fhand.name, self.oligos,
-                                             program='blastn', filters=filters,
-                                             params=params,
-                                             elongate_for_global=False)
+        self._matcher = OligoMatcher(seqs, self.oligos, filters=filters,
+                                     expect=0.0001, elongate_for_global=False)
 
     def _do_check(self, seq):
         segments = self._matcher.get_matched_segments_for_read(get_name(seq))
@@ -274,6 +310,9 @@ class FilterBlastMatch(_BaseFilter):
         self._blast_program = program
         self._filters = filters
         self._dbtype = dbtype
+        # it is taken here, so the packets of all the worker processes share
+        # the runner
+        self._runner = get_blast_runner(database, program, dbtype=dbtype)
         super(FilterBlastMatch, self).__init__(reverse=reverse,
                                           failed_drags_pair=failed_drags_pair)
 
@@ -281,67 +320,103 @@ class FilterBlastMatch(_BaseFilter):
         seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
         self._matcher = Blaster(seqs, self._blast_db, dbtype=self._dbtype,
                                 program=self._blast_program,
-                                filters=self._filters)
+                                filters=self._filters,
+                                runner=self._runner)
 
     def _do_check(self, seq):
         segments = self._matcher.get_matched_segments(get_name(seq))
         return True if segments is None else False
 
 
+def _get_bowtie2_input_params(seq):
+    'It returns the format and the bowtie2 parameters for the given reads'
+    seq_class = seq.kind
+    extra_params = []
+    # Which format do we need for the bowtie2 input read file fasta or
+    # fastq?
+    if seq_class == SEQRECORD:
+        if 'phred_quality' in seq.object.letter_annotations.viewkeys():
+            file_format = 'fastq'
+        else:
+            extra_params.append('-f')
+            file_format = 'fasta'
+    elif seq_class == SEQITEM:
+        file_format = get_file_format(seq)
+        if 'illumina' in file_format:
+            extra_params.append('--phred64')
+        elif 'fasta' in file_format:
+            extra_params.append('-f')
+        elif 'fastq' in file_format:
+            pass
+        else:
+            msg = 'For FilterBowtie2Match and SeqItems fastq or fasta '
+            msg += 'files are required'
+            raise RuntimeError(msg)
+    else:
+        raise NotImplementedError()
+    return file_format, extra_params
+
+
+def _get_packet_seqs(filterpacket):
+    return [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
+
+
 class FilterBowtie2Match(_BaseFilter):
-    'It filters a seq if it maps against a bowtie2 index'
+    '''It filters a seq if it maps against a bowtie2 index
+
+    Called with a packet it maps the packet with its own bowtie2 process,
+    filter_packets maps a stream of packets with a single bowtie2.
+    '''
     def __init__(self, index_fpath, reverse=False, min_mapq=None,
-                 failed_drags_pair=True, threads=None):
+                 failed_drags_pair=True, threads=None, exact=False):
         self._index_fpath = index_fpath
         self._reverse = reverse
-        self.min_mapq = min_mapq
+        self.min_mapq = int(min_mapq) if min_mapq else min_mapq
         self.threads = threads
+        self._exact = exact
         super(FilterBowtie2Match, self).__init__(reverse=reverse,
                                           failed_drags_pair=failed_drags_pair)
 
-    def _setup_checks(self, filterpacket):
-        index_fpath = self._index_fpath
-        seqs = [s for seqs in filterpacket[SEQS_PASSED]for s in seqs]
-        seq_class = seqs[0].kind
-        extra_params = []
-        # Which format do we need for the bowtie2 input read file fasta or
-        # fastq?
-        if seq_class == SEQRECORD:
-            if 'phred_quality' in seqs[0].object.letter_annotations.viewkeys():
-                file_format = 'fastq'
-            else:
-                extra_params.append('-f')
-                file_format = 'fasta'
-        elif seq_class == SEQITEM:
-            file_format = get_file_format(seqs[0])
-            if 'illumina' in file_format:
-                extra_params.append('--phred64')
-            elif 'fasta' in file_format:
-                extra_params.append('-f')
-            elif 'fastq' in file_format:
-                pass
-            else:
-                msg = 'For FilterBowtie2Match and SeqItems fastq or fasta '
-                msg += 'files are required'
-                raise RuntimeError(msg)
-        else:
-            raise NotImplementedError()
-
-        reads_fhand = NamedTemporaryFile(suffix=file_format)
-        write_seqs(seqs, reads_fhand, file_format=file_format)
-        reads_fhand.flush()
-
-        bam_fhand = NamedTemporaryFile(suffix='.bam')
-        map_process = map_with_bowtie2(index_fpath,
-                                       unpaired_fpath=reads_fhand.name,
+    def _start_session(self, seq):
+        file_format, extra_params = _get_bowtie2_input_params(seq)
+        # the session requires the reads in the input order
+        extra_params.append('--reorder')
+        map_process = map_with_bowtie2(self._index_fpath, unpaired_fpath='-',
                                        extra_params=extra_params,
-                                       threads=self.threads)
-        map_process_to_bam(map_process, bam_fhand.name)
+                                       threads=self.threads, stdin=PIPE)
+        return MappingSession(map_process, file_format=file_format,
+                              binary='bowtie2')
+
+    def _set_mapped_reads(self, seqs, sam_lines):
+        mapped_reads = HashedNameSet(get_mapped_names_from_sam(sam_lines,
+                                                               self.min_mapq),
+                                     exact=self._exact)
+        names = [get_name(seq) for seq in seqs]
+        found = mapped_reads.contains_batch(names)
+        self._mapped_names = dict(zip(names, found.tolist()))
 
-        self.mapped_reads = _get_mapped_reads(bam_fhand.name, self.min_mapq)
+    def _setup_checks(self, filterpacket):
+        seqs = _get_packet_seqs(filterpacket)
+        session = self._start_session(seqs[0])
+        for mapped_seqs, sam_lines in session.map_packets([seqs]):
+            self._set_mapped_reads(mapped_seqs, sam_lines)
+
+    def filter_packets(self, filterpackets):
+        'It filters a stream of packets mapping them with one bowtie2'
+        filterpackets = iter(filterpackets)
+        try:
+            first_packet = next(filterpackets)
+        except StopIteration:
+            return
+        session = self._start_session(_get_packet_seqs(first_packet)[0])
+        filterpackets = chain([first_packet], filterpackets)
+        for filterpacket, sam_lines in session.map_packets(filterpackets,
+                                                    get_seqs=_get_packet_seqs):
+            self._set_mapped_reads(_get_packet_seqs(filterpacket), sam_lines)
+            yield self._filter_packet(filterpacket)
 
     def _do_check(self, seq):
-        return False if get_name(seq) in self.mapped_reads else True
+        return False if self._mapped_names[get_name(seq)] else True
 
 
 class FilterDustComplexity(_BaseFilter):
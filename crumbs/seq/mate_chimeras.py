@@ -66,7 +66,7 @@ def _split_mates(alignments_group):
 
 def _get_primary_alignment(alignments_group):
     for alignment in alignments_group:
-        if not alignment.is_secondary:
+        if not alignment.is_secondary and not alignment.is_supplementary:
             return alignment
 
 
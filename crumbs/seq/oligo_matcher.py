@@ -0,0 +1,377 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+'''
+An in process matcher for short oligos, like adaptors and linkers.
+
+It looks for few short oligos in a packet of reads without creating a blast
+database for the reads and without running blastn-short. The oligos and
+their reverse complements are indexed by their words, the words found in
+the reads are used as seeds and the seeds are verified with an alignment
+restricted to the band of diagonals around them. The scoring follows the
+blastn-short defaults and the alignments are returned as match_parts, so the
+alignment_result filters and elongations can be used with them.
+'''
+
+from __future__ import division
+
+from math import exp, log
+from string import maketrans
+
+from crumbs.seq.seq import get_name, get_str_seq
+from crumbs.seq.alignment_result import (filter_alignments, MatchPart,
+                                         index_match_parts_by_subject,
+                                         covered_segments_in_subject)
+from crumbs.settings import get_setting
+
+# pylint: disable=C0111
+
+# blastn-short defaults
+WORD_SIZE = 7
+MATCH_SCORE = 1
+MISMATCH_SCORE = -3
+GAP_OPEN = 5
+GAP_EXTEND = 2
+# Karlin-Altschul parameters for the 1/-3 scoring
+_LAMBDA = 1.374
+_K = 0.711
+_H = 1.31
+# As blast, the hits that score less than the gap trigger (27 bits) are
+# discarded
+_MIN_SCORE = int((27 * log(2) + log(_K)) / _LAMBDA)
+
+_BAND = 3
+_COMPLEMENT = maketrans('ACGTN', 'TGCAN')
+_NO_SCORE = -1000000
+
+
+def _reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def _ungapped_local_alignment(query, subject, diag):
+    '''It returns the best segment along the given diagonal (j - i).
+
+    It returns the score, the query and the subject starts and ends and the
+    number of identical residues and the alignment length.
+    '''
+    q_start = max(0, -diag)
+    q_end = min(len(query), len(subject) - diag)
+    best_score, best_start, best_end = 0, None, None
+    score, start = 0, q_start
+    for q_idx in xrange(q_start, q_end):
+        if query[q_idx] == subject[q_idx + diag]:
+            score += MATCH_SCORE
+        else:
+            score += MISMATCH_SCORE
+        if score <= 0:
+            score, start = 0, q_idx + 1
+        elif score > best_score:
+            best_score, best_start, best_end = score, start, q_idx
+    if best_start is None:
+        return None
+    length = best_end - best_start + 1
+    n_identical = (length * MATCH_SCORE - best_score) // (MATCH_SCORE -
+                                                         MISMATCH_SCORE)
+    n_identical = length - n_identical
+    return (best_score, best_start, best_end, best_start + diag,
+            best_end + diag, n_identical, length)
+
+
+def _banded_local_alignment(query, subject, min_diag, max_diag):
+    '''It does a Smith-Waterman with affine gaps restricted to a band.
+
+    Only the cells with a diagonal (j - i) between min_diag and max_diag are
+    computed. It returns the same tuple than _ungapped_local_alignment.
+    '''
+    len_q, len_s = len(query), len(subject)
+    width = max_diag - min_diag + 1
+    gap_first = GAP_OPEN + GAP_EXTEND
+    # The matrices have one row per query prefix and one column per
+    # diagonal in the band.
+    prev_h = [0] * width
+    prev_f = [_NO_SCORE] * width
+    back_h = [None] * (len_q + 1)
+    back_e = [None] * (len_q + 1)
+    back_f = [None] * (len_q + 1)
+    best = 0, None, None
+    for q_idx in xrange(1, len_q + 1):
+        row_h = [0] * width
+        row_e = [_NO_SCORE] * width
+        row_f = [_NO_SCORE] * width
+        row_back_h = [0] * width
+        row_back_e = [False] * width
+        row_back_f = [False] * width
+        q_res = query[q_idx - 1]
+        for col in xrange(width):
+            s_idx = q_idx + min_diag + col
+            if s_idx < 1 or s_idx > len_s:
+                continue
+            if q_res == subject[s_idx - 1]:
+                diag_score = prev_h[col] + MATCH_SCORE
+            else:
+                diag_score = prev_h[col] + MISMATCH_SCORE
+            if col > 0:
+                open_ = row_h[col - 1] - gap_first
+                extend = row_e[col - 1] - GAP_EXTEND
+                row_back_e[col] = open_ >= extend
+                row_e[col] = open_ if open_ >= extend else extend
+            if col + 1 < width:
+                open_ = prev_h[col + 1] - gap_first
+                extend = prev_f[col + 1] - GAP_EXTEND
+                row_back_f[col] = open_ >= extend
+                row_f[col] = open_ if open_ >= extend else extend
+            score, back = 0, 0
+            if diag_score > score:
+                score, back = diag_score, 1
+            if row_e[col] > score:
+                score, back = row_e[col], 2
+            if row_f[col] > score:
+                score, back = row_f[col], 3
+            row_h[col] = score
+            row_back_h[col] = back
+            if score > best[0]:
+                best = score, q_idx, col
+        back_h[q_idx] = row_back_h
+        back_e[q_idx] = row_back_e
+        back_f[q_idx] = row_back_f
+        prev_h, prev_f = row_h, row_f
+
+    best_score, q_idx, col = best
+    if q_idx is None:
+        return None
+    q_end, s_end = q_idx - 1, q_idx + min_diag + col - 1
+    n_identical, length = 0, 0
+    matrix = 'h'
+    while True:
+        if matrix == 'h':
+            back = back_h[q_idx][col] if q_idx else 0
+            if back == 0:
+                break
+            elif back == 1:
+                s_idx = q_idx + min_diag + col
+                if query[q_idx - 1] == subject[s_idx - 1]:
+                    n_identical += 1
+                length += 1
+                q_idx -= 1
+            elif back == 2:
+                matrix = 'e'
+            else:
+                matrix = 'f'
+        elif matrix == 'e':
+            # a gap in the query, we move along the subject
+            if back_e[q_idx][col]:
+                matrix = 'h'
+            length += 1
+            col -= 1
+        else:
+            # a gap in the subject, we move along the query
+            if back_f[q_idx][col]:
+                matrix = 'h'
+            length += 1
+            q_idx -= 1
+            col += 1
+    q_start, s_start = q_idx, q_idx + min_diag + col
+    return best_score, q_start, q_end, s_start, s_end, n_identical, length
+
+
+def _cluster_diagonals(diags, band):
+    'It groups the diagonals that are closer than the band'
+    diags = sorted(diags)
+    cluster = [diags[0]]
+    for diag in diags[1:]:
+        if diag - cluster[-1] > band:
+            yield cluster[0], cluster[-1]
+            cluster = [diag]
+        else:
+            cluster.append(diag)
+    yield cluster[0], cluster[-1]
+
+
+class OligoMatcher(object):
+    '''It matches the given oligos against the given reads.
+
+    It is a replacement for BlasterForFewSubjects that does not use blast.
+    The reads act as the subjects and the oligos as the queries, so the
+    filters and the elongation are applied as in BlasterForFewSubjects.
+    The hits with an expect value above the given one are not reported.
+    '''
+    def __init__(self, seqs, oligos, filters=None, elongate_for_global=False,
+                 expect=10):
+        self.filters = filters
+        self.elongate_for_global = elongate_for_global
+        self.expect = expect
+        self._oligos = []
+        self._index = {}
+        for oligo in oligos:
+            self._add_oligo(oligo)
+        self._match_parts = self._look_for_matches(seqs)
+
+    def _add_oligo(self, oligo):
+        oligo_idx = len(self._oligos)
+        fwd_seq = get_str_seq(oligo).upper()
+        strands = fwd_seq, _reverse_complement(fwd_seq)
+        self._oligos.append((get_name(oligo), strands))
+        index = self._index
+        for strand, str_seq in enumerate(strands):
+            for pos in xrange(len(str_seq) - WORD_SIZE + 1):
+                word = str_seq[pos: pos + WORD_SIZE]
+                key = oligo_idx, strand
+                try:
+                    index[word].append((key, pos))
+                except KeyError:
+                    index[word] = [(key, pos)]
+
+    def _find_seeds(self, str_seq):
+        'It returns the diagonals with seeds for every oligo and strand'
+        index = self._index
+        diags = {}
+        for pos in xrange(len(str_seq) - WORD_SIZE + 1):
+            hits = index.get(str_seq[pos: pos + WORD_SIZE])
+            if hits is None:
+                continue
+            for key, oligo_pos in hits:
+                try:
+                    diags[key].add(pos - oligo_pos)
+                except KeyError:
+                    diags[key] = set([pos - oligo_pos])
+        return diags
+
+    def _align_read(self, str_seq):
+        'It yields the oligo index and the match part for every hit'
+        hits_by_oligo = {}
+        for (oligo_idx, strand), diags in self._find_seeds(str_seq).items():
+            oligo_seq = self._oligos[oligo_idx][1][strand]
+            for min_diag, max_diag in _cluster_diagonals(diags, _BAND):
+                if min_diag == max_diag:
+                    hit = _ungapped_local_alignment(oligo_seq, str_seq,
+                                                    min_diag)
+                else:
+                    hit = _banded_local_alignment(oligo_seq, str_seq,
+                                                  min_diag - _BAND,
+                                                  max_diag + _BAND)
+                if hit is not None and hit[0] >= _MIN_SCORE:
+                    hits = hits_by_oligo.setdefault(oligo_idx, [])
+                    hits.append(hit + (strand,))
+
+        for oligo_idx, hits in hits_by_oligo.items():
+            oligo_len = len(self._oligos[oligo_idx][1][0])
+            # As blast does, a hit contained in a better hit of the same
+            # strand, in the oligo and in the read, is not reported. The
+            # overlapping hits of the other strand, like the ones of a
+            # palindromic oligo, are kept.
+            hits.sort(reverse=True)
+            kept_hits = []
+            for hit in hits:
+                if any(hit[7] == kept[7] and
+                       kept[1] <= hit[1] and hit[2] <= kept[2] and
+                       kept[3] <= hit[3] and hit[4] <= kept[4]
+                       for kept in kept_hits):
+                    continue
+                kept_hits.append(hit)
+
+            for hit in kept_hits:
+                (score, q_start, q_end, s_start, s_end, n_ident, length,
+                 strand) = hit
+                if strand:
+                    # The oligo is reported in the forward strand and the
+                    # read reversed, as blast does
+                    q_start, q_end = (oligo_len - q_end - 1,
+                                      oligo_len - q_start - 1)
+                    s_start, s_end = s_end, s_start
+                match_part = MatchPart(query_start=q_start, query_end=q_end,
+                                       subject_start=s_start,
+                                       subject_end=s_end,
+                                       scores={'score': score,
+                                               'identity':
+                                                    n_ident / length * 100})
+                yield oligo_idx, match_part
+
+    def _calc_expect(self, score, oligo_len, db_len, n_reads):
+        'It calculates the expect value with a blast like length adjustment'
+        kmn = _K * oligo_len * db_len
+        adjustment = int(log(kmn) / _H) if kmn > 1 else 0
+        oligo_len = max(oligo_len - adjustment, 1 / _K)
+        db_len = max(db_len - n_reads * adjustment, 1)
+        return _K * oligo_len * db_len * exp(-_LAMBDA * score)
+
+    def _look_for_matches(self, seqs):
+        'It looks for the oligos in the given reads'
+        alignments = [{} for _ in self._oligos]
+        db_len, n_reads = 0, 0
+        for seq in seqs:
+            str_seq = get_str_seq(seq).upper()
+            db_len += len(str_seq)
+            read_idx = n_reads
+            n_reads += 1
+            for oligo_idx, match_part in self._align_read(str_seq):
+                try:
+                    match = alignments[oligo_idx][read_idx]
+                except KeyError:
+                    read = {'name': get_name(seq), 'length': len(str_seq)}
+                    match = {'subject': read, 'match_parts': []}
+                    alignments[oligo_idx][read_idx] = match
+                match['match_parts'].append(match_part)
+
+        results = []
+        for (oligo_name, strands), matches in zip(self._oligos, alignments):
+            oligo_len = len(strands[0])
+            filtered_matches = []
+            for match in matches.values():
+                match_parts = match['match_parts']
+                for match_part in match_parts:
+                    scores = match_part['scores']
+                    scores['expect'] = self._calc_expect(scores['score'],
+                                                         oligo_len, db_len,
+                                                         n_reads)
+                if self.expect is not None:
+                    match_parts = [m_p for m_p in match_parts
+                                   if m_p['scores']['expect'] <= self.expect]
+                if not match_parts:
+                    continue
+                match_parts.sort(key=lambda m_p: m_p['scores']['score'],
+                                 reverse=True)
+                match['match_parts'] = match_parts
+                best_expect = match_parts[0]['scores']['expect']
+                match['scores'] = {'expect': best_expect}
+                match['start'] = min(m_p['query_start'] for m_p in match_parts)
+                match['end'] = max(m_p['query_end'] for m_p in match_parts)
+                match['subject_start'] = min(min(m_p['subject_start'],
+                                                 m_p['subject_end'])
+                                             for m_p in match_parts)
+                match['subject_end'] = max(max(m_p['subject_start'],
+                                               m_p['subject_end'])
+                                           for m_p in match_parts)
+                filtered_matches.append(match)
+            if filtered_matches:
+                filtered_matches.sort(key=lambda m: m['scores']['expect'])
+                results.append({'query': {'name': oligo_name,
+                                          'length': oligo_len},
+                                'matches': filtered_matches})
+        if self.filters:
+            results = filter_alignments(results, config=self.filters)
+        elongate = self.elongate_for_global
+        return index_match_parts_by_subject(results,
+                                            elongate_for_global=elongate)
+
+    def get_matched_segments_for_read(self, read_name):
+        'It returns the matched segments for any oligo'
+        setting_key = 'DEFAULT_IGNORE_ELONGATION_SHORTER'
+        ignore_elongation_shorter = get_setting(setting_key)
+        try:
+            match_parts = self._match_parts[read_name]
+        except KeyError:
+            return None
+        return covered_segments_in_subject(match_parts,
+                                           ignore_elongation_shorter)
@@ -13,42 +13,124 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 import re
-from itertools import izip_longest, chain
+from itertools import izip_longest, izip, chain
 
 from toolz import first
 
 from crumbs.exceptions import (PairDirectionError, InterleaveError,
                                ItemsNotSortedError)
 from crumbs.seq.seqio import write_seqs
-from crumbs.seq.seq import get_title, get_name
-from crumbs.utils.tags import FWD, REV
+from crumbs.seq.seq import get_title, get_name, MatePacket
+from crumbs.utils.tags import FWD, REV, SEQITEM
 from crumbs.utils.file_utils import flush_fhand
 from crumbs.iterutils import sorted_items, group_in_packets_fill_last
 from crumbs.collectionz import KeyedSet
 
 
-def _parse_pair_direction_and_name(seq):
-    'It parses the description field to get the name and the pair direction'
-    return _parse_pair_direction_and_name_from_title(get_title(seq))
+_PAIR_REGEXES = [re.compile('(.+)[/|\\\\](\d+)'),
+                 re.compile('(.+)\s(\d+):.+'),
+                 re.compile('(.+)\.(\w)\s?')]
+_DIRECTIONS = {'1': FWD, 'f': FWD, '2': REV, 'r': REV}
+_SLASH_SEPARATORS = re.compile(r'[/|\\]')
+_WHITESPACE = re.compile(r'\s')
+_SLASH_SEPARATORS_OR_WHITESPACE = re.compile(r'[/|\\\s]')
 
 
-def _parse_pair_direction_and_name_from_title(title):
-    'It guesses the direction from the title line'
-    reg_exps = ['(.+)[/|\\\\](\d+)', '(.+)\s(\d+):.+', '(.+)\.(\w)\s?']
-    for reg_exp in reg_exps:
-        match = re.match(reg_exp, title)
+def _parse_slash_title(title):
+    'name/1, the name is everything before the last separator'
+    if len(title) > 2 and title[-2] in '/|\\' and title[-1] in '12':
+        return title[:-2], _DIRECTIONS[title[-1]]
+
+
+def _parse_illumina_title(title):
+    'name 1:N:0:ATCACG'
+    if _SLASH_SEPARATORS.search(title):
+        # the slash scheme would have precedence
+        return None
+    space_idx = title.rfind(' ')
+    if space_idx < 1:
+        return None
+    rest = title[space_idx + 1:]
+    direction, colon, tail = rest.partition(':')
+    if (direction in ('1', '2') and tail and
+            not _WHITESPACE.search(rest)):
+        return title[:space_idx], _DIRECTIONS[direction]
+
+
+def _parse_dot_title(title):
+    'name.f'
+    if (len(title) > 2 and title[-2] == '.' and title[-1] in 'f1r2' and
+            not _SLASH_SEPARATORS_OR_WHITESPACE.search(title)):
+        return title[:-2], _DIRECTIONS[title[-1]]
+
+
+def _no_scheme(title):
+    'No scheme has been detected yet'
+    return None
+
+
+# the specialised parsers for the schemes of _PAIR_REGEXES. They return
+# None for the titles that the regexes could parse differently
+_SCHEME_PARSERS = [_parse_slash_title, _parse_illumina_title,
+                   _parse_dot_title]
+
+
+def _parse_title_with_regexes(title):
+    'It returns the name, the direction and the matching naming scheme'
+    for scheme, reg_exp in enumerate(_PAIR_REGEXES):
+        match = reg_exp.match(title)
         if match:
             name, direction = match.groups()
-            if direction in ('1', 'f'):
-                direction = FWD
-            elif direction in ('2', 'r'):
-                direction = REV
-            else:
+            try:
+                direction = _DIRECTIONS[direction]
+            except KeyError:
                 raise PairDirectionError('unknown direction descriptor')
-            return name, direction
+            return name, direction, scheme
     raise PairDirectionError('Unable to detect the direction of the seq')
 
 
+class PairNameParser(object):
+    '''It parses the pair names and directions of a stream of reads.
+
+    The naming scheme (/1, 1:N:0 or .f) is detected from the first read.
+    The following reads are parsed by the string based parser of that
+    scheme, the regular expressions are only used for the reads that do
+    not follow it.
+    '''
+    def __init__(self):
+        self._parse_scheme = _no_scheme
+
+    def _parse_with_regexes(self, title):
+        name, direction, scheme = _parse_title_with_regexes(title)
+        self._parse_scheme = _SCHEME_PARSERS[scheme]
+        return name, direction
+
+    def parse_title(self, title):
+        parsed = self._parse_scheme(title)
+        return self._parse_with_regexes(title) if parsed is None else parsed
+
+    def __call__(self, seq):
+        if seq.kind == SEQITEM:
+            # the title is taken directly from the header line
+            title = seq.object.lines[0][1:].rstrip()
+        else:
+            title = get_title(seq)
+        return self.parse_title(title)
+
+
+_PAIR_NAME_PARSER = PairNameParser()
+
+
+def _parse_pair_direction_and_name(seq):
+    'It parses the description field to get the name and the pair direction'
+    return _PAIR_NAME_PARSER(seq)
+
+
+def _parse_pair_direction_and_name_from_title(title):
+    'It guesses the direction from the title line'
+    return _PAIR_NAME_PARSER.parse_title(title)
+
+
 def _get_paired_and_orphan(reads, ordered, max_reads_memory, temp_dir):
     if ordered:
         sorted_reads = reads
@@ -65,12 +147,13 @@ def match_pairs(reads, out_fhand, orphan_out_fhand, out_format, ordered=True,
     '''It matches the seq pairs in an iterator and splits the orphan seqs.'''
     counts = 0
     check_order_buffer = KeyedSet()
+    parse_pair_name = PairNameParser()
     for pair in _get_paired_and_orphan(reads, ordered, max_reads_memory,
                                        temp_dir):
         if len(pair) == 1:
             write_seqs(pair, orphan_out_fhand, out_format)
             try:
-                name = _parse_pair_direction_and_name(pair[0])[0]
+                name = parse_pair_name(pair[0])[0]
             except PairDirectionError:
                 name = get_name(pair[0])
             if ordered and counts < check_order_buffer_size:
@@ -88,13 +171,13 @@ def match_pairs(reads, out_fhand, orphan_out_fhand, out_format, ordered=True,
     flush_fhand(out_fhand)
 
 
-def _check_name_and_direction_match(*seqs):
+def _check_name_and_direction_match(seqs, parse_pair_name):
     'It fails if the names do not match or if the directions are equal'
     n_seqs = len(seqs)
     names = set()
     directions = set()
     for seq in seqs:
-        name, direction = _parse_pair_direction_and_name(seq)
+        name, direction = parse_pair_name(seq)
         names.add(name)
         directions.add(direction)
 
@@ -113,18 +196,72 @@ def interleave_pairs(seqs1, seqs2, skip_checks=False):
     It will fail if forward and reverse reads do not match in both sequence
     iterators.
     '''
+    parse_pair_name = PairNameParser()
     for seq1, seq2 in izip_longest(seqs1, seqs2, fillvalue=None):
         if not skip_checks:
             if seq1 is None or seq2 is None:
                 msg = 'The files had a different number of sequences'
                 raise InterleaveError(msg)
-            _check_name_and_direction_match(seq1, seq2)
+            _check_name_and_direction_match((seq1, seq2), parse_pair_name)
         if seq1 is not None:
             yield seq1
         if seq2 is not None:
             yield seq2
 
 
+def _check_mates(mates1, mates2, parse_pair_name):
+    'It fails if any pair of mates does not match'
+    for seq1, seq2 in izip(mates1, mates2):
+        name1, direction1 = parse_pair_name(seq1)
+        name2, direction2 = parse_pair_name(seq2)
+        if name1 != name2 or direction1 == direction2:
+            # it raises the error
+            _check_name_and_direction_match((seq1, seq2), parse_pair_name)
+
+
+def interleaved_to_mate_packets(seq_packets, skip_checks=False):
+    '''It yields MatePackets from packets of interleaved pairs.
+
+    Every read should be followed by its mate, a pair split between two
+    packets is moved to the next one.
+    '''
+    parse_pair_name = PairNameParser()
+    leftover = []
+    for packet in seq_packets:
+        if leftover:
+            packet = leftover + list(packet)
+        n_seqs = len(packet) - len(packet) % 2
+        leftover = list(packet[n_seqs:])
+        mates1 = list(packet[0:n_seqs:2])
+        mates2 = list(packet[1:n_seqs:2])
+        if not skip_checks:
+            _check_mates(mates1, mates2, parse_pair_name)
+        if mates1:
+            yield MatePacket(mates1, mates2)
+    if leftover:
+        msg = 'The last read has no mate: ' + get_name(leftover[0])
+        raise InterleaveError(msg)
+
+
+def two_streams_to_mate_packets(seq_packets1, seq_packets2,
+                                skip_checks=False):
+    '''It yields MatePackets from the packets of the forward and reverse reads.
+
+    Both streams should be read with the same packet size.
+    '''
+    parse_pair_name = PairNameParser()
+    for packet1, packet2 in izip_longest(seq_packets1, seq_packets2,
+                                         fillvalue=()):
+        if len(packet1) != len(packet2):
+            msg = 'The files had a different number of sequences'
+            raise InterleaveError(msg)
+        mates1 = list(packet1)
+        mates2 = list(packet2)
+        if not skip_checks:
+            _check_mates(mates1, mates2, parse_pair_name)
+        yield MatePacket(mates1, mates2)
+
+
 def deinterleave_pairs(seqs, out_fhand1, out_fhand2, out_format):
     '''It splits a sequence iterator with alternating paired reads in two.
 
@@ -141,9 +278,10 @@ def group_pairs_by_name(seqs, all_pairs_same_n_seqs=False):
     paired_seqs = []
     prev_name = None
     n_seqs_per_pair = None
+    parse_pair_name = PairNameParser()
     for seq in iter(seqs):
         try:
-            name = _parse_pair_direction_and_name(seq)[0]
+            name = parse_pair_name(seq)[0]
         except PairDirectionError:
             name = None
         if name is None or (paired_seqs and name != prev_name):
@@ -168,11 +306,11 @@ def group_pairs_by_name(seqs, all_pairs_same_n_seqs=False):
         yield paired_seqs
 
 
-def _get_first_pair_by_name(seqs):
+def _get_first_pair_by_name(seqs, parse_pair_name):
     paired_seqs = []
     prev_name = None
     for seq in iter(seqs):
-        name = _parse_pair_direction_and_name(seq)[0]
+        name = parse_pair_name(seq)[0]
         if prev_name is None:
             prev_name = name
         if name != prev_name:
@@ -186,8 +324,9 @@ def group_pairs(seqs, n_seqs_in_pair=None, check_all_same_n_seqs=True,
                 check_name_matches=True):
 
     seqs = iter(seqs)
+    parse_pair_name = PairNameParser()
     if n_seqs_in_pair is None:
-        first_pair, next_read = _get_first_pair_by_name(seqs)
+        first_pair, next_read = _get_first_pair_by_name(seqs, parse_pair_name)
         if first_pair is None:
             n_seqs_in_pair = None
         else:
@@ -209,5 +348,5 @@ def group_pairs(seqs, n_seqs_in_pair=None, check_all_same_n_seqs=True,
                 msg = 'The last pair has fewer reads'
                 raise InterleaveError(msg)
             if check_name_matches:
-                _check_name_and_direction_match(*pair)
+                _check_name_and_direction_match(pair, parse_pair_name)
             yield pair
@@ -0,0 +1,153 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+from crumbs.utils.tags import (SEQS_PASSED, SEQS_FILTERED_OUT, ORPHAN_SEQS,
+                               DIVERTED_SEQS)
+from crumbs.seq.filters import (FilterByLength, FilterByQuality,
+                                FilterDustComplexity, FilterAllNs)
+from crumbs.seq.trim import (TrimByQuality, TrimEdges, TrimLowercasedLetters,
+                             FusedTrimmer, is_read_trimmer)
+from crumbs.seq.seq import MatePacket
+from crumbs.settings import get_setting
+
+# pylint: disable=R0903
+
+FILTER = 'filter'
+TRIM = 'trim'
+
+_CRUMB_STEPS = {'trim_quality': (TRIM, TrimByQuality),
+                'trim_edges': (TRIM, TrimEdges),
+                'trim_by_case': (TRIM, TrimLowercasedLetters),
+                'filter_by_length': (FILTER, FilterByLength),
+                'filter_by_quality': (FILTER, FilterByQuality),
+                'filter_by_complexity': (FILTER, FilterDustComplexity),
+                'filter_all_ns': (FILTER, FilterAllNs)}
+
+_STEP_DEFAULTS = {'trim_quality': {
+                      'threshold': get_setting('DEFAULT_QUALITY_TRIM_TRESHOLD'),
+                      'window': get_setting('DEFAULT_QUALITY_TRIM_WINDOW')}}
+
+CRUMB_STEPS = sorted(_CRUMB_STEPS)
+
+
+def _parse_step_value(value):
+    'It converts a parameter value to bool, None, int or float if it can'
+    lower_value = value.lower()
+    if lower_value in ('true', 'false'):
+        return lower_value == 'true'
+    if lower_value == 'none':
+        return None
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_step(spec):
+    '''It returns the name and the parameters of a step spec.
+
+    The spec is the name of the crumb followed by its parameters, for
+    instance: filter_by_length:minimum=50,maximum=200
+    '''
+    name, _, params = spec.strip().partition(':')
+    if name not in _CRUMB_STEPS:
+        msg = 'Unknown crumb step: ' + name + '. Available steps: '
+        raise ValueError(msg + ', '.join(CRUMB_STEPS))
+    kwargs = dict(_STEP_DEFAULTS.get(name, {}))
+    for param in params.split(',') if params else []:
+        key, sep, value = param.partition('=')
+        if not sep:
+            raise ValueError('Malformed parameter in step %s: %s' % (name,
+                                                                     param))
+        kwargs[key.strip()] = _parse_step_value(value.strip())
+    return name, kwargs
+
+
+def build_step(name, kwargs):
+    'It returns the kind and the filter or trimmer for the given step'
+    kind, step_class = _CRUMB_STEPS[name]
+    try:
+        step = step_class(**kwargs)
+    except TypeError, error:
+        raise ValueError('Wrong parameters for step %s: %s' % (name, error))
+    return kind, step
+
+
+class CrumbPipeline(object):
+    '''It runs a chain of filters and trimmers over every packet.
+
+    The packet is parsed and serialized once for the whole chain, but the
+    result is the same as running every crumb in a shell pipeline. Every
+    trimmer is run with its own TrimOrMask, so it sees the seqs cut by the
+    previous steps.
+    The returned packets have the seqs passed and, for every step, the
+    seqs filtered out or made orphan by it.
+    The MatePackets are filtered and trimmed by changing the status of the
+    mates. For them the diverted seqs are given as the number of the step
+    that removed every mate, 0 for the kept ones.
+    '''
+    def __init__(self, steps, mask=False):
+        '''The initiator.
+
+        steps - a list of (kind, filter or trimmer) tuples
+        mask - If True the seqs will be masked instead of trimmed
+        '''
+        self._stages = []
+        for kind, step in steps:
+            if kind == TRIM:
+                if not is_read_trimmer(step):
+                    msg = 'Only the trimmers that work read by read can be '
+                    msg += 'used in a pipeline: ' + type(step).__name__
+                    raise ValueError(msg)
+                step = FusedTrimmer([step], mask=mask)
+            elif kind != FILTER:
+                raise ValueError('Unknown kind of step: ' + str(kind))
+            self._stages.append((kind, step))
+
+    def __call__(self, packet):
+        'It filters and trims the seqs'
+        if isinstance(packet, MatePacket):
+            return self._process_mate_packet(packet)
+        paired_seqs_list = packet[SEQS_PASSED]
+        diverted = []
+        for kind, stage in self._stages:
+            if kind == FILTER:
+                result = stage({SEQS_PASSED: paired_seqs_list,
+                                SEQS_FILTERED_OUT: []})
+                diverted.append([seq for paired_seqs in
+                                 result[SEQS_FILTERED_OUT]
+                                 for seq in paired_seqs])
+            else:
+                result = stage({SEQS_PASSED: paired_seqs_list,
+                                ORPHAN_SEQS: []})
+                diverted.append(result[ORPHAN_SEQS])
+            paired_seqs_list = result[SEQS_PASSED]
+        return {SEQS_PASSED: paired_seqs_list, DIVERTED_SEQS: diverted}
+
+    def _process_mate_packet(self, mate_packet):
+        'It filters and trims the mates and records the step that removes them'
+        removed_by = numpy.zeros(mate_packet.status.shape, dtype=numpy.int32)
+        for step_number, (kind, stage) in enumerate(self._stages, 1):
+            kept = mate_packet.kept
+            if kind == FILTER:
+                stage.filter_mates(mate_packet)
+            else:
+                stage.trim_mates(mate_packet)
+            removed_by[kept & ~mate_packet.kept] = step_number
+        return {SEQS_PASSED: mate_packet, DIVERTED_SEQS: removed_by}
@@ -0,0 +1,124 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+from itertools import chain
+
+from crumbs.iterutils import sample, group_in_packets
+from crumbs.exceptions import (NotIndexableError, SampleSizeError,
+                               InterleaveError, PairDirectionError)
+from crumbs.seq.seqio import read_seqs
+from crumbs.seq.pairs import (group_pairs_by_name,
+                              _parse_pair_direction_and_name)
+from crumbs.seq.utils.file_formats import get_format
+from crumbs.seq.utils.record_index import get_record_index
+
+
+def _check_pair(pair):
+    'It raises an InterleaveError if the seqs are not the mates of a pair'
+    try:
+        names = [_parse_pair_direction_and_name(seq)[0] for seq in pair]
+    except PairDirectionError:
+        names = None
+    if len(pair) != 2 or not names or names[0] != names[1]:
+        msg = 'The reads are not interleaved in pairs: '
+        msg += ', '.join(seq.object.name for seq in pair)
+        raise InterleaveError(msg)
+
+
+def _check_pairs(pairs):
+    for pair in pairs:
+        _check_pair(pair)
+        yield pair
+
+
+def _sample_with_reservoir(fhands, num_seqs, paired, in_disk):
+    seqs = read_seqs(fhands)
+    if paired:
+        # every pair goes through the check, also the ones not sampled
+        pairs = _check_pairs(group_pairs_by_name(seqs))
+        pairs = sample(pairs, num_seqs, in_disk=in_disk)
+        return chain.from_iterable(pairs)
+    return sample(seqs, num_seqs, in_disk=in_disk)
+
+
+def _choose_records(fhands, num_seqs, records_per_unit):
+    '''It returns the file, the index and the records sampled in every file.
+
+    A unit is a read or a pair of reads.
+    '''
+    indexes = []
+    num_units = 0
+    for fhand in fhands:
+        index = get_record_index(fhand, get_format(fhand))
+        if len(index) % records_per_unit:
+            msg = 'The reads are not interleaved in pairs, there is an '
+            msg += 'odd number of reads'
+            raise InterleaveError(msg)
+        indexes.append((fhand, index, num_units))
+        num_units += len(index) // records_per_unit
+    if num_units < num_seqs:
+        raise SampleSizeError('Sample larger than population')
+
+    sampled_units = sorted(random.sample(xrange(num_units), num_seqs))
+    chosen_records = []
+    for fhand, index, first_unit in indexes:
+        last_unit = first_unit + len(index) // records_per_unit
+        record_idxs = [(unit - first_unit) * records_per_unit
+                       for unit in sampled_units
+                       if first_unit <= unit < last_unit]
+        chosen_records.append((fhand, index, record_idxs))
+    return chosen_records
+
+
+def _read_records(chosen_records, records_per_unit):
+    for fhand, index, record_idxs in chosen_records:
+        seqs = index.read_records(fhand, record_idxs,
+                                  records_per_read=records_per_unit)
+        for seq in seqs:
+            yield seq
+
+
+def _sample_with_offsets(fhands, num_seqs, paired):
+    records_per_unit = 2 if paired else 1
+    chosen_records = _choose_records(fhands, num_seqs, records_per_unit)
+    if paired:
+        # the sampled pairs are checked before yielding any seq, so no
+        # partial sample is written
+        seqs = _read_records(chosen_records, records_per_unit)
+        for pair in group_in_packets(seqs, records_per_unit):
+            _check_pair(pair)
+    return _read_records(chosen_records, records_per_unit)
+
+
+def sample_seqs(fhands, num_seqs, paired=False, in_disk=False):
+    '''It returns a random sample of the seqs in the given files.
+
+    The fasta and fastq files that can be indexed are sampled by seeking
+    to the records chosen from their record index, the rest of the records
+    are not parsed. The other inputs, like pipes and gzip compressed files,
+    are read completely and sampled with a reservoir.
+    In paired mode the interleaved pairs are sampled together and num_seqs
+    is the number of pairs. An orphan read or two consecutive reads that
+    are not mates raise an InterleaveError before any seq is returned. With
+    the record index only the sampled pairs are read, so only they are
+    checked.
+    '''
+    if num_seqs <= 0:
+        raise SampleSizeError('No items to sample')
+    try:
+        return _sample_with_offsets(fhands, num_seqs, paired)
+    except NotIndexableError:
+        return _sample_with_reservoir(fhands, num_seqs, paired, in_disk)
@@ -16,10 +16,12 @@
 from copy import deepcopy
 from collections import namedtuple
 
+import numpy
+
 from crumbs.utils.optional_modules import SeqRecord
 from crumbs.utils.tags import (SEQITEM, SEQRECORD, ILLUMINA_QUALITY,
                                SANGER_QUALITY, SANGER_FASTQ_FORMATS,
-                               ILLUMINA_FASTQ_FORMATS)
+                               ILLUMINA_FASTQ_FORMATS, MATE_PASSED)
 
 # pylint: disable=C0111
 
@@ -37,6 +39,54 @@ class SeqItem(_SeqItem):
         return super(SeqItem, cls).__new__(cls, name, lines, annotations)
 
 
+class MatePacket(object):
+    '''A packet of pairs kept as two aligned lists of mates.
+
+    The first list has the forward mates and the second the reverse ones.
+    status is an array with one row per list and one column per pair.
+    Filters and trimmers change the status of the mates instead of moving
+    them to other lists. The seqs are only split at write time.
+    '''
+    def __init__(self, mates1, mates2, status=None):
+        '''The initiator.
+
+        mates1 and mates2 - lists of SeqWrappers, the mates of every pair
+        should be in the same position
+        status - the MATE_PASSED, MATE_FILTERED_OUT or MATE_LOST of every
+        mate, by default all mates are passed
+        '''
+        if len(mates1) != len(mates2):
+            raise ValueError('Both mate lists should have the same length')
+        self.mates = (mates1, mates2)
+        if status is None:
+            status = numpy.zeros((2, len(mates1)), dtype=numpy.uint8)
+        self.status = status
+
+    def __len__(self):
+        return len(self.mates[0])
+
+    def get_seqs(self, selected):
+        '''It returns the seqs selected by a (2, n_pairs) boolean array.
+
+        The seqs are returned in the pair order, forward mates first.
+        '''
+        mates = self.mates
+        positions = numpy.flatnonzero(selected.T.ravel())
+        return [mates[position & 1][position >> 1]
+                for position in positions.tolist()]
+
+    @property
+    def kept(self):
+        'It returns a boolean array with the mates not removed'
+        return self.status == MATE_PASSED
+
+    @property
+    def kept_pairs(self):
+        'It returns a boolean array with the pairs with both mates kept'
+        kept = self.kept
+        return kept[0] & kept[1]
+
+
 def get_title(seq):
     'Given a seq it returns the title'
     seq_class = seq.kind
@@ -282,14 +332,12 @@ def _slice_seqitem(seqwrap, start, stop):
     fmt = seqwrap.file_format
     seq_obj = seqwrap.object
     lines = seq_obj.lines
-    seq_str = get_str_seq(seqwrap)
-    seq_str = seq_str[start: stop] + '\n'
+    # the lines are sliced directly, the qualities are not recoded
+    seq_str = lines[1].strip()[start: stop] + '\n'
     if 'fasta' in fmt:
         lines = [lines[0], seq_str]
     elif 'fastq' in fmt:
-        qual_str = get_str_qualities(seqwrap)
-        qual_str = qual_str[start: stop]
-        qual_str += '\n'
+        qual_str = lines[3].rstrip()[start: stop] + '\n'
         lines = [lines[0], seq_str, '+\n', qual_str]
     else:
         raise ValueError('Unknown SeqItem type')
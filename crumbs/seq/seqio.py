@@ -14,16 +14,16 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 
-from itertools import chain, tee, ifilter
+from itertools import chain, ifilter, izip_longest
 from shutil import copyfileobj
 from tempfile import NamedTemporaryFile
 import cStringIO
 
 from crumbs.utils.optional_modules import (FastaIterator, QualPhredIterator,
-                                           PairedFastaQualIterator,
                                            FastqPhredIterator, write_seqrecs,
                                            FastqSolexaIterator,
                                            FastqIlluminaIterator,
+                                           FastqGeneralIterator,
                                            parse_into_seqrecs)
 from crumbs.seq.utils.data import (ambiguous_rna_letters,
                                    ambiguous_dna_letters,
@@ -32,14 +32,16 @@ from crumbs.exceptions import (MalformedFile, error_quality_disagree,
                                UnknownFormatError, IncompatibleFormatError,
                                FileIsEmptyError, IsSingleLineFastqError)
 from crumbs.iterutils import group_in_packets, group_in_packets_fill_last
-from crumbs.utils.file_utils import rel_symlink, flush_fhand
+from crumbs.utils.file_utils import rel_symlink, flush_fhand, AsyncWriter
 from crumbs.seq.utils.file_formats import get_format, peek_chunk_from_file
 
 from crumbs.utils.tags import (GUESS_FORMAT, SEQS_PASSED, SEQS_FILTERED_OUT,
-                               SEQITEM, SEQRECORD, ORPHAN_SEQS,
+                               SEQITEM, SEQRECORD, ORPHAN_SEQS, DIVERTED_SEQS,
+                               MATE_FILTERED_OUT, MATE_LOST,
                                SANGER_FASTQ_FORMATS, ILLUMINA_FASTQ_FORMATS)
 from crumbs.settings import get_setting
-from crumbs.seq.seq import SeqItem, get_str_seq, assing_kind_to_seqs
+from crumbs.seq.seq import (SeqItem, MatePacket, get_str_seq,
+                            assing_kind_to_seqs)
 
 # pylint: disable=C0111
 
@@ -79,37 +81,56 @@ def _write_seqrecord_packets(fhand, seq_packets, file_format='fastq',
         raise
 
 
-def write_seq_packets(fhand, seq_packets, file_format='fastq', workers=None):
-    'It writes to file a stream of seq lists'
+def _write_packet_buffers(writers, buffer_packets, workers=None):
+    '''It writes every stream of buffers with its own background writer.
+
+    buffer_packets yields a tuple with one buffer for every writer.
+    It returns the stats of the writers.
+    '''
+    writers = [AsyncWriter(fhand) for fhand in writers]
     try:
-        write_seqs(chain.from_iterable(seq_packets), fhand,
-                   file_format=file_format)
+        for buffers in buffer_packets:
+            for writer, buff in zip(writers, buffers):
+                writer.write(buff)
+        for writer in writers:
+            writer.close()
     except BaseException:
         if workers is not None:
             workers.terminate()
+        for writer in writers:
+            writer.abort()
         raise
+    return [writer.stats for writer in writers]
+
+
+def write_seq_packets(fhand, seq_packets, file_format='fastq', workers=None):
+    '''It writes to file a stream of seq lists.
+
+    The packets are written by a background thread, it returns the stats of
+    the writer.
+    '''
+    buffers = ((_serialize_seqs(packet, file_format),)
+               for packet in seq_packets)
+    return _write_packet_buffers([fhand], buffers, workers=workers)[0]
 
 
 def _write_filter_trim_packets(passed_fhand, diverted_fhand, packets,
                                file_format='fastq', workers=None,
                                seqs_diverted=SEQS_FILTERED_OUT):
-    'It writes the filter stream into passed and filtered out sequence files'
-
-    if diverted_fhand is None:
-        seq_packets = (p[SEQS_PASSED] for p in packets)
-        seqs = (s for pair in chain.from_iterable(seq_packets) for s in pair)
-        try:
-            return write_seqs(seqs, passed_fhand, file_format=file_format)
-        except BaseException:
-            if workers is not None:
-                workers.terminate()
-            raise
+    '''It writes the filter stream into passed and filtered out sequence files
 
+    Both streams are written concurrently by background threads, it returns
+    the stats of the writers.
+    '''
     flatten_pairs = lambda pairs: (seq for pair in pairs for seq in pair)
-    for packet in packets:
-        try:
-            write_seqs(flatten_pairs(packet[SEQS_PASSED]), fhand=passed_fhand,
-                       file_format=file_format)
+
+    def _serialize_packets():
+        for packet in packets:
+            passed = _serialize_seqs(flatten_pairs(packet[SEQS_PASSED]),
+                                     file_format)
+            if diverted_fhand is None:
+                yield (passed,)
+                continue
             # if diverted seqs are filtered aout they are a list of list
             # as not diverted seqs.
             # if they are orphan, they are a list of seqs
@@ -117,28 +138,89 @@ def _write_filter_trim_packets(passed_fhand, diverted_fhand, packets,
                 seqs = flatten_pairs(packet[seqs_diverted])
             else:
                 seqs = packet[seqs_diverted]
-            write_seqs(seqs, fhand=diverted_fhand, file_format=file_format)
+            yield passed, _serialize_seqs(seqs, file_format)
 
-        except BaseException:
-            if workers is not None:
-                workers.terminate()
-            raise
+    fhands = [passed_fhand]
+    if diverted_fhand is not None:
+        fhands.append(diverted_fhand)
+    stats = _write_packet_buffers(fhands, _serialize_packets(),
+                                  workers=workers)
+    return dict(zip([SEQS_PASSED, seqs_diverted], stats))
 
 
 def write_filter_packets(passed_fhand, filtered_fhand, filter_packets,
                          file_format='fastq', workers=None):
     'It writes the filter stream into passed and filtered out sequence files'
-    _write_filter_trim_packets(passed_fhand, filtered_fhand, filter_packets,
-                               file_format=file_format, workers=workers,
-                               seqs_diverted=SEQS_FILTERED_OUT)
+    return _write_filter_trim_packets(passed_fhand, filtered_fhand,
+                                      filter_packets, file_format=file_format,
+                                      workers=workers,
+                                      seqs_diverted=SEQS_FILTERED_OUT)
 
 
 def write_trim_packets(passed_fhand, orphan_fhand, trim_packets,
                        file_format='fastq', workers=None):
     'It writes the filter stream into passed and filtered out sequence files'
-    _write_filter_trim_packets(passed_fhand, orphan_fhand, trim_packets,
-                               file_format=file_format, workers=workers,
-                               seqs_diverted=ORPHAN_SEQS)
+    return _write_filter_trim_packets(passed_fhand, orphan_fhand, trim_packets,
+                                      file_format=file_format, workers=workers,
+                                      seqs_diverted=ORPHAN_SEQS)
+
+
+def _split_mate_packet(mate_packet, removed_by, step_numbers):
+    '''It returns the passed seqs and the seqs diverted by the given steps.
+
+    A step diverts the pairs that it filtered out and the mates of the seqs
+    that it trimmed away.
+    '''
+    status = mate_packet.status
+    kept = mate_packet.kept
+    passed = mate_packet.get_seqs(kept & kept[::-1])
+    filtered = status == MATE_FILTERED_OUT
+    orphans = kept & (status[::-1] == MATE_LOST)
+    mate_removed_by = removed_by[::-1]
+    diverted = []
+    for step_number in step_numbers:
+        selected = ((filtered & (removed_by == step_number)) |
+                    (orphans & (mate_removed_by == step_number)))
+        diverted.append(mate_packet.get_seqs(selected))
+    return passed, diverted
+
+
+def write_pipeline_packets(passed_fhand, diverted_fhands, packets,
+                           file_format='fastq', workers=None):
+    '''It writes the passed seqs and the seqs diverted by every step
+
+    diverted_fhands has one fhand per pipeline step, None for the steps
+    whose diverted seqs are not kept. It returns the stats of the writers.
+    The passed pairs of the MatePackets are written interleaved.
+    '''
+    kept_steps = [index for index, fhand in enumerate(diverted_fhands)
+                  if fhand is not None]
+    kept_step_numbers = [index + 1 for index in kept_steps]
+
+    def _serialize_packets():
+        for packet in packets:
+            passed = packet[SEQS_PASSED]
+            if isinstance(passed, MatePacket):
+                passed, diverted = _split_mate_packet(passed,
+                                                      packet[DIVERTED_SEQS],
+                                                      kept_step_numbers)
+            else:
+                passed = (seq for paired_seqs in passed
+                          for seq in paired_seqs)
+                diverted = [packet[DIVERTED_SEQS][index]
+                            for index in kept_steps]
+            buffers = [_serialize_seqs(passed, file_format)]
+            for seqs in diverted:
+                buffers.append(_serialize_seqs(seqs, file_format))
+            yield buffers
+
+    fhands = [passed_fhand] + [diverted_fhands[index] for index in kept_steps]
+    stats = _write_packet_buffers(fhands, _serialize_packets(),
+                                  workers=workers)
+    diverted_stats = [None] * len(diverted_fhands)
+    for index, stat in zip(kept_steps, stats[1:]):
+        diverted_stats[index] = stat
+    return {SEQS_PASSED: stats[0], DIVERTED_SEQS: diverted_stats}
 
 
 def title2ids(title):
@@ -194,6 +276,79 @@ def _read_seqrecords(fhands):
     return chain.from_iterable(seq_iters)
 
 
+def _build_qual_table(in_offset, out_offset, max_phred):
+    'It returns a 256 char table that recodes a quality string'
+    table = []
+    for code in range(256):
+        phred = min(max(code - in_offset, 0), max_phred)
+        table.append(chr(phred + out_offset))
+    return ''.join(table)
+
+
+_QUAL_TABLES = {(33, 64): _build_qual_table(33, 64, 62),
+                (64, 33): _build_qual_table(64, 33, 93)}
+_PHRED_TO_SANGER = [chr(phred + 33) for phred in range(94)]
+
+
+def _get_qual_offset(file_format):
+    'It returns the ASCII offset of the qualities of a fastq format'
+    if file_format in SANGER_FASTQ_FORMATS:
+        return 33
+    elif file_format in ILLUMINA_FASTQ_FORMATS:
+        return 64
+    return None
+
+
+def _get_qual_table(in_format, out_format):
+    'It returns the table to recode the qualities, None if not required'
+    in_offset = _get_qual_offset(in_format)
+    out_offset = _get_qual_offset(out_format)
+    if out_offset is None or in_offset == out_offset:
+        return None
+    return _QUAL_TABLES[in_offset, out_offset]
+
+
+def _can_transcode(in_format, out_format):
+    'It checks if the raw records can be recoded without using SeqRecords'
+    if _get_qual_offset(in_format) is None:
+        return in_format == 'fasta' and out_format == 'fasta'
+    return out_format == 'fasta' or _get_qual_offset(out_format) is not None
+
+
+def _recode_qual(qual, table, min_char):
+    'It recodes a quality string with the given translation table'
+    if qual and min(qual) < min_char:
+        raise ValueError('Invalid character in quality string')
+    return qual.translate(table)
+
+
+def _transcode_fastq(fhand, in_format, out_format):
+    'It yields the fastq records of the file recoded into the output format'
+    table = _get_qual_table(in_format, out_format)
+    min_char = chr(_get_qual_offset(in_format))
+    to_fasta = out_format == 'fasta'
+    for title, seq, qual in FastqGeneralIterator(fhand):
+        if to_fasta:
+            # as Biopython, the empty reads are written without a seq line
+            yield '>' + title + '\n' + (seq + '\n' if seq else '')
+        else:
+            if table is not None:
+                qual = _recode_qual(qual, table, min_char)
+            yield '@' + title + '\n' + seq + '\n+\n' + qual + '\n'
+
+
+def _transcode_seqs(in_fhands, in_formats, out_fhand, out_format):
+    'It writes the raw records of the files in the output format'
+    packet_size = get_setting('PACKET_SIZE')
+    for in_fhand, in_format in zip(in_fhands, in_formats):
+        if in_format == out_format:
+            copyfileobj(in_fhand, out_fhand)
+            continue
+        records = _transcode_fastq(in_fhand, in_format, out_format)
+        for packet in group_in_packets(records, packet_size):
+            out_fhand.write(''.join(packet))
+
+
 def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
     'It converts sequence files between formats'
     if out_format not in get_setting('SUPPORTED_OUTPUT_FORMATS'):
@@ -207,9 +362,13 @@ def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
         else:
             rel_symlink(in_fhands[0].name, out_fhand.name)
     else:
-        seqs = _read_seqrecords(in_fhands)
         try:
-            write_seqrecs(seqs, out_fhand, out_format)
+            if all(_can_transcode(in_format, out_format)
+                   for in_format in in_formats):
+                _transcode_seqs(in_fhands, in_formats, out_fhand, out_format)
+            else:
+                seqs = _read_seqrecords(in_fhands)
+                write_seqrecs(seqs, out_fhand, out_format)
         except ValueError, error:
             if error_quality_disagree(error):
                 raise MalformedFile(str(error))
@@ -220,11 +379,57 @@ def seqio(in_fhands, out_fhand, out_format, copy_if_same_format=True):
     flush_fhand(out_fhand)
 
 
+def _itemize_fasta_records(fhand):
+    'It yields the title and the body lines of every fasta or qual record'
+    title = None
+    lines = []
+    for line in fhand:
+        if line[0] == '>':
+            if title is not None:
+                yield title, lines
+            title = line[1:].rstrip()
+            lines = []
+        elif title is not None:
+            lines.append(line)
+    if title is not None:
+        yield title, lines
+
+
+def _fastaqual_to_fastq_records(seq_fhand, qual_fhand):
+    'It yields the fastq records made by pairing the fasta and qual records'
+    records = izip_longest(_itemize_fasta_records(seq_fhand),
+                           _itemize_fasta_records(qual_fhand))
+    for seq_record, qual_record in records:
+        if qual_record is None:
+            raise ValueError('FASTA file has more entries than the QUAL file.')
+        if seq_record is None:
+            raise ValueError('QUAL file has more entries than the FASTA file.')
+        title, seq_lines = seq_record
+        qual_title, qual_lines = qual_record
+        name = title.split(None, 1)[0] if title else ''
+        qual_name = qual_title.split(None, 1)[0] if qual_title else ''
+        if name != qual_name:
+            msg = 'FASTA and QUAL entries do not match (%s vs %s).'
+            raise ValueError(msg % (name, qual_name))
+        seq = ''.join(seq_lines).replace(' ', '').replace('\r', '')
+        seq = seq.replace('\n', '')
+        quals = ''.join(qual_lines).split()
+        if len(seq) != len(quals):
+            msg = 'Sequence length and number of quality scores disagree for '
+            raise ValueError(msg + name)
+        # as Biopython, the scores are clamped to the 0-93 sanger range
+        qual = ''.join([_PHRED_TO_SANGER[max(min(int(phred), 93), 0)]
+                        for phred in quals])
+        yield '@' + title + '\n' + seq + '\n+\n' + qual + '\n'
+
+
 def fastaqual_to_fasta(seq_fhand, qual_fhand, out_fhand):
     'It converts a fasta and a qual file into a fastq format file'
-    seqrecords = PairedFastaQualIterator(seq_fhand, qual_fhand)
+    records = _fastaqual_to_fastq_records(seq_fhand, qual_fhand)
+    packet_size = get_setting('PACKET_SIZE')
     try:
-        write_seqrecs(seqrecords, out_fhand.name, 'fastq')
+        for packet in group_in_packets(records, packet_size):
+            out_fhand.write(''.join(packet))
     except ValueError, error:
         if error_quality_disagree(error):
             raise MalformedFile(str(error))
@@ -373,52 +578,72 @@ def _read_seqitems(fhands):
     return chain.from_iterable(seq_iters)
 
 
-def _write_seqitems(items, fhand, file_format):
-    'It writes one seq item (tuple of name and string)'
-    for seq in items:
+def _seqitems_to_str(seqs, file_format):
+    'It returns the lines of the given seq items joined'
+    lines = []
+    for seq in seqs:
         seqitems_fmt = seq.file_format
-        if file_format and 'fastq' in seqitems_fmt and 'fasta' in file_format:
+        if not file_format or seqitems_fmt == file_format:
+            lines.extend(seq.object.lines)
+        elif 'fastq' in seqitems_fmt and 'fasta' in file_format:
             seq_lines = seq.object.lines
-            try:
-                fhand.write('>' + seq_lines[0][1:] + seq_lines[1])
-            except IOError, error:
-                # The pipe could be already closed
-                if not 'Broken pipe' in str(error):
-                    raise
-        elif file_format and seqitems_fmt != file_format:
+            lines.append('>' + seq_lines[0][1:])
+            lines.append(seq_lines[1])
+        elif _can_transcode(seqitems_fmt, file_format):
+            seq_lines = seq.object.lines
+            table = _get_qual_table(seqitems_fmt, file_format)
+            if table is not None:
+                min_char = chr(_get_qual_offset(seqitems_fmt))
+                qual = _recode_qual(seq_lines[3].rstrip(), table, min_char)
+                seq_lines = seq_lines[:3] + [qual + '\n']
+            lines.extend(seq_lines)
+        else:
             msg = 'Input and output file formats do not match, you should not '
             msg += 'use SeqItems: ' + str(seq.file_format) + ' '
             msg += str(file_format)
             raise RuntimeError(msg)
-        else:
-            try:
-                fhand.write(''.join(seq.object.lines))
-            except IOError, error:
-                # The pipe could be already closed
-                if not 'Broken pipe' in str(error):
-                    raise
+    return ''.join(lines)
 
 
-def write_seqs(seqs, fhand=None, file_format=None):
-    'It writes the given sequences'
-    if fhand is None:
-        fhand = NamedTemporaryFile(suffix='.' + file_format.replace('-', '_'))
+def _seqrecords_to_str(seqs, file_format):
+    fhand = cStringIO.StringIO()
+    write_seqrecs(_clean_seqrecord_stream(seqs), fhand, file_format)
+    return fhand.getvalue()
 
-    seqs, seqs2 = tee(seqs)
+
+def _serialize_seqs(seqs, file_format):
+    'It returns the given seqs formatted in one contiguous string'
+    seqs = iter(seqs)
     try:
-        seq = seqs2.next()
+        seq = seqs.next()
     except StopIteration:
-        # No sequences to write, so we're done
-        return fhand
-    del seqs2
+        return ''
+    seqs = chain([seq], seqs)
     seq_class = seq.kind
     if seq_class == SEQITEM:
-        _write_seqitems(seqs, fhand, file_format)
+        return _seqitems_to_str(seqs, file_format)
     elif seq_class == SEQRECORD:
-        seqs = (seq.object for seq in seqs)
-        _write_seqrecords(seqs, fhand, file_format)
+        return _seqrecords_to_str((seq.object for seq in seqs), file_format)
     else:
         raise ValueError('Unknown class for seq: ' + seq_class)
+
+
+def write_seqs(seqs, fhand=None, file_format=None):
+    '''It writes the given sequences
+
+    The sequences are written in packets, one string per packet.
+    '''
+    if fhand is None:
+        fhand = NamedTemporaryFile(suffix='.' + file_format.replace('-', '_'))
+
+    packet_size = get_setting('PACKET_SIZE')
+    try:
+        for packet in group_in_packets(seqs, packet_size):
+            fhand.write(_serialize_seqs(packet, file_format))
+    except IOError, error:
+        # The pipe could be already closed
+        if not 'Broken pipe' in str(error):
+            raise
     return fhand
 
 
@@ -431,10 +656,11 @@ def read_seqs(fhands, out_format=None, prefered_seq_classes=None):
         in_format = get_format(fhands[0])
     except FileIsEmptyError:
         return []
-    # seqitems is incompatible with different input and output formats
-    # or when in_format != a fasta or fastq
+    # seqitems is incompatible with input and output formats that can not be
+    # transcoded or when in_format != a fasta or fastq
     if ((out_format not in (None, GUESS_FORMAT) and in_format != out_format
-         and SEQITEM in prefered_seq_classes) or
+         and SEQITEM in prefered_seq_classes and
+         not _can_transcode(in_format, out_format)) or
         (in_format not in ('fasta',) + SANGER_FASTQ_FORMATS +
          ILLUMINA_FASTQ_FORMATS)):
         prefered_seq_classes.pop(prefered_seq_classes.index(SEQITEM))
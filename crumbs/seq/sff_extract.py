@@ -14,12 +14,174 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
-from array import array
+import struct
+
+import numpy
 
 from crumbs.utils.optional_modules import SffIterator
+from crumbs.seq.seq import SeqItem, SeqWrapper, get_name, get_length
+from crumbs.utils.tags import SEQITEM
 
 # pylint: disable=R0913
 
+_SFF_MAGIC = '.sff'
+_SFF_HEADER_FMT = '>4s4BQIIHHHB'
+_SFF_HEADER_SIZE = struct.calcsize(_SFF_HEADER_FMT)
+_READ_HEADER_FMT = '>2HI4H'
+_READ_HEADER_SIZE = struct.calcsize(_READ_HEADER_FMT)
+_PHRED_TO_SANGER = ''.join(chr(min(qual + 33, 126)) for qual in range(256))
+_COUNT_BLOCK_SIZE = 10000
+
+
+def _padded(length):
+    'The SFF sections are padded to 8 bytes'
+    return length + (-length % 8)
+
+
+def _read_sff_header(fhand):
+    'It reads the common header and it leaves the fhand at the first read'
+    data = fhand.read(_SFF_HEADER_SIZE)
+    if not data:
+        raise ValueError('Empty file.')
+    elif len(data) < _SFF_HEADER_SIZE:
+        raise ValueError('File too small to hold a valid SFF header.')
+    (magic_number, ver0, ver1, ver2, ver3, index_offset, index_length,
+     number_of_reads, header_length, key_length, number_of_flows,
+     flowgram_format) = struct.unpack(_SFF_HEADER_FMT, data)
+    if magic_number != _SFF_MAGIC:
+        msg = "SFF file did not start '.sff', but %s" % repr(magic_number)
+        raise ValueError(msg)
+    if (ver0, ver1, ver2, ver3) != (0, 0, 0, 1):
+        msg = 'Unsupported SFF version in header, %i.%i.%i.%i'
+        raise ValueError(msg % (ver0, ver1, ver2, ver3))
+    if flowgram_format != 1:
+        msg = 'Flowgram format code %i not supported' % flowgram_format
+        raise ValueError(msg)
+    fhand.read(header_length - _SFF_HEADER_SIZE)
+    return (header_length, index_offset, index_length, number_of_reads,
+            number_of_flows)
+
+
+def _read_sff_reads(fhand):
+    '''It yields the name, bases, sanger qualities and clips of every read.
+
+    The read headers and the bases are unpacked from the binary records,
+    the flowgrams are skipped. The left clips are in python counting, like
+    the Biopython ones.
+    '''
+    (offset, index_offset, index_length, number_of_reads,
+     number_of_flows) = _read_sff_header(fhand)
+    flows_size = number_of_flows * 2
+    for _ in xrange(number_of_reads):
+        if index_offset and offset == index_offset:
+            # the index block can be in between the reads
+            index_end = _padded(index_offset + index_length)
+            fhand.read(index_end - offset)
+            offset = index_end
+            index_offset = 0
+        header = fhand.read(_READ_HEADER_SIZE)
+        if len(header) < _READ_HEADER_SIZE:
+            raise ValueError('The SFF file is truncated')
+        (read_header_length, name_length, seq_len, clip_qual_left,
+         clip_qual_right, clip_adapter_left,
+         clip_adapter_right) = struct.unpack(_READ_HEADER_FMT, header)
+        if read_header_length < 10 or read_header_length % 8 != 0:
+            msg = 'Malformed read header, says length is %i'
+            raise ValueError(msg % read_header_length)
+        size = (read_header_length - _READ_HEADER_SIZE +
+                _padded(flows_size + seq_len * 3))
+        record = fhand.read(size)
+        if len(record) < size:
+            raise ValueError('The SFF file is truncated')
+        offset += _READ_HEADER_SIZE + size
+
+        name = record[:name_length]
+        bases_start = read_header_length - _READ_HEADER_SIZE + flows_size
+        bases_start += seq_len   # the flow index
+        quals_start = bases_start + seq_len
+        bases = record[bases_start:quals_start]
+        quals = record[quals_start:quals_start + seq_len]
+        clips = (clip_qual_left - 1 if clip_qual_left else 0, clip_qual_right,
+                 clip_adapter_left - 1 if clip_adapter_left else 0,
+                 clip_adapter_right)
+        yield name, bases, quals.translate(_PHRED_TO_SANGER), clips
+
+
+def _sff_read_to_seqitem(sff_read, trim, min_left_clip):
+    '''It returns a fastq SeqItem equal to the SeqRecord that we would get
+    from SffIterator and _min_left_clipped_seqs'''
+    name, bases, quals, clips = sff_read
+    (clip_qual_left, clip_qual_right, clip_adapter_left,
+     clip_adapter_right) = clips
+    # the Biopython clipping, the most aggressive of qual and adapter
+    clip_left = max(clip_qual_left, clip_adapter_left)
+    if clip_qual_right and clip_adapter_right:
+        clip_right = min(clip_qual_right, clip_adapter_right)
+    else:
+        clip_right = clip_qual_right or clip_adapter_right or len(bases)
+
+    if clip_left >= clip_right:
+        mixed_case = bases.lower()
+    else:
+        mixed_case = (bases[:clip_left].lower() +
+                      bases[clip_left:clip_right].upper() +
+                      bases[clip_right:].lower())
+    annotations = {}
+    if min_left_clip:
+        clip = max(min_left_clip, clip_qual_left, clip_adapter_left)
+        if trim:
+            seq = mixed_case[clip:]
+            quals = quals[clip:]
+        else:
+            seq = bases[:clip].lower() + bases[clip:].upper()
+            clips = (clip, clip_qual_right, clip, clip_adapter_right)
+    elif trim:
+        if clip_left >= clip_right:
+            seq, quals = '', ''
+        else:
+            seq = bases[clip_left:clip_right].upper()
+            quals = quals[clip_left:clip_right]
+    else:
+        seq = mixed_case
+    if not trim:
+        annotations = dict(zip(('clip_qual_left', 'clip_qual_right',
+                                'clip_adapter_left', 'clip_adapter_right'),
+                               clips))
+    lines = ['@' + name + '\n', seq + '\n', '+\n', quals + '\n']
+    return SeqWrapper(SEQITEM, SeqItem(name, lines, annotations), 'fastq')
+
+
+class _NuclCounter(object):
+    '''It counts the nucleotides found in the first positions of the reads.
+
+    The reads are counted in blocks, every block is a 2D array with a row
+    per read.
+    '''
+    def __init__(self, num_positions):
+        self.num_positions = num_positions
+        self.counts = {nucl: numpy.zeros(num_positions, dtype=numpy.int64)
+                       for nucl in 'ATCG'}
+        self._block = []
+
+    def add(self, seq):
+        'It adds the first nucleotides of the given seq (as a string)'
+        num_positions = self.num_positions
+        self._block.append(seq[:num_positions].ljust(num_positions, '\0'))
+        if len(self._block) >= _COUNT_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        'It counts the pending reads'
+        if not self._block or not self.num_positions:
+            self._block = []
+            return
+        block = numpy.frombuffer(''.join(self._block), dtype=numpy.uint8)
+        block = block.reshape(-1, self.num_positions)
+        for nucl, counts in self.counts.items():
+            # we do not count the lowercase letters
+            counts += (block == ord(nucl)).sum(axis=0)
+        self._block = []
+
 
 def _min_left_clipped_seqs(sff_fhand, trim, min_left_clip):
     'It generates sequences (as tuples) given a path to a SFF file.'
@@ -45,7 +207,11 @@ def _min_left_clipped_seqs(sff_fhand, trim, min_left_clip):
 
 
 class SffExtractor(object):
-    'This class extracts the reads from an SFF file'
+    '''This class extracts the reads from an SFF file
+
+    seqs yields Biopython SeqRecords, seq_items parses the SFF records
+    directly and yields fastq SeqItems.
+    '''
     def __init__(self, sff_fhands, trim=False, min_left_clip=0,
                  nucls_to_check=50, max_nucl_freq_threshold=0.5):
         'It inits the class'
@@ -57,43 +223,49 @@ class SffExtractor(object):
         self.nucls_to_check = nucls_to_check
         self.max_nucl_freq_threshold = max_nucl_freq_threshold
         self.nucl_counts = {}
+        self._nucl_counters = {}
 
     @property
     def seqs(self):
         'It yields all sequences'
         for fhand in self.fhands:
-            self._prepare_nucl_counts(fhand.name)
+            counter = self._prepare_nucl_counts(fhand.name)
             if not self.min_left_clip:
                 seqs = SffIterator(fhand, trim=self.trim)
             else:
                 seqs = _min_left_clipped_seqs(fhand, self.trim,
                                               self.min_left_clip)
             for record in seqs:
-                self._update_nucl_counts(str(record.seq), fhand.name)
+                counter.add(str(record.seq))
                 yield record
+            counter.flush()
+
+    @property
+    def seq_items(self):
+        'It yields all sequences as fastq SeqItems'
+        trim = self.trim
+        min_left_clip = self.min_left_clip
+        for fhand in self.fhands:
+            counter = self._prepare_nucl_counts(fhand.name)
+            for sff_read in _read_sff_reads(fhand):
+                seq = _sff_read_to_seqitem(sff_read, trim, min_left_clip)
+                counter.add(seq.object.lines[1])
+                yield seq
+            counter.flush()
 
     def _prepare_nucl_counts(self, fpath):
         'It prepares the structure to store the nucleotide counts'
-        counts = {'A': array('L', [0] * self.nucls_to_check),
-                  'T': array('L', [0] * self.nucls_to_check),
-                  'C': array('L', [0] * self.nucls_to_check),
-                  'G': array('L', [0] * self.nucls_to_check)}
-        self.nucl_counts[fpath] = counts
-
-    def _update_nucl_counts(self, seq, fpath):
-        'Given a seq (as a string) it updates the nucleotide counts'
-        seq = seq[:self.nucls_to_check]
-        counts = self.nucl_counts
-        for index, nucl in enumerate(seq):
-            try:
-                counts[fpath][nucl][index] += 1
-            except KeyError:
-                pass  # we do not count the lowercase letters
+        counter = _NuclCounter(self.nucls_to_check)
+        self._nucl_counters[fpath] = counter
+        self.nucl_counts[fpath] = counter.counts
+        return counter
 
     @property
     def clip_advice(self):
         'It checks how many positions have a high max nucl freq.'
         advices = {}
+        for counter in self._nucl_counters.values():
+            counter.flush()
         for fhand in self.fhands:
             fpath = fhand.name
             counts = self.nucl_counts[fpath]
@@ -129,12 +301,9 @@ class SffExtractor(object):
 
 
 def _do_seq_xml(seq):
-    seq = seq.object
-    annots = seq.annotations
-    read_len = len(seq)
-    read_name = seq.id
-    if 'E3MFGYR02FTGED' == read_name:
-        print annots, read_len
+    annots = seq.object.annotations
+    read_len = get_length(seq)
+    read_name = get_name(seq)
     qual_left = annots.get('clip_qual_left', 0)
     qual_right = annots.get('clip_qual_right', 0)
     vector_left = annots.get('clip_adapter_left', 0)
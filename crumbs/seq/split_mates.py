@@ -15,10 +15,9 @@
 
 # similar software SffToCA
 
-from crumbs.blast import BlasterForFewSubjects
-from crumbs.seq.seqio import write_seqs
+from crumbs.seq.oligo_matcher import OligoMatcher
 from crumbs.settings import get_setting
-from crumbs.utils.tags import NUCL, SEQITEM
+from crumbs.utils.tags import SEQITEM
 from crumbs.seq.seq import (assing_kind_to_seqs, get_name, slice_seq, get_length,
                             copy_seq, SeqItem)
 
@@ -32,15 +31,13 @@ class MatePairSplitter(object):
         'The initiator'
         if linkers is None:
             linkers = get_setting('LINKERS')
-            linkers = [SeqItem(str(i), '>%d\n%s\n' % (i, l)) for i, l in enumerate(linkers)]
+            linkers = [SeqItem(str(i), ['>%d\n' % i, l + '\n'])
+                                                for i, l in enumerate(linkers)]
             linkers = assing_kind_to_seqs(SEQITEM, linkers, 'fasta')
         self.linkers = list(linkers)
 
     def __call__(self, seqs):
         'It splits a list of sequences with the provided linkers'
-        seq_fhand = write_seqs(seqs, file_format='fasta')
-        seq_fhand.flush()
-
         min_identity = 87.0
         min_len = 13
         filters = [{'kind': 'min_length', 'min_num_residues': min_len,
@@ -48,11 +45,9 @@ class MatePairSplitter(object):
                    {'kind': 'score_threshold', 'score_key': 'identity',
                    'min_score': min_identity}]
 
-        matcher = BlasterForFewSubjects(seq_fhand.name, self.linkers,
-                                        program='blastn', filters=filters,
-                                        params={'task': 'blastn-short'},
-                                        elongate_for_global=True,
-                                        seqs_type=NUCL)
+        # 0.001 is the expect used by blast when it was run for the linkers
+        matcher = OligoMatcher(seqs, self.linkers, filters=filters,
+                               expect=0.001, elongate_for_global=True)
         new_seqs = []
         for seq in seqs:
             segments = matcher.get_matched_segments_for_read(get_name(seq))
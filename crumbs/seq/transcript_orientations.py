@@ -15,27 +15,56 @@
 
 from itertools import compress
 import os.path
+import hashlib
+import sqlite3
 
-from crumbs.seq.annotation import (PolyaAnnotator, EstscanOrfAnnotator,
-                                   BlastAnnotator)
+from crumbs.seq.annotation import (EstscanOrfAnnotator, BlastAnnotator,
+                                   get_polya_tails)
 from crumbs.seq.utils.seq_utils import append_to_description
 from crumbs.utils.tags import SEQRECORD
-from crumbs.seq.seq import SeqWrapper
+from crumbs.seq.seq import SeqWrapper, get_str_seq
+from crumbs.blast import _get_blastdb_key
+from crumbs.utils.index_cache import hash_file
+from crumbs.utils.sqlite_utils import open_sqlite_cache
+from crumbs.settings import get_setting
 
 
 class TranscriptOrientator(object):
     '''This class orientates the transcripts
 
-    It can take into account: poly-A, ORFs and blast matches'''
+    It can take into account: poly-A, ORFs and blast matches.
+    The ESTScan and blast annotations are kept in a persistent cache, so the
+    transcripts already annotated are not analyzed again.'''
 
     def __init__(self, polya_params=None, estscan_params=None,
-                 blast_params=None):
+                 blast_params=None, cache_fpath=None):
         self._polya_params = polya_params
         self._estscan_params = estscan_params
         self._blast_params = blast_params
+        if cache_fpath is None:
+            cache_fpath = get_setting('TRANSCRIPT_ANNOTATIONS_CACHE')
+        self._cache_fpath = cache_fpath
+        self._cache = None
+        self._cache_pid = None
 
         self._annotators = self._create_pipeline()
 
+    def __getstate__(self):
+        # the cache connection can not be shared with other processes
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        state['_cache_pid'] = None
+        return state
+
+    def _get_cache(self):
+        'It returns the annotation cache for this process'
+        if not self._cache_fpath:
+            return None
+        if self._cache_pid != os.getpid():
+            self._cache = open_sqlite_cache(self._cache_fpath)
+            self._cache_pid = os.getpid()
+        return self._cache
+
     def _create_pipeline(self):
         'It creates the annotation pipeline'
         # pylint: disable=W0142
@@ -55,13 +84,6 @@ class TranscriptOrientator(object):
         'it selects features by type'
         return [feat for feat in features if feat.type == kind]
 
-    def _polya_selector(self, features):
-        'It selects the polya'
-        # pylint: disable=W0613
-        feats = self._select_features_by_type(features, 'polyA_sequence')
-        if feats:
-            return feats[0]
-
     def _orf_selector(self, features):
         'it returns the longest feature'
         # pylint: disable=W0613
@@ -85,11 +107,15 @@ class TranscriptOrientator(object):
 
     def _guess_orientations(self, seqs, annotator_name, blastdb):
         '''It returns the orientation of the annotated transcripts.'''
+        if annotator_name == 'polyA':
+            # the poly-A tails are not annotated as features
+            tails = get_polya_tails([get_str_seq(seq) for seq in seqs],
+                                    **self._polya_params)
+            return [None if tail is None else tail[2] for tail in tails]
+
         orientations = []
         for seq in seqs:
-            if annotator_name == 'polyA':
-                feature = self._polya_selector(seq.object.features)
-            elif annotator_name == 'estscan_orf':
+            if annotator_name == 'estscan_orf':
                 feature = self._orf_selector(seq.object.features)
             elif  annotator_name == 'blast':
                 feature = self._match_part_selector(seq.object.features,
@@ -103,21 +129,85 @@ class TranscriptOrientator(object):
 
     def _get_annotator(self, annotator_name, blastdb):
         'It prepares and returns the annotator'
-        if annotator_name == 'polyA':
-            annotator = PolyaAnnotator(**self._polya_params)
-        elif annotator_name == 'estscan_orf':
+        if annotator_name == 'estscan_orf':
             annotator = EstscanOrfAnnotator(**self._estscan_params)
         elif annotator_name == 'blast':
-            blast_param = None
-            for blast_param_ in self._blast_params:
-                if blastdb == blast_param_['blastdb']:
-                    blast_param = blast_param_
-                    break
-            annotator = BlastAnnotator(**blast_param)
+            annotator = BlastAnnotator(**self._get_blast_param(blastdb))
         else:
             raise NotImplementedError('This annotator type not supported')
         return annotator
 
+    def _get_blast_param(self, blastdb):
+        'It returns the parameters for the given blast database'
+        for blast_param in self._blast_params:
+            if blastdb == blast_param['blastdb']:
+                return blast_param
+
+    def _get_annotator_key(self, annotator_name, blastdb):
+        '''It returns a key for the annotator, its parameters and database.
+
+        It returns None if the annotations can not be cached.
+        '''
+        if annotator_name == 'estscan_orf':
+            matrix_fpath = self._estscan_params['usage_matrix']
+            key = [annotator_name, hash_file(matrix_fpath)]
+        elif annotator_name == 'blast':
+            blast_param = self._get_blast_param(blastdb)
+            if blast_param.get('remote'):
+                return None
+            if os.path.isfile(blastdb):
+                db_key = hash_file(blastdb)
+            else:
+                db_key = _get_blastdb_key(blastdb)
+            key = [annotator_name, os.path.basename(blastdb), db_key,
+                   repr(sorted((param, repr(value))
+                               for param, value in blast_param.viewitems()
+                               if param != 'blastdb'))]
+        else:
+            return None
+        return '\t'.join(key)
+
+    def _annotate(self, annotator_name, blastdb, seqs):
+        '''It annotates the seqs.
+
+        The cached annotations are used and only the rest of the seqs are
+        annotated.
+        '''
+        cache = self._get_cache()
+        annotator_key = None
+        if cache is not None:
+            annotator_key = self._get_annotator_key(annotator_name, blastdb)
+        if annotator_key is None:
+            annotator = self._get_annotator(annotator_name, blastdb)
+            return annotator(seqs)
+
+        keys = [hashlib.sha1(annotator_key + '\t' +
+                             get_str_seq(seq)).hexdigest() for seq in seqs]
+        try:
+            cached_feats = cache.get_many(set(keys))
+        except sqlite3.Error:
+            cached_feats = {}
+
+        to_annotate = [(seq, key) for seq, key in zip(seqs, keys)
+                                                    if key not in cached_feats]
+        if to_annotate:
+            n_feats = [len(seq.object.features) for seq, _ in to_annotate]
+            annotator = self._get_annotator(annotator_name, blastdb)
+            annotator([seq for seq, _ in to_annotate])
+            # the features added by the annotator are cached
+            new_feats = [(key, seq.object.features[n_feat:])
+                         for (seq, key), n_feat in zip(to_annotate, n_feats)]
+            try:
+                cache.update(new_feats)
+            except sqlite3.Error:
+                # other process could be writing the cache
+                pass
+
+        for seq, key in zip(seqs, keys):
+            if key in cached_feats:
+                seq.object.features.extend(cached_feats[key])
+        return seqs
+
     def __call__(self, seqs):
         'It orientates seqs, that should have a SeqRecord in it'
         orientations = None
@@ -133,9 +223,12 @@ class TranscriptOrientator(object):
 
             annotator_name = annotator['name']
             blastdb = annotator.get('blastdb', None)
-            annotator = self._get_annotator(annotator_name, blastdb)
-
-            annot_seqrecords = annotator(seqs_to_analyze)
+            if annotator_name == 'polyA':
+                # the orientation is taken directly from the poly-A tails
+                annot_seqrecords = seqs_to_analyze
+            else:
+                annot_seqrecords = self._annotate(annotator_name, blastdb,
+                                                  seqs_to_analyze)
             annot_strands = self._guess_orientations(annot_seqrecords,
                                                      annotator_name,
                                                      blastdb=blastdb)
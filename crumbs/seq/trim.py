@@ -15,23 +15,24 @@
 
 from operator import itemgetter
 from tempfile import NamedTemporaryFile
+from subprocess import PIPE
 
+import numpy
 from pysam import Samfile
 
 from crumbs.utils.optional_modules import Seq
 from crumbs.utils.tags import (TRIMMING_RECOMMENDATIONS, QUALITY, OTHER,
                                VECTOR, TRIMMING_KINDS, SEQS_PASSED,
-                               ORPHAN_SEQS)
+                               ORPHAN_SEQS, MATE_LOST)
 from crumbs.seq.utils.seq_utils import get_uppercase_segments
 from crumbs.seq.seq import (copy_seq, get_str_seq, get_annotations, get_length,
                             slice_seq, get_int_qualities, get_name)
-from crumbs.utils.segments_utils import (get_longest_segment, get_all_segments,
-                                         get_longest_complementary_segment,
-                                         merge_overlaping_segments)
+from crumbs.utils.segments_utils import (
+                                get_longest_segment, get_all_segments,
+                                get_longest_complementary_segment_in_batch,
+                                merge_overlaping_segments)
 from crumbs.utils.tags import SEQRECORD
-from crumbs.iterutils import rolling_window
-from crumbs.blast import BlasterForFewSubjects
-from crumbs.seq.seqio import write_seqs
+from crumbs.seq.oligo_matcher import OligoMatcher
 from crumbs.seq.pairs import group_pairs_by_name, group_pairs
 from crumbs.settings import get_setting
 from crumbs.seq.mate_chimeras import (_split_mates, _get_primary_alignment,
@@ -39,7 +40,7 @@ from crumbs.seq.mate_chimeras import (_split_mates, _get_primary_alignment,
                                       _get_qend, _5end_mapped,
                                       _group_alignments_reads_by_qname)
 from crumbs.mapping import (alignedread_to_seqitem, map_with_bwamem,
-                            map_process_to_sortedbam)
+                            MappingSession)
 # pylint: disable=R0903
 
 
@@ -66,6 +67,21 @@ class _BaseTrim(object):
         return {SEQS_PASSED: trimmed_seqs,
                 ORPHAN_SEQS: trim_packet[ORPHAN_SEQS]}
 
+    def trim_mates(self, mate_packet):
+        '''It adds the trimming recommendations to the kept mates.
+
+        As with __call__, TrimOrMask should be run afterwards.
+        '''
+        kept = mate_packet.kept
+        self._pre_trim({SEQS_PASSED: [mate_packet.get_seqs(kept)],
+                        ORPHAN_SEQS: []})
+        do_trim = self._do_trim
+        for mates, kept_mates in zip(mate_packet.mates, kept):
+            for index in numpy.flatnonzero(kept_mates).tolist():
+                mates[index] = do_trim(mates[index])
+        self._post_trim()
+        return mate_packet
+
     def _do_trim(self, seq):
         raise NotImplementedError()
 
@@ -94,7 +110,7 @@ class TrimLowercasedLetters(_BaseTrim):
             _add_trim_segments(segments, seq, kind=OTHER)
 
         else:
-            segments = [(0, len(seq))]
+            segments = [(0, len(str_seq) - 1)]
             _add_trim_segments(segments, seq, kind=OTHER)
         return seq
 
@@ -105,13 +121,15 @@ def _add_trim_segments(segments, sequence, kind):
     if not segments:
         return
     annotations = sequence.object.annotations
-    if TRIMMING_RECOMMENDATIONS not in annotations:
-        annotations[TRIMMING_RECOMMENDATIONS] = {}
-        for trim_kind in TRIMMING_KINDS:
-            annotations[TRIMMING_RECOMMENDATIONS][trim_kind] = []
-
-    trim_rec = annotations[TRIMMING_RECOMMENDATIONS]
-    trim_rec[kind].extend(segments)
+    # only the kinds used are added to the recommendations
+    try:
+        trim_rec = annotations[TRIMMING_RECOMMENDATIONS]
+    except KeyError:
+        trim_rec = annotations[TRIMMING_RECOMMENDATIONS] = {}
+    try:
+        trim_rec[kind].extend(segments)
+    except KeyError:
+        trim_rec[kind] = list(segments)
 
 
 class TrimEdges(_BaseTrim):
@@ -144,10 +162,10 @@ def _mask_sequence(seq, segments):
 
     if not segments:
         return seq
-    segments = merge_overlaping_segments(segments)
-    segments = get_all_segments(segments, get_length(seq))
     str_seq = get_str_seq(seq)
-    new_seq = ''
+    segments = merge_overlaping_segments(segments)
+    segments = get_all_segments(segments, len(str_seq))
+    new_seq = []
     for segment in segments:
         start = segment[0][0]
         end = segment[0][1] + 1
@@ -155,7 +173,8 @@ def _mask_sequence(seq, segments):
 
         if segment[1]:
             str_seq_ = str_seq_.lower()
-        new_seq += str_seq_
+        new_seq.append(str_seq_)
+    new_seq = ''.join(new_seq)
     if seq.kind == SEQRECORD:
         new_seq = Seq(new_seq, alphabet=seq.object.seq.alphabet)
     return copy_seq(seq, seq=new_seq)
@@ -169,65 +188,167 @@ class TrimOrMask(object):
 
     def __call__(self, trim_packet):
         'It trims the seqs'
-        trimmed_seqs = []
+        paired_seqs_list = trim_packet[SEQS_PASSED]
         orphan_seqs = trim_packet[ORPHAN_SEQS]
-        for paired_seqs in trim_packet[SEQS_PASSED]:
-            trimmed_paired_seqs = [self._do_trim(s) for s in paired_seqs]
+        seqs = [seq for paired_seqs in paired_seqs_list for seq in paired_seqs]
+        # all the seqs of the packet are trimmed at once
+        trimmed = iter(self._trim_seqs(seqs + orphan_seqs))
+
+        trimmed_seqs = []
+        new_orphans = []
+        for paired_seqs in paired_seqs_list:
+            trimmed_paired_seqs = [next(trimmed) for _ in paired_seqs]
             # all sequences are trimed, no lost
             if None not in trimmed_paired_seqs:
                 trimmed_seqs.append(trimmed_paired_seqs)
             # all secuences are lost because of trimming
-            elif (len(trimmed_paired_seqs) == 1 or
-                  trimmed_paired_seqs == (None, None)):
+            elif len(trimmed_paired_seqs) == 1:
                 continue
             # one of the pairs is lost in trimming
             else:
                 orphans = [s for s in trimmed_paired_seqs if s is not None]
-                orphan_seqs.extend(orphans)
-        orphan_seqs = self._trim_orphans(orphan_seqs)
+                new_orphans.extend(orphans)
+        orphan_seqs = [seq for seq in trimmed if seq is not None]
+        orphan_seqs.extend(new_orphans)
         return {SEQS_PASSED: trimmed_seqs, ORPHAN_SEQS: orphan_seqs}
 
-    def _do_trim(self, seq):
-        'It trims the edges of the given seqs.'
-        annots = get_annotations(seq)
-        if not TRIMMING_RECOMMENDATIONS in annots:
-            return seq
+    def trim_mates(self, mate_packet):
+        '''It trims or masks the kept mates of a MatePacket.
+
+        The mates left with no sequence are marked as lost.
+        '''
+        kept_indexes = [numpy.flatnonzero(kept_mates).tolist()
+                        for kept_mates in mate_packet.kept]
+        seqs = [mates[index] for mates, indexes in zip(mate_packet.mates,
+                                                       kept_indexes)
+                for index in indexes]
+        # all the seqs of the packet are trimmed at once
+        trimmed = iter(self._trim_seqs(seqs))
+        for mates, status, indexes in zip(mate_packet.mates,
+                                          mate_packet.status, kept_indexes):
+            for index in indexes:
+                seq = next(trimmed)
+                if seq is None:
+                    status[index] = MATE_LOST
+                else:
+                    mates[index] = seq
+        return mate_packet
 
-        trim_rec = annots[TRIMMING_RECOMMENDATIONS]
-        # fixing the trimming recommendations
-        if TRIMMING_RECOMMENDATIONS in annots:
-            del annots[TRIMMING_RECOMMENDATIONS]
+    @staticmethod
+    def _pop_trim_segments(seq):
+        '''It removes the trimming recommendations from the seq.
 
+        It returns the segments to trim or None if there were no
+        recommendations.
+        '''
+        annots = get_annotations(seq)
+        if TRIMMING_RECOMMENDATIONS not in annots:
+            return None
+        trim_rec = annots.pop(TRIMMING_RECOMMENDATIONS)
         trim_segments = []
         for trim_kind in TRIMMING_KINDS:
             trim_segments.extend(trim_rec.get(trim_kind, []))
+        return trim_segments
+
+    def _trim_seqs(self, seqs):
+        '''It trims or masks the given seqs.
 
+        The seqs left with no sequence are returned as None.
+        '''
+        trim_segments = [self._pop_trim_segments(seq) for seq in seqs]
         # masking
         if self.mask:
-            seq = _mask_sequence(seq, trim_segments)
-        else:
-            # trimming
-            if trim_segments:
-                trim_limits = get_longest_complementary_segment(
-                                            trim_segments, get_length(seq))
-                if trim_limits is None:
-                    # there's no sequence left
-                    return None
+            return [seq if segments is None else _mask_sequence(seq, segments)
+                    for seq, segments in zip(seqs, trim_segments)]
+
+        # trimming
+        to_trim = [index for index, segments in enumerate(trim_segments)
+                                                                if segments]
+        trim_limits = get_longest_complementary_segment_in_batch(
+                                [trim_segments[index] for index in to_trim],
+                                [get_length(seqs[index]) for index in to_trim])
+        trimmed_seqs = list(seqs)
+        for index, limits in zip(to_trim, trim_limits):
+            if limits is None:
+                # there's no sequence left
+                trimmed_seqs[index] = None
             else:
-                trim_limits = []
+                trimmed_seqs[index] = slice_seq(seqs[index], limits[0],
+                                                limits[1] + 1)
+        return trimmed_seqs
 
-            if trim_limits:
-                seq = slice_seq(seq, trim_limits[0], trim_limits[1] + 1)
+    def _do_trim(self, seq):
+        'It trims the edges of the given seqs.'
+        return self._trim_seqs([seq])[0]
 
-        return seq
 
-    def _trim_orphans(self, seqs):
-        new_seqs = []
-        for seq in seqs:
-            seq = self._do_trim(seq)
-            if seq is not None:
-                new_seqs.append(seq)
-        return new_seqs
+def is_read_trimmer(trimmer):
+    'It checks if the trimmer works read by read and not with whole packets'
+    return type(trimmer).__call__ == _BaseTrim.__call__
+
+
+class FusedTrimmer(object):
+    '''It runs several trimmers and it trims or masks every seq once.
+
+    It is equivalent to running the trimmers followed by TrimOrMask, but
+    the packet is walked only once. The trimmers that work read by read add
+    their recommendations one after the other and the seqs are cut or
+    masked at the end.
+    The trimmers that work with the whole packet, like TrimMatePairChimeras,
+    create new seqs, so they are run before the rest.
+    '''
+    def __init__(self, trimmers, mask=False):
+        '''The initiator.
+
+        trimmers - a list of trimmers
+        mask - If True the seqs will be masked instead of trimmed
+        '''
+        self._packet_trimmers = []
+        self._read_trimmers = []
+        for trimmer in trimmers:
+            if is_read_trimmer(trimmer):
+                self._read_trimmers.append(trimmer)
+            else:
+                self._packet_trimmers.append(trimmer)
+        self._trim_or_mask = TrimOrMask(mask=mask)
+
+    def __call__(self, trim_packet):
+        'It trims the seqs'
+        for trimmer in self._packet_trimmers:
+            trim_packet = trimmer(trim_packet)
+
+        read_trimmers = self._read_trimmers
+        for trimmer in read_trimmers:
+            trimmer._pre_trim(trim_packet)
+        do_trims = [trimmer._do_trim for trimmer in read_trimmers]
+        for paired_seqs in trim_packet[SEQS_PASSED]:
+            for seq in paired_seqs:
+                for do_trim in do_trims:
+                    do_trim(seq)
+        for trimmer in read_trimmers:
+            trimmer._post_trim()
+        return self._trim_or_mask(trim_packet)
+
+    def trim_mates(self, mate_packet):
+        'It trims the kept mates of a MatePacket'
+        if self._packet_trimmers:
+            msg = 'The packet trimmers can not trim a MatePacket'
+            raise NotImplementedError(msg)
+        read_trimmers = self._read_trimmers
+        kept = mate_packet.kept
+        trim_packet = {SEQS_PASSED: [mate_packet.get_seqs(kept)],
+                       ORPHAN_SEQS: []}
+        for trimmer in read_trimmers:
+            trimmer._pre_trim(trim_packet)
+        do_trims = [trimmer._do_trim for trimmer in read_trimmers]
+        for mates, kept_mates in zip(mate_packet.mates, kept):
+            for index in numpy.flatnonzero(kept_mates).tolist():
+                seq = mates[index]
+                for do_trim in do_trims:
+                    do_trim(seq)
+        for trimmer in read_trimmers:
+            trimmer._post_trim()
+        return self._trim_or_mask.trim_mates(mate_packet)
 
 
 def _get_bad_quality_segments(quals, window, threshold, trim_left=True,
@@ -236,10 +357,15 @@ def _get_bad_quality_segments(quals, window, threshold, trim_left=True,
 
     The algorithm is similar to the one used by qclip in Staden.
     '''
-    # do window quality means
-    mean = lambda l: float(sum(l)) / len(l) if len(l) > 0 else float('nan')
-
-    wquals = [mean(win_quals) for win_quals in rolling_window(quals, window)]
+    # do window quality means, using the cumulative sum of the qualities
+    cum_quals = [0]
+    cum_qual = 0
+    for qual in quals:
+        cum_qual += qual
+        cum_quals.append(cum_qual)
+    window_ = float(window)
+    wquals = [(cum_quals[index + window] - cum_quals[index]) / window_
+                                for index in xrange(len(quals) - window + 1)]
 
     if not wquals:
         return [(0, len(quals) - 1)]
@@ -316,17 +442,12 @@ class TrimWithBlastShort(_BaseTrim):
 
     def _pre_trim(self, trim_packet):
         seqs = [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
-        db_fhand = write_seqs(seqs, file_format='fasta')
-        db_fhand.flush()
-        params = {'task': 'blastn-short', 'expect': '0.0001'}
         filters = [{'kind': 'score_threshold', 'score_key': 'identity',
                     'min_score': 87},
                    {'kind': 'min_length', 'min_num_residues': 13,
                     'length_in_query': False}]
-        self._matcher = BlasterForFewSubjects(db_fhand.name, self.oligos,
-                                             program='blastn', filters=filters,
-                                             params=params,
-                                             elongate_for_global=True)
+        self._matcher = OligoMatcher(seqs, self.oligos, filters=filters,
+                                     expect=0.0001, elongate_for_global=True)
 
     def _do_trim(self, seq):
         'It trims the masked segments of the SeqWrappers.'
@@ -347,32 +468,46 @@ def _get_longest_5end_alinged_read(aligned_reads, max_clipping):
     return longest_5end
 
 
+def _get_trim_packet_seqs(trim_packet):
+    return [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
+
+
 class TrimMatePairChimeras(_BaseTrim):
-    'It trims chimeric regions in mate pairs reads'
+    '''It trims chimeric regions in mate pairs reads
 
-    def __init__(self, index_fpath, max_clipping=None, tempdir=None):
+    Called with a packet it maps the packet with its own bwa process,
+    trim_packets maps a stream of packets with a single bwa.
+    '''
+
+    def __init__(self, index_fpath, max_clipping=None, tempdir=None,
+                 threads=None):
         'The initiator'
         self._tempdir = tempdir
         self._index_fpath = index_fpath
+        self.threads = threads
         if max_clipping is not None:
             self.max_clipping = max_clipping
         else:
             self.max_clipping = get_setting('CHIMERAS_SETTINGS')['MAX_CLIPPING']
 
-    def _pre_trim(self, trim_packet):
-        seqs = [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
-        reads_fhand = NamedTemporaryFile(dir=self._tempdir, suffix='.trimming')
+    def _start_session(self):
+        bwa = map_with_bwamem(self._index_fpath, interleave_fpath='-',
+                              threads=self.threads, stdin=PIPE)
+        return MappingSession(bwa, binary='bwa')
 
-        write_seqs(seqs, reads_fhand)
-        reads_fhand.flush()
-        bwa = map_with_bwamem(self._index_fpath,
-                              interleave_fpath=reads_fhand.name)
-        bam_fhand = NamedTemporaryFile(dir=self._tempdir)
-        map_process_to_sortedbam(bwa, bam_fhand.name, key='queryname',
-                                 tempdir=self._tempdir)
+    def _write_sam(self, header_lines, sam_lines):
+        # bwa keeps the pairs together, so the SAM does not need sorting
+        sam_fhand = NamedTemporaryFile(dir=self._tempdir, suffix='.sam')
+        sam_fhand.write(''.join(header_lines))
+        sam_fhand.write(''.join(sam_lines))
+        sam_fhand.flush()
+        self._bam_fhand = sam_fhand
 
-        self._bam_fhand = bam_fhand
-        reads_fhand.close()
+    def _pre_trim(self, trim_packet):
+        seqs = _get_trim_packet_seqs(trim_packet)
+        session = self._start_session()
+        for _, sam_lines in session.map_packets([seqs]):
+            self._write_sam(session.header_lines, sam_lines)
 
     def _do_trim(self, aligned_reads):
         max_clipping = self.max_clipping
@@ -391,9 +526,7 @@ class TrimMatePairChimeras(_BaseTrim):
             _add_trim_segments(segments, seq, kind=OTHER)
         return seq
 
-    def __call__(self, trim_packet):
-        'It trims the seqs'
-        self._pre_trim(trim_packet)
+    def _trim_mapped_packet(self, trim_packet):
         trimmed_seqs = []
         bamfile = Samfile(self._bam_fhand.name)
         for grouped_mates in _group_alignments_reads_by_qname(bamfile):
@@ -403,6 +536,19 @@ class TrimMatePairChimeras(_BaseTrim):
         return {SEQS_PASSED: trimmed_seqs,
                 ORPHAN_SEQS: trim_packet[ORPHAN_SEQS]}
 
+    def __call__(self, trim_packet):
+        'It trims the seqs'
+        self._pre_trim(trim_packet)
+        return self._trim_mapped_packet(trim_packet)
+
+    def trim_packets(self, trim_packets):
+        'It trims a stream of packets mapping them with one bwa'
+        session = self._start_session()
+        for trim_packet, sam_lines in session.map_packets(trim_packets,
+                                               get_seqs=_get_trim_packet_seqs):
+            self._write_sam(session.header_lines, sam_lines)
+            yield self._trim_mapped_packet(trim_packet)
+
     def _post_trim(self):
         self._bam_fhand.close()
 
@@ -416,17 +562,12 @@ class TrimNexteraAdapters(_BaseTrim):
 
     def _pre_trim(self, trim_packet):
         seqs = [s for seqs in trim_packet[SEQS_PASSED]for s in seqs]
-        db_fhand = write_seqs(seqs, file_format='fasta')
-        db_fhand.flush()
-        params = {'task': 'blastn-short', 'expect': '0.0001'}
         filters = [{'kind': 'score_threshold', 'score_key': 'identity',
                     'min_score': 87},
                    {'kind': 'min_length', 'min_num_residues': 13,
                     'length_in_query': False}]
-        self._matcher = BlasterForFewSubjects(db_fhand.name, self.oligos,
-                                             program='blastn', filters=filters,
-                                             params=params,
-                                             elongate_for_global=True)
+        self._matcher = OligoMatcher(seqs, self.oligos, filters=filters,
+                                     expect=0.0001, elongate_for_global=True)
 
     def _do_trim(self, seq):
         'It trims the masked segments of the SeqWrappers.'
@@ -13,74 +13,66 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import stat
 import cStringIO
-from array import array
-import hashlib
+import weakref
+from collections import OrderedDict
 
 from crumbs.utils.optional_modules import FastqGeneralIterator
 from crumbs.settings import get_setting
-from crumbs.utils.file_utils import fhand_is_seekable, peek_chunk_from_file
+from crumbs.utils.file_utils import peek_chunk_from_file
 from crumbs.exceptions import (UnknownFormatError, UndecidedFastqVersionError,
                                FileIsEmptyError)
 
-FILETYPE = 'file'
-STRINGIOTYPE = 'stringio'
-OTHERTYPE = 'othertype'
+# the lowest quality character of the Illumina 1.3+ encoding
+_MIN_ILLUMINA_QUAL_CHAR = '@'
 
 
-def _get_some_qual_and_lengths(fhand, force_file_as_non_seek):
-    'It returns the quality characters and the lengths'
+def _get_some_quals(fhand):
+    '''It returns the qualities of the first reads and if they are malformed.
+
+    The reads are taken from a chunk peeked from the beginning of the file,
+    the same way for seekable files, pipes and compressed streams.
+    '''
     seqs_to_peek = get_setting('SEQS_TO_GUESS_FASTQ_VERSION')
     chunk_size = get_setting('CHUNK_TO_GUESS_FASTQ_VERSION')
 
-    lengths = array('I')
-    seqs_analyzed = 0
-    if fhand_is_seekable(fhand) and not force_file_as_non_seek:
-        fmt_fhand = fhand
-        chunk = fmt_fhand.read(chunk_size)
-        fhand.seek(0)
-    else:
-        chunk = peek_chunk_from_file(fhand, chunk_size)
-        fmt_fhand = cStringIO.StringIO(chunk)
-
+    chunk = peek_chunk_from_file(fhand, chunk_size)
+    # if the chunk is not the whole file the last read could be cut
+    whole_file = len(chunk) < chunk_size
+    quals = []
+    malformed = False
     try:
-        for seq in FastqGeneralIterator(fmt_fhand):
-            qual = [ord(char) for char in seq[2]]
-            sanger_chars = [q for q in qual if q < 64]
-            if sanger_chars:
-                fhand.seek(0)
-                return None, True, chunk  # no quals, no lengths, is_sanger
-            lengths.append(len(qual))
-            seqs_analyzed += 1
-            if seqs_analyzed > seqs_to_peek:
+        for seq in FastqGeneralIterator(cStringIO.StringIO(chunk)):
+            quals.append(seq[2])
+            if len(quals) > seqs_to_peek:
+                whole_file = True   # the last read is complete
                 break
     except ValueError:
-        msg = 'The file is Fastq, but the version is difficult to guess'
-        raise UndecidedFastqVersionError(msg)
-    finally:
-        fhand.seek(0)
-    return lengths, None, chunk  # don't know if it's sanger
+        if whole_file or not quals:
+            malformed = True
+        whole_file = True   # the cut read was not yielded
+    if not whole_file and len(quals) > 1:
+        quals.pop()
+    return quals, malformed
 
 
-def _guess_fastq_version(fhand, force_file_as_non_seek):
+def _guess_fastq_version(fhand):
     '''It guesses the format of fastq files.
 
     It ignores the solexa fastq version.
     '''
-    lengths, is_sanger, chunk = _get_some_qual_and_lengths(fhand,
-                                                        force_file_as_non_seek)
-    if is_sanger:
-        fmt = 'fastq'
-    elif is_sanger is False:
-        fmt = 'fastq-illumina'
-    else:
-        fmt = None
-    if fmt:
-        return fmt
+    quals, malformed = _get_some_quals(fhand)
+    all_quals = ''.join(quals)
+    if all_quals and min(all_quals) < _MIN_ILLUMINA_QUAL_CHAR:
+        return 'fastq'
+    if malformed:
+        msg = 'The file is Fastq, but the version is difficult to guess'
+        raise UndecidedFastqVersionError(msg)
 
     longest_expected_illumina = get_setting('LONGEST_EXPECTED_ILLUMINA_READ')
-    n_long_seqs = [l for l in lengths if l > longest_expected_illumina]
-    if n_long_seqs:
+    if quals and max(len(qual) for qual in quals) > longest_expected_illumina:
         msg = 'It was not possible to guess the format of '
         if hasattr(fhand, 'name'):
             msg += 'the file ' + fhand.name
@@ -93,66 +85,121 @@ def _guess_fastq_version(fhand, force_file_as_non_seek):
     else:
         return 'fastq-illumina'
 
-FILEFORMAT_INVENTORY = {}
-
 
-def _get_instance_type(fhand):
+def _get_file_key(fhand):
+    'It returns a key for the regular files, None for any other fhand'
     try:
-        name = fhand.name
-    except AttributeError:
-        name = None
-    if name:
-        return FILETYPE
-
-    if 'getvalue' in dir(fhand):
-        return STRINGIOTYPE
-    else:
-        return OTHERTYPE
-
-
-def _get_fhand_id(fhand):
-    'get unique id of the fhand'
-    fhand_type = _get_instance_type(fhand)
-    fhand_id = id(fhand)
-    if fhand_type == FILETYPE:
-        key = (fhand_id, fhand.name)
-    elif fhand_type == STRINGIOTYPE:
-        hash_ = hashlib.sha224(fhand.getvalue()[:100]).hexdigest()
-        key = (fhand_id, hash_)
-    else:
-        key = fhand_id
-    return key
+        stat_ = os.fstat(fhand.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        # StringIOs and other file like objects
+        return None
+    if not stat.S_ISREG(stat_.st_mode):
+        # pipes and other streams can not be recognized when reopened
+        return None
+    return (stat_.st_dev, stat_.st_ino, stat_.st_size, stat_.st_mtime)
+
+
+class FormatDetector(object):
+    '''It guesses the format of the sequence files and it remembers it.
+
+    The formats of the regular files are cached by device, inode, size and
+    modification time, so a file is guessed only once, even if it is opened
+    several times, and a modified file is guessed again. The other file
+    like objects (StringIOs, pipes, decompressed streams) are cached by
+    instance and the cache keeps them alive, so their ids can not be reused
+    by another object while they are in it.
+    The cache is a bounded LRU. The formats set by the user can not be
+    guessed again, so they are kept by instance out of the LRU, for as long
+    as the instance lives. The objects that do not support weak references
+    (cStringIOs) go to the LRU.
+    '''
+    def __init__(self, cache_size=None):
+        if cache_size is None:
+            cache_size = get_setting('FORMAT_CACHE_SIZE')
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._forced_formats = weakref.WeakKeyDictionary()
+
+    def _get_cached(self, key):
+        cache = self._cache
+        try:
+            value = cache.pop(key)
+        except KeyError:
+            return None
+        cache[key] = value
+        return value
+
+    def _cache_format(self, key, fhand, file_format):
+        cache = self._cache
+        cache.pop(key, None)
+        cache[key] = fhand, file_format
+        if len(cache) > self._cache_size:
+            cache.popitem(last=False)
+
+    def _get_instance_format(self, fhand):
+        try:
+            return self._forced_formats[fhand]
+        except (KeyError, TypeError):
+            pass
+        cached = self._get_cached(id(fhand))
+        if cached is not None and cached[0] is fhand:
+            return cached[1]
+        return None
+
+    def get_format(self, fhand):
+        'It gets the format from the cache or it guesses it'
+        file_format = self._get_instance_format(fhand)
+        if file_format is not None:
+            return file_format
+
+        file_key = _get_file_key(fhand)
+        if file_key is not None:
+            cached = self._get_cached(file_key)
+            if cached is not None:
+                return cached[1]
+        file_format = _guess_format(fhand, force_file_as_non_seek=False)
+        if file_key is None:
+            self._cache_format(id(fhand), fhand, file_format)
+        else:
+            self._cache_format(file_key, None, file_format)
+        return file_format
 
+    def set_format(self, fhand, file_format):
+        'It sets the file format of the given instance'
+        if self._get_instance_format(fhand) is not None:
+            msg = 'The given instance already setted its file format'
+            raise RuntimeError(msg)
+        try:
+            self._forced_formats[fhand] = file_format
+        except TypeError:
+            self._cache_format(id(fhand), fhand, file_format)
 
-def get_format(fhand):
-    'It gets the format or it looks in the inventory'
-    id_ = _get_fhand_id(fhand)
-    try:
-        file_format = FILEFORMAT_INVENTORY[id_]
-    except KeyError:
-        file_format = None
+    def clear(self):
+        'It forgets all the formats'
+        self._cache.clear()
+        self._forced_formats.clear()
 
-    if file_format is None:
-        file_format = _guess_format(fhand, force_file_as_non_seek=False)
-        FILEFORMAT_INVENTORY[id_] = file_format
 
-    return file_format
+_FORMAT_DETECTOR = FormatDetector()
+
+
+def get_format(fhand):
+    'It gets the format or it guesses it'
+    return _FORMAT_DETECTOR.get_format(fhand)
 
 
 def set_format(fhand, file_format):
-    'It sets the file format in the global inventory variable'
-    id_ = _get_fhand_id(fhand)
-    if id_ in FILEFORMAT_INVENTORY:
-        msg = 'The given instance already setted its file format'
-        raise RuntimeError(msg)
-    FILEFORMAT_INVENTORY[id_] = file_format
+    'It sets the file format of the given instance'
+    _FORMAT_DETECTOR.set_format(fhand, file_format)
 
 
-def _guess_format(fhand, force_file_as_non_seek):
+def _guess_format(fhand, force_file_as_non_seek=False):
     '''It guesses the format of the sequence file.
 
-    This function is just for testing forcing the fhand as non-seekable.
     It does ignore the solexa fastq version.
+    The seekable and non-seekable files follow the same route, both are
+    guessed from a peeked chunk, force_file_as_non_seek is kept for the
+    tests.
     '''
     chunk_size = 2048
     chunk = peek_chunk_from_file(fhand, chunk_size)
@@ -169,7 +216,7 @@ def _guess_format(fhand, force_file_as_non_seek):
             else:
                 return 'fasta'
     elif chunk.startswith('@'):
-        return _guess_fastq_version(fhand, force_file_as_non_seek)
+        return _guess_fastq_version(fhand)
     elif chunk.startswith('LOCUS'):
         return 'genbank'
     elif chunk.startswith('ID'):
@@ -0,0 +1,426 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+'''
+An index of the records of the FASTA and FASTQ files.
+
+The index keeps the byte offset and the length of every record, so any
+record can be read with a seek, without parsing the records that precede
+it. For the bgzip compressed files the offsets are BGZF virtual offsets.
+The index is built once with a block scanner and it is stored in the user
+cache directory.
+'''
+
+import os
+import io
+import stat
+from contextlib import contextmanager
+
+import numpy
+
+from crumbs.seq.seq import SeqWrapper, SeqItem
+from crumbs.settings import get_setting
+from crumbs.utils.tags import SEQITEM
+from crumbs.exceptions import NotIndexableError
+from crumbs.utils.file_utils import evict_cache_files, touch_cache_file
+from crumbs.utils.compression import (is_bgzf as _is_bgzf,
+                                      read_bgzf_raw_block, inflate_bgzf_block,
+                                      BGZF_HEADER_SIZE, GZIP_MAGIC,
+                                      BZIP2_MAGIC)
+
+# pylint: disable=C0111
+
+_INDEX_VERSION = 1
+_SCAN_BLOCK_SIZE = 4 * 1024 * 1024
+_NEWLINE = ord('\n')
+
+
+@contextmanager
+def _open_raw(fhand):
+    '''It yields a raw binary handler for a regular file and its kind.
+
+    The raw handler shares the file descriptor with fhand, so the file
+    position is restored afterwards.
+    '''
+    try:
+        fileno = fhand.fileno()
+    except (AttributeError, IOError, ValueError):
+        raise NotIndexableError('The file has no file descriptor')
+    if not stat.S_ISREG(os.fstat(fileno).st_mode):
+        raise NotIndexableError('It is not a regular file')
+    position = os.lseek(fileno, 0, os.SEEK_CUR)
+    raw = io.open(fileno, 'rb', closefd=False)
+    try:
+        raw.seek(0)
+        header = raw.read(BGZF_HEADER_SIZE)
+        if _is_bgzf(header):
+            is_bgzf = True
+        elif header[:2] in (GZIP_MAGIC, BZIP2_MAGIC):
+            raise NotIndexableError('Only bgzf compressed files are indexed')
+        else:
+            is_bgzf = False
+        yield raw, is_bgzf
+    finally:
+        raw.close()
+        os.lseek(fileno, position, os.SEEK_SET)
+
+
+def _read_bgzf_block(raw):
+    'It returns the uncompressed data of the next bgzf block or None'
+    try:
+        raw_block = read_bgzf_raw_block(raw)
+    except IOError, error:
+        raise NotIndexableError(str(error))
+    return None if raw_block is None else inflate_bgzf_block(raw_block)
+
+
+def _iter_plain_blocks(raw):
+    raw.seek(0)
+    while True:
+        block = raw.read(_SCAN_BLOCK_SIZE)
+        if not block:
+            break
+        yield block
+
+
+def _iter_bgzf_blocks(raw, bgzf_blocks):
+    '''It yields the uncompressed data in big chunks.
+
+    The compressed and uncompressed start of every bgzf block are appended
+    to bgzf_blocks.
+    '''
+    raw.seek(0)
+    chunk = []
+    chunk_size = 0
+    uncompressed_start = 0
+    while True:
+        compressed_start = raw.tell()
+        data = _read_bgzf_block(raw)
+        if data is None:
+            break
+        if not data:
+            continue
+        bgzf_blocks.append((compressed_start, uncompressed_start))
+        uncompressed_start += len(data)
+        chunk.append(data)
+        chunk_size += len(data)
+        if chunk_size >= _SCAN_BLOCK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class _RecordScanner(object):
+    '''It finds the records and the sequence lengths in a stream of blocks.
+
+    The newlines are looked for with numpy in big blocks.
+    '''
+    def __init__(self, is_fastq):
+        self.is_fastq = is_fastq
+        self.total_length = 0
+        self.size = 0
+        self._num_lines = 0
+        self._record_starts = []
+        # the line that starts at the beginning of the next block
+        self._pending = numpy.array([0], dtype=numpy.int64)
+        # the last line found, its length is known in the next block
+        self._last_line = None
+        self._last_byte = None
+
+    def _is_seq(self, first_bytes, line_kinds):
+        if self.is_fastq:
+            return line_kinds == 1
+        else:
+            return first_bytes != ord('>')
+
+    def _add_line_lengths(self, starts, first_bytes, line_kinds):
+        if self._last_line is not None:
+            last_start, last_first_byte, last_kind = self._last_line
+            starts = numpy.append(last_start, starts)
+            first_bytes = numpy.append(last_first_byte, first_bytes)
+            line_kinds = numpy.append(last_kind, line_kinds)
+        lengths = numpy.diff(starts) - 1
+        is_seq = self._is_seq(first_bytes[:-1], line_kinds[:-1])
+        self.total_length += int(lengths[is_seq].sum())
+        self._last_line = starts[-1], first_bytes[-1], line_kinds[-1]
+
+    def add_block(self, block):
+        if '\r' in block:
+            raise NotIndexableError('The files with \\r\\n are not indexed')
+        block_start = self.size
+        block_end = block_start + len(block)
+        bytes_ = numpy.frombuffer(block, dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(bytes_ == _NEWLINE) + 1 + block_start
+        starts = numpy.concatenate((self._pending, newlines))
+        # the line after the last newline starts in the next block
+        in_block = starts < block_end
+        self._pending = starts[~in_block]
+        starts = starts[in_block]
+        self.size = block_end
+        self._last_byte = block[-1]
+        if not len(starts):
+            return
+        first_bytes = bytes_[starts - block_start]
+        line_kinds = numpy.arange(self._num_lines,
+                                  self._num_lines + len(starts)) % 4
+        self._num_lines += len(starts)
+        if self.is_fastq:
+            is_title = line_kinds == 0
+            if (numpy.any(first_bytes[is_title] != ord('@')) or
+                    numpy.any(first_bytes[line_kinds == 2] != ord('+'))):
+                msg = 'Only the fastq files with one line per sequence can '
+                msg += 'be indexed'
+                raise NotIndexableError(msg)
+            self._record_starts.append(starts[is_title])
+        else:
+            self._record_starts.append(starts[first_bytes == ord('>')])
+        self._add_line_lengths(starts, first_bytes, line_kinds)
+
+    def finish(self):
+        'It returns the record starts'
+        if self.is_fastq and self._num_lines % 4:
+            raise NotIndexableError('The last fastq record is truncated')
+        if self._last_line is not None:
+            last_start, last_first_byte, last_kind = self._last_line
+            length = self.size - last_start
+            if self._last_byte == '\n':
+                length -= 1
+            if self._is_seq(last_first_byte, last_kind):
+                self.total_length += int(length)
+        if not self._record_starts:
+            return numpy.array([], dtype=numpy.int64)
+        return numpy.concatenate(self._record_starts)
+
+
+def _to_virtual_offsets(offsets, bgzf_blocks):
+    'It converts the uncompressed offsets into bgzf virtual offsets'
+    if not len(offsets):
+        return numpy.array([], dtype=numpy.uint64)
+    compressed_starts, uncompressed_starts = numpy.array(bgzf_blocks,
+                                                         dtype=numpy.int64).T
+    block_idxs = numpy.searchsorted(uncompressed_starts, offsets,
+                                    side='right') - 1
+    within_block = offsets - uncompressed_starts[block_idxs]
+    virtual_offsets = compressed_starts[block_idxs].astype(numpy.uint64)
+    virtual_offsets <<= numpy.uint64(16)
+    return virtual_offsets | within_block.astype(numpy.uint64)
+
+
+def _read_at_virtual_offset(raw, virtual_offset, length):
+    raw.seek(virtual_offset >> 16)
+    within_block = virtual_offset & 0xFFFF
+    data = []
+    data_size = -within_block
+    while data_size < length:
+        block = _read_bgzf_block(raw)
+        if block is None:
+            break
+        data.append(block)
+        data_size += len(block)
+    return ''.join(data)[within_block:within_block + length]
+
+
+def _chunk_to_seqitem(chunk, file_format):
+    'It builds a seqitem like the ones created by read_seqs'
+    lines = chunk.splitlines(True)
+    if not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    title = lines[0]
+    name = title[1:-1].partition(' ')[0]
+    if 'fastq' not in file_format:
+        lines = [title, ''.join(line.rstrip() for line in lines[1:]) + '\n']
+    return SeqWrapper(SEQITEM, SeqItem(name, lines), file_format)
+
+
+class RecordIndex(object):
+    '''The offsets and lengths of the records of a file.
+
+    The offsets are BGZF virtual offsets for the bgzip compressed files
+    and the lengths are always the uncompressed lengths.
+    '''
+    def __init__(self, offsets, lengths, file_format, total_length,
+                 is_bgzf=False):
+        self.offsets = offsets
+        self.lengths = lengths
+        self.file_format = file_format
+        self.total_length = total_length
+        self.is_bgzf = is_bgzf
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _read_chunk(self, raw, offset, length):
+        if self.is_bgzf:
+            return _read_at_virtual_offset(raw, int(offset), length)
+        raw.seek(int(offset))
+        return raw.read(length)
+
+    def read_records(self, fhand, indexes, records_per_read=1):
+        '''It yields the seqs of the given record indexes.
+
+        The indexes should be sorted to read the file sequentially. With
+        records_per_read several consecutive records are read at once
+        starting from every index.
+        '''
+        offsets, lengths = self.offsets, self.lengths
+        file_format = self.file_format
+        with _open_raw(fhand) as (raw, _):
+            for index in indexes:
+                rec_lengths = lengths[index: index + records_per_read]
+                chunk = self._read_chunk(raw, offsets[index],
+                                         int(rec_lengths.sum()))
+                rec_start = 0
+                for rec_length in rec_lengths:
+                    rec_end = rec_start + int(rec_length)
+                    yield _chunk_to_seqitem(chunk[rec_start:rec_end],
+                                            file_format)
+                    rec_start = rec_end
+
+    def slice_records(self, fhand, start, stop=None):
+        'It yields the seqs from the start record to the stop one'
+        stop = len(self) if stop is None else min(stop, len(self))
+        return self.read_records(fhand, xrange(start, stop))
+
+    def get_byte_ranges(self, num_parts):
+        '''It splits the records in contiguous parts.
+
+        It returns a list with the offset, uncompressed length and number of
+        records of every part.
+        '''
+        num_records = len(self)
+        if not num_records:
+            return []
+        num_parts = max(1, min(num_parts, num_records))
+        bounds = numpy.linspace(0, num_records, num_parts + 1).astype(int)
+        ranges = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            ranges.append((int(self.offsets[start]),
+                           int(self.lengths[start:stop].sum()),
+                           int(stop - start)))
+        return ranges
+
+
+def _build_index(fhand, file_format):
+    is_fastq = 'fastq' in file_format
+    if not is_fastq and file_format != 'fasta':
+        raise NotIndexableError('Unsupported format: ' + file_format)
+    scanner = _RecordScanner(is_fastq)
+    bgzf_blocks = []
+    with _open_raw(fhand) as (raw, is_bgzf):
+        if is_bgzf:
+            blocks = _iter_bgzf_blocks(raw, bgzf_blocks)
+        else:
+            blocks = _iter_plain_blocks(raw)
+        for block in blocks:
+            scanner.add_block(block)
+    starts = scanner.finish()
+    lengths = numpy.diff(numpy.append(starts, scanner.size))
+    lengths = lengths.astype(numpy.uint32)
+    if is_bgzf:
+        offsets = _to_virtual_offsets(starts, bgzf_blocks)
+    else:
+        offsets = starts.astype(numpy.uint64)
+    return RecordIndex(offsets, lengths, file_format, scanner.total_length,
+                       is_bgzf=is_bgzf)
+
+
+def _get_index_fpath(fhand, cache_dir):
+    '''It returns the path of the cached index or None.
+
+    The index of a file is kept by device and inode, its size and
+    modification time are checked when it is loaded.
+    '''
+    if not cache_dir:
+        return None
+    try:
+        stat_ = os.fstat(fhand.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(stat_.st_mode):
+        return None
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another process could have created it
+            if not os.path.isdir(cache_dir):
+                return None
+    fname = '{:d}_{:d}.npz'.format(stat_.st_dev, stat_.st_ino)
+    return os.path.join(cache_dir, fname)
+
+
+def _get_file_stamp(fhand):
+    stat_ = os.fstat(fhand.fileno())
+    return numpy.array([_INDEX_VERSION, stat_.st_size, stat_.st_mtime],
+                       dtype=numpy.float64)
+
+
+def _load_index(index_fpath, fhand, file_format):
+    try:
+        with open(index_fpath, 'rb') as index_fhand:
+            index = numpy.load(index_fhand)
+            if (not numpy.array_equal(index['stamp'], _get_file_stamp(fhand))
+                    or str(index['file_format']) != file_format):
+                return None
+            return RecordIndex(index['offsets'], index['lengths'],
+                               file_format, int(index['total_length']),
+                               is_bgzf=bool(index['is_bgzf']))
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _save_index(index, index_fpath, fhand):
+    'It saves the index, if the directory is not writable it does nothing'
+    tmp_fpath = '{}.{}.tmp'.format(index_fpath, os.getpid())
+    try:
+        with open(tmp_fpath, 'wb') as tmp_fhand:
+            numpy.savez(tmp_fhand, offsets=index.offsets,
+                        lengths=index.lengths, file_format=index.file_format,
+                        total_length=index.total_length,
+                        is_bgzf=index.is_bgzf, stamp=_get_file_stamp(fhand))
+        os.rename(tmp_fpath, index_fpath)
+    except (IOError, OSError):
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+
+
+def get_record_index(fhand, file_format, cache_dir=None, max_size=None):
+    '''It returns the record index of the file.
+
+    The index is read from the cache directory or it is built and saved
+    there. By default the RECORD_INDEX_CACHE_DIR setting is used, if it is
+    empty the index is not saved. When the cache goes above max_size bytes,
+    by default RECORD_INDEX_CACHE_MAX_SIZE, the least recently used indexes
+    are removed. Only the fasta files and the fastq files with one line per
+    sequence and quality, uncompressed or bgzip compressed, can be indexed,
+    NotIndexableError is raised otherwise.
+    '''
+    if cache_dir is None:
+        cache_dir = get_setting('RECORD_INDEX_CACHE_DIR')
+    index_fpath = _get_index_fpath(fhand, cache_dir)
+    if index_fpath is not None:
+        index = _load_index(index_fpath, fhand, file_format)
+        if index is not None:
+            touch_cache_file(index_fpath)
+            return index
+    index = _build_index(fhand, file_format)
+    if index_fpath is not None:
+        _save_index(index, index_fpath, fhand)
+        if max_size is None:
+            max_size = get_setting('RECORD_INDEX_CACHE_MAX_SIZE')
+        # the cache only grows when an index is saved
+        evict_cache_files(cache_dir, int(max_size))
+    return index
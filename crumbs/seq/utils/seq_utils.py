@@ -30,17 +30,15 @@ def uppercase_length(string):
     return len(re.findall("[A-Z]", string))
 
 
+_UPPERCASE_RE = re.compile('[A-Z]+')
+
+
 def get_uppercase_segments(string):
     '''It detects the unmasked regions of a sequence
 
     It returns a list of (start, end) tuples'''
-    start = 0
-    for is_upper, group in itertools.groupby(string, lambda x: x.isupper()):
-        group = list(group)
-        end = start + len(group) - 1
-        if is_upper:
-            yield start, end
-        start = end + 1
+    for match in _UPPERCASE_RE.finditer(string):
+        yield match.start(), match.end() - 1
 
 
 class ChangeCase(object):
@@ -21,17 +21,18 @@ _SUPPORTED_OUTPUT_FORMATS = ['fasta', 'fastq', 'fastq-illumina']
 # hold in memory
 _PACKET_SIZE = 1000
 
-# number of sequences to analyze in the fastq version guessing of a seekable
-# file
+# maximum number of sequences to analyze in the fastq version guessing
 _SEQS_TO_GUESS_FASTQ_VERSION = 1000
 
-# number of bytes to analyze in the fastq version guessing of a non-seekable
-# file
+# number of bytes peeked from the file in the fastq version guessing
 _CHUNK_TO_GUESS_FASTQ_VERSION = 50000
 
 # maximum length expected for an Illumina read
 _LONGEST_EXPECTED_ILLUMINA_READ = 250
 
+# number of file formats remembered by the format guessing
+_FORMAT_CACHE_SIZE = 1024
+
 
 # 454 FLX mate pair linker
 _FLX_LINKER = 'GTTGGAACCGAAAGGGTTTGAATTCAAACCCTTTCGGTTCCAAC'
@@ -108,6 +109,53 @@ _CHIMERAS_SETTINGS['MAX_CLIPPING'] = 0.05
 _CHIMERAS_SETTINGS['MAX_PE_LEN'] = 750
 _CHIMERAS_SETTINGS['MATE_DISTANCE_VARIATION'] = 1000
 
+# directory for the persistent cache of the bwa, bowtie2 and blast indexes
+# built by the crumbs. If it is empty the cache is not used.
+_INDEX_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                'seq_crumbs', 'indexes')
+# disk budget for the index cache in bytes
+_INDEX_CACHE_MAX_SIZE = 20 * 1024 ** 3
+
+# maximum number of queries searched by every blast process and number of
+# local blast processes run at the same time. The queries of the packets
+# searched at the same time by the worker processes are blasted together.
+_BLAST_BATCH_SIZE = 5000
+_BLAST_MAX_PROCESSES = 2
+# persistent cache for the results of the local blast searches, for
+# instance ~/.cache/seq_crumbs/blast_results.sqlite. If it is empty, the
+# default, the results are not cached between runs.
+_BLAST_RESULTS_CACHE = ''
+# persistent cache for the ESTScan and blast annotations used to orientate
+# the transcripts. If it is empty the annotations are not cached.
+_TRANSCRIPT_ANNOTATIONS_CACHE = os.path.join(os.path.expanduser('~'),
+                                             '.cache', 'seq_crumbs',
+                                         'transcript_annotations.sqlite')
+
+# disk budget in bytes for the values of each of the sqlite caches
+_SQLITE_CACHE_MAX_SIZE = 1024 ** 3
+
+# directory for the read counts by reference taken from the bam indexes. If
+# it is empty the counts are not cached.
+_REF_COUNTS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                     'seq_crumbs', 'ref_counts')
+# disk budget for the cached read counts in bytes
+_REF_COUNTS_CACHE_MAX_SIZE = 64 * 1024 ** 2
+
+# directory for the record indexes of the fasta and fastq files. If it is
+# empty the indexes are not stored.
+_RECORD_INDEX_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                       'seq_crumbs', 'record_indexes')
+# disk budget for the record indexes in bytes
+_RECORD_INDEX_CACHE_MAX_SIZE = 1024 ** 3
+
+# number of threads used to compress the gzip and bgzf outputs and to
+# decompress the bgzf inputs
+_COMPRESSION_THREADS = 4
+
+# number of serialized packets that can wait to be written by the
+# background writers of the packet writers
+_WRITER_QUEUE_SIZE = 4
+
 _DEFAULT_N_BINS = 80
 _DEFAULT_N_MOST_ABUNDANT_REFERENCES = 40
 
@@ -344,7 +344,7 @@ class IntBoxplot(object):
         'The init'
         self.counts = {}
 
-    def append(self, category, value):
+    def append(self, category, value, count=1):
         'It appends a value to the distribution corresponding to a category'
         counts = self.counts
         try:
@@ -352,7 +352,7 @@ class IntBoxplot(object):
         except KeyError:
             counts[category] = IntCounter()
             cat_counts = counts[category]
-        cat_counts[value] += 1
+        cat_counts[value] += count
 
     @property
     def aggregated_array(self):
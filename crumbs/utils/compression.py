@@ -0,0 +1,416 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+'''
+Threaded gzip, bgzf and bzip2 readers and parallel gzip and bgzf writers.
+
+The decompression is done in a background thread while the main thread
+parses the uncompressed data, the independent bgzf blocks are inflated by a
+pool of threads. The output is compressed in independent blocks by a pool
+of threads, bgzf blocks or gzip members. zlib and bz2 release the GIL, so
+the threads run in parallel.
+'''
+
+import sys
+import zlib
+import bz2
+import struct
+import atexit
+import errno
+import weakref
+import threading
+from Queue import Queue
+from collections import deque
+from itertools import islice
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from crumbs.settings import get_setting
+
+# pylint: disable=C0111
+
+_READ_SIZE = 1024 * 1024
+_QUEUE_SIZE = 4
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_BGZF_BLOCKS_PER_CHUNK = 64
+
+GZIP_MAGIC = '\037\213'
+BZIP2_MAGIC = 'BZ'
+BGZF_HEADER_SIZE = 18
+_BGZF_MAGIC = '\037\213\010\004'
+# the maximum uncompressed size of a bgzf block used by htslib
+_BGZF_BLOCK_SIZE = 0xff00
+_GZIP_BLOCK_SIZE = 1024 * 1024
+_TRUNCATED_MSG = 'Compressed file ended before the end-of-stream marker '
+_TRUNCATED_MSG += 'was reached'
+BGZF_EOF = ('\037\213\010\004\000\000\000\000\000\377\006\000BC\002\000'
+             '\033\000\003\000\000\000\000\000\000\000\000\000')
+
+
+def is_bgzf(header):
+    'It checks if the first bytes of a file are a bgzf header'
+    return header[:4] == _BGZF_MAGIC and header[12:14] == 'BC'
+
+
+def read_bgzf_raw_block(fhand):
+    'It returns the next compressed bgzf block or None at the end'
+    header = fhand.read(BGZF_HEADER_SIZE)
+    if not header:
+        return None
+    if not is_bgzf(header):
+        raise IOError('Malformed bgzf block')
+    block_size = struct.unpack('<H', header[16:18])[0] + 1
+    return header + fhand.read(block_size - BGZF_HEADER_SIZE)
+
+
+def inflate_bgzf_block(raw_block):
+    'It returns the uncompressed data of a bgzf block'
+    # the deflated data is followed by the crc32 and the data size
+    return zlib.decompress(raw_block[BGZF_HEADER_SIZE:-8], -15)
+
+
+def _gzip_chunks(fhand):
+    'It yields the uncompressed data of all gzip members'
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    member_ended = False
+    while True:
+        data = fhand.read(_READ_SIZE)
+        if not data:
+            break
+        while data:
+            if member_ended:
+                # gzip files can be padded with zeroes, as gzip.py allows
+                data = data.lstrip('\0')
+                if not data:
+                    break
+                # other gzip member starts
+                decompressor = zlib.decompressobj(_GZIP_WBITS)
+                member_ended = False
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                member_ended = True
+    if member_ended:
+        return
+    # a finished member does not consume more data
+    try:
+        decompressor.decompress('\0')
+    except zlib.error:
+        pass
+    if not decompressor.unused_data:
+        raise EOFError(_TRUNCATED_MSG)
+
+
+def _bz2_chunks(fhand):
+    'It yields the uncompressed data of all bzip2 streams'
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        data = fhand.read(_READ_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # other bzip2 stream starts
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return
+    raise EOFError(_TRUNCATED_MSG)
+
+
+def _bgzf_chunks(fhand, pool):
+    'It yields the uncompressed data, the blocks are inflated in parallel'
+    raw_blocks = iter(lambda: read_bgzf_raw_block(fhand), None)
+    while True:
+        blocks = list(islice(raw_blocks, _BGZF_BLOCKS_PER_CHUNK))
+        if not blocks:
+            break
+        yield ''.join(pool.map(inflate_bgzf_block, blocks))
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+_END = object()
+
+
+class ThreadedReader(object):
+    '''A file like object with the data decompressed in a background thread.
+
+    It is not seekable, it reads forward only.
+    '''
+    def __init__(self, fhand, chunks, pool=None):
+        self.fhand = fhand
+        self.name = getattr(fhand, 'name', None)
+        self.mode = 'rb'
+        self._pool = pool
+        self._queue = Queue(_QUEUE_SIZE)
+        self._closed = False
+        self._lines = []
+        self._line_idx = 0
+        self._partial = ''
+        self._eof = False
+        thread = threading.Thread(target=self._feed, args=(chunks,))
+        thread.daemon = True
+        thread.start()
+
+    def _feed(self, chunks):
+        try:
+            for chunk in chunks:
+                if self._closed:
+                    return
+                self._queue.put(chunk)
+            self._queue.put(_END)
+        except Exception:
+            self._queue.put(_Failure(sys.exc_info()))
+
+    def _next_chunk(self):
+        chunk = self._queue.get()
+        if chunk is _END:
+            return None
+        if isinstance(chunk, _Failure):
+            exc_type, exc_value, traceback = chunk.exc_info
+            raise exc_type, exc_value, traceback
+        return chunk
+
+    def _load_lines(self):
+        'It splits the next chunk in lines, it returns False at the end'
+        while not self._eof:
+            chunk = self._next_chunk()
+            if chunk is None:
+                self._eof = True
+                data = self._partial
+                cut = len(data)
+            else:
+                data = self._partial + chunk
+                cut = data.rfind('\n') + 1
+            self._partial = data[cut:]
+            if cut:
+                self._lines = StringIO(data[:cut]).readlines()
+                self._line_idx = 0
+                return True
+        return False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._line_idx >= len(self._lines) and not self._load_lines():
+            raise StopIteration()
+        line = self._lines[self._line_idx]
+        self._line_idx += 1
+        return line
+
+    def readline(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return ''
+
+    def readlines(self):
+        return list(self)
+
+    def _rebuffer(self, size):
+        'It returns at least size bytes of unread data, all if size < 0'
+        data = [''.join(self._lines[self._line_idx:]), self._partial]
+        data_size = sum(len(chunk) for chunk in data)
+        while (size < 0 or data_size < size) and not self._eof:
+            chunk = self._next_chunk()
+            if chunk is None:
+                self._eof = True
+            else:
+                data.append(chunk)
+                data_size += len(chunk)
+        self._lines = []
+        self._line_idx = 0
+        return ''.join(data)
+
+    def peek(self, size=1):
+        data = self._rebuffer(size)
+        self._partial = data
+        return data
+
+    def read(self, size=-1):
+        data = self._rebuffer(size)
+        if size < 0:
+            self._partial = ''
+            return data
+        self._partial = data[size:]
+        return data[:size]
+
+    def fileno(self):
+        return self.fhand.fileno()
+
+    def close(self):
+        self._closed = True
+        # the feeding thread could be waiting for room in the queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        if self._pool is not None:
+            self._pool.terminate()
+        self.fhand.close()
+
+
+def _get_num_threads():
+    return max(1, int(get_setting('COMPRESSION_THREADS')))
+
+
+def open_decompressed(fhand, magic):
+    '''It returns a threaded reader for a compressed fhand.
+
+    magic are the first bytes of the file.
+    '''
+    if is_bgzf(magic):
+        pool = ThreadPool(_get_num_threads())
+        return ThreadedReader(fhand, _bgzf_chunks(fhand, pool), pool=pool)
+    elif magic.startswith(GZIP_MAGIC):
+        return ThreadedReader(fhand, _gzip_chunks(fhand))
+    elif magic.startswith(BZIP2_MAGIC):
+        return ThreadedReader(fhand, _bz2_chunks(fhand))
+    raise ValueError('Unknown compression')
+
+
+# the bins do not always close the output
+_OPEN_WRITERS = weakref.WeakSet()
+
+
+def _close_open_writers():
+    for writer in list(_OPEN_WRITERS):
+        writer.close()
+
+
+atexit.register(_close_open_writers)
+
+
+def _gzip_member(data, bgzf):
+    'It compresses the data into an independent gzip member'
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    if bgzf:
+        # the extra field keeps the size of the block
+        block_size = BGZF_HEADER_SIZE + len(deflated) + 8
+        header = _BGZF_MAGIC + '\000\000\000\000\000\377\006\000BC\002\000'
+        header += struct.pack('<H', block_size - 1)
+    else:
+        header = GZIP_MAGIC + '\010\000\000\000\000\000\000\377'
+    return header + deflated + trailer
+
+
+def _bgzf_block(data):
+    return _gzip_member(data, bgzf=True)
+
+
+def _gzip_block(data):
+    return _gzip_member(data, bgzf=False)
+
+
+class ParallelCompressedWriter(object):
+    '''A file like object that compresses the data in parallel blocks.
+
+    The blocks are bgzf blocks or gzip members, both can be read by any
+    gzip reader. Every flush writes complete blocks, so the flushed file is
+    always valid.
+    '''
+    def __init__(self, fhand, bgzf=False, num_threads=None):
+        self.fhand = fhand
+        self.name = getattr(fhand, 'name', None)
+        self.mode = 'wb'
+        self.bgzf = bgzf
+        if bgzf:
+            self._block_size = _BGZF_BLOCK_SIZE
+            self._compress = _bgzf_block
+        else:
+            self._block_size = _GZIP_BLOCK_SIZE
+            self._compress = _gzip_block
+        if num_threads is None:
+            num_threads = _get_num_threads()
+        self._num_threads = num_threads
+        self._pool = None
+        self._pending = deque()
+        self._buffer = []
+        self._buffer_size = 0
+        self.closed = False
+        _OPEN_WRITERS.add(self)
+
+    def _submit(self, data):
+        if self._pool is None:
+            self._pool = ThreadPool(self._num_threads)
+        self._pending.append(self._pool.apply_async(self._compress, (data,)))
+        # the blocks are written in order as soon as they are ready
+        pending = self._pending
+        while pending and (pending[0].ready() or
+                           len(pending) > 2 * self._num_threads):
+            self.fhand.write(pending.popleft().get())
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size < self._block_size:
+            return
+        data = ''.join(self._buffer)
+        block_size = self._block_size
+        num_full = len(data) // block_size * block_size
+        for start in range(0, num_full, block_size):
+            self._submit(data[start:start + block_size])
+        rest = data[num_full:]
+        self._buffer = [rest] if rest else []
+        self._buffer_size = len(rest)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._buffer_size:
+            self._submit(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_size = 0
+        while self._pending:
+            self.fhand.write(self._pending.popleft().get())
+        self.fhand.flush()
+
+    def fileno(self):
+        return self.fhand.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            if self.bgzf:
+                self.fhand.write(BGZF_EOF)
+            self.fhand.close()
+        except IOError as error:
+            # the reader of the pipe could be already gone
+            if error.errno != errno.EPIPE:
+                raise
+        finally:
+            self.closed = True
+            _OPEN_WRITERS.discard(self)
+            if self._pool is not None:
+                self._pool.close()
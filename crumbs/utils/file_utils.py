@@ -13,23 +13,29 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+import time
 import tempfile
 import shutil
 import io
 import os.path
-
-from gzip import GzipFile
+from threading import Thread
+from Queue import Queue
 
 from subprocess import check_call, Popen, PIPE
 
 
-from crumbs.utils.optional_modules import BgzfWriter
 from crumbs.utils.tags import BGZF, GZIP, BZIP2
+from crumbs.utils.compression import (open_decompressed,
+                                      ParallelCompressedWriter,
+                                      BGZF_HEADER_SIZE, GZIP_MAGIC,
+                                      BZIP2_MAGIC)
 try:
     from crumbs.utils import BZ2File
 except ImportError:
     pass
 from crumbs.exceptions import OptionalRequirementError
+from crumbs.settings import get_setting
 
 
 DEF_FILE_BUFFER = 8192*4
@@ -85,15 +91,13 @@ BZIP_ERROR += 'bzip2 files'
 
 
 def uncompress_if_required(fhand):
-    'It returns a uncompressed handle if required'
-    magic = peek_chunk_from_file(fhand, 2)
-    if magic == '\037\213':
-        fhand = GzipFile(fileobj=fhand)
-    elif magic == 'BZ':
-        try:
-            fhand = BZ2File(fhand)
-        except NameError:
-            raise OptionalRequirementError(BZIP_ERROR)
+    '''It returns a uncompressed handle if required.
+
+    The data is decompressed in a background thread, it works with stdin.
+    '''
+    magic = peek_chunk_from_file(fhand, BGZF_HEADER_SIZE)
+    if magic.startswith(GZIP_MAGIC) or magic.startswith(BZIP2_MAGIC):
+        fhand = open_decompressed(fhand, magic)
     return fhand
 
 
@@ -101,11 +105,11 @@ def compress_fhand(fhand, compression_kind=None):
     'Compresses the file if required'
     if compression_kind == BGZF:
         if fhand_is_seekable(fhand):
-            fhand = BgzfWriter(fileobj=fhand)
+            fhand = ParallelCompressedWriter(fhand, bgzf=True)
         else:
             raise RuntimeError('bgzf is only available for seekable files')
     elif compression_kind == GZIP:
-        fhand = GzipFile(fileobj=fhand)
+        fhand = ParallelCompressedWriter(fhand)
     elif compression_kind == BZIP2:
         mode = 'w' if 'w' in fhand.mode else 'r'
         try:
@@ -182,6 +186,46 @@ def rel_symlink(path1, path2):
         os.rmdir(temp_dir)
 
 
+def evict_cache_files(cache_dir, max_size):
+    '''It removes the least recently used files above the disk budget.
+
+    The modification time of the cached files is taken as their last use.
+    The temporary files being written are not removed.
+    '''
+    entries = []
+    try:
+        fnames = os.listdir(cache_dir)
+    except OSError:
+        return
+    for fname in fnames:
+        if fname.endswith('.tmp'):
+            continue
+        fpath = os.path.join(cache_dir, fname)
+        try:
+            stat_ = os.stat(fpath)
+        except OSError:
+            # another process could have removed it
+            continue
+        entries.append((stat_.st_mtime, fpath, stat_.st_size))
+    total_size = sum(entry[2] for entry in entries)
+    for _, fpath, size in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(fpath)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def touch_cache_file(fpath):
+    'It marks the cached file as recently used'
+    try:
+        os.utime(fpath, None)
+    except OSError:
+        pass
+
+
 def flush_fhand(fhand):
     try:
         fhand.flush()
@@ -191,6 +235,118 @@ def flush_fhand(fhand):
             raise
 
 
+class AsyncWriter(object):
+    '''It writes the given buffers to a file in a background thread.
+
+    The buffers wait in a bounded queue, so the next buffer is prepared
+    while the previous one is being written (double buffering).
+    If the pipe is closed the rest of the buffers are discarded. Any other
+    error is raised by the following write, flush or close.
+    The wrapped file is flushed by close, but it is not closed.
+    '''
+    def __init__(self, fhand, queue_size=None):
+        if queue_size is None:
+            queue_size = get_setting('WRITER_QUEUE_SIZE')
+        self.fhand = fhand
+        self._queue = Queue(int(queue_size))
+        self._error = None
+        self._discard = False
+        self.broken_pipe = False
+        self.bytes_written = 0
+        self.max_queue_depth = 0
+        self._start_time = time.time()
+        self._end_time = None
+        self._thread = Thread(target=self._write_buffers)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_buffers(self):
+        while True:
+            buff = self._queue.get()
+            try:
+                if buff is None:
+                    return
+                if self._discard or self.broken_pipe or self._error:
+                    continue
+                try:
+                    self.fhand.write(buff)
+                    self.bytes_written += len(buff)
+                except IOError, error:
+                    # The pipe could be already closed
+                    if 'Broken pipe' in str(error):
+                        self.broken_pipe = True
+                    else:
+                        self._error = sys.exc_info()
+                except Exception:
+                    self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            exc_type, exc_value, traceback = self._error
+            self._error = None
+            raise exc_type, exc_value, traceback
+
+    def write(self, buff):
+        self._raise_error()
+        if self._end_time is not None:
+            raise ValueError('I/O operation on closed writer')
+        if not buff:
+            return
+        self._queue.put(buff)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _flush_fhand(self):
+        if self.broken_pipe:
+            return
+        try:
+            self.fhand.flush()
+        except IOError, error:
+            # The pipe could be already closed
+            if 'Broken pipe' not in str(error):
+                raise
+            self.broken_pipe = True
+
+    def flush(self):
+        self._queue.join()
+        self._raise_error()
+        self._flush_fhand()
+
+    def _stop(self):
+        if self._end_time is None:
+            self._queue.put(None)
+            self._thread.join()
+            self._end_time = time.time()
+
+    def close(self):
+        'It writes the pending buffers and it stops the thread'
+        self._stop()
+        self._raise_error()
+        self._flush_fhand()
+
+    def abort(self):
+        'It stops the thread discarding the pending buffers'
+        self._discard = True
+        self._stop()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def stats(self):
+        'It returns the bytes written, the bytes/sec and the queue depths'
+        end_time = time.time() if self._end_time is None else self._end_time
+        elapsed = end_time - self._start_time
+        bytes_per_sec = self.bytes_written / elapsed if elapsed else 0.0
+        return {'bytes_written': self.bytes_written,
+                'bytes_per_sec': bytes_per_sec,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'broken_pipe': self.broken_pipe}
+
+
 def compress_with_bgzip(in_fhand, compressed_fhand):
     '''It compresses the input fhand.
 
@@ -238,27 +394,13 @@ def _vcf_is_gz(fhand):
         raise RuntimeError(msg)
 
 
-def _fhand_is_tellable(fhand):
-    try:
-        fhand.tell()
-        tellable = True
-    except IOError:
-        tellable = False
-    return tellable
-
-
 def get_input_fhand(in_fhand):
     in_fhand = wrap_in_buffered_reader(in_fhand, buffering=DEF_FILE_BUFFER)
 
     in_compressed = _vcf_is_gz(in_fhand)
-    if in_compressed and not _fhand_is_tellable(in_fhand):
-        msg = 'The given input has no tell member and it is compressed. '
-        msg += 'You cannot use gzip file through stdin, try to pipe it '
-        msg += 'uncompressed with zcat |'
-        raise RuntimeError(msg)
-
     if in_compressed:
-        mod_in_fhand = GzipFile(fileobj=in_fhand)
+        magic = peek_chunk_from_file(in_fhand, BGZF_HEADER_SIZE)
+        mod_in_fhand = open_decompressed(in_fhand, magic)
     else:
         mod_in_fhand = in_fhand
 
@@ -0,0 +1,322 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+'''
+A persistent cache for the mapper and blast indexes.
+
+The indexes are stored in a cache directory keyed by a hash of the contents
+of the sequence file, the index kind and the version of the tool used to
+build them, so the same reference is indexed only once, no matter its path.
+An index in use is locked, so it can not be evicted by other process.
+'''
+
+import os
+import shutil
+import fcntl
+import hashlib
+from subprocess import PIPE
+from tempfile import mkdtemp
+from contextlib import contextmanager
+
+from crumbs.settings import get_setting
+from crumbs.utils.bin_utils import popen
+
+# pylint: disable=C0111
+
+_READY_MARK = '.ready'
+_LOCK_EXT = '.lock'
+_BUILD_PREFIX = '.building_'
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+_TOOL_VERSIONS = {}
+_FILE_HASHES = {}
+
+
+def get_tool_version(binary, version_args):
+    '''It returns the version line reported by the given binary.
+
+    If the version can not be found an empty string is returned, the index
+    will be cached anyway.
+    '''
+    key = binary, tuple(version_args)
+    if key in _TOOL_VERSIONS:
+        return _TOOL_VERSIONS[key]
+    try:
+        process = popen([binary] + list(version_args), stdout=PIPE,
+                        stderr=PIPE)
+        stdout, stderr = process.communicate()
+    except Exception:
+        stdout, stderr = '', ''
+    version = ''
+    for line in (stdout + stderr).splitlines():
+        if 'version' in line.lower():
+            version = line.strip()
+            break
+    _TOOL_VERSIONS[key] = version
+    return version
+
+
+def hash_file(fpath):
+    'It returns the sha1 of the file contents'
+    stat = os.stat(fpath)
+    key = os.path.abspath(fpath), stat.st_size, stat.st_mtime
+    if key in _FILE_HASHES:
+        return _FILE_HASHES[key]
+    sha1 = hashlib.sha1()
+    with open(fpath, 'rb') as fhand:
+        while True:
+            chunk = fhand.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+    _FILE_HASHES[key] = digest
+    return digest
+
+
+def _get_dir_size(dir_path):
+    size = 0
+    for root, _, files in os.walk(dir_path):
+        for file_ in files:
+            fpath = os.path.join(root, file_)
+            if not os.path.islink(fpath):
+                size += os.path.getsize(fpath)
+    return size
+
+
+class _FileLock(object):
+    '''A lock based in flock, it can be shared by processes.
+
+    The process that holds the exclusive lock can remove the lock file, so
+    the lock is taken again if the locked file is no longer in its path.
+    '''
+    def __init__(self, fpath, shared=False, blocking=True):
+        self.fpath = fpath
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            fhand = open(fpath, 'a')
+            try:
+                fcntl.flock(fhand, flags)
+            except IOError:
+                fhand.close()
+                raise
+            try:
+                locked = os.path.samestat(os.fstat(fhand.fileno()),
+                                          os.stat(fpath))
+            except OSError:
+                locked = False
+            if locked:
+                break
+            fhand.close()
+        self._fhand = fhand
+
+    def remove(self):
+        'It removes the lock file, the lock has to be exclusive'
+        os.remove(self.fpath)
+
+    def release(self):
+        if not self._fhand.closed:
+            fcntl.flock(self._fhand, fcntl.LOCK_UN)
+            self._fhand.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class IndexCache(object):
+    '''A content addressed cache of indexes.
+
+    Every index is built once in its own directory. The concurrent
+    processes that ask for the same index wait for the first one to build
+    it. The indexes are locked in shared mode while they are used. When the
+    cache goes above its disk budget the least recently used indexes that
+    are not in use are removed.
+    '''
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = get_setting('INDEX_CACHE_DIR')
+        if max_size is None:
+            max_size = get_setting('INDEX_CACHE_MAX_SIZE')
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size)
+        # the shared locks of the indexes in use and their number of users
+        self._in_use = {}
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another process could have created it
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _get_lock_fpath(self, key):
+        return self._get_entry_dir(key) + _LOCK_EXT
+
+    def _build(self, key, seq_fpath, builder):
+        'It builds the index in a temporary dir and it moves it to its entry'
+        entry_dir = self._get_entry_dir(key)
+        if os.path.exists(entry_dir):
+            # a previous build has failed
+            shutil.rmtree(entry_dir)
+        build_dir = mkdtemp(dir=self.cache_dir,
+                            prefix='{}{}.'.format(_BUILD_PREFIX, key))
+        try:
+            build_index_fpath = os.path.join(build_dir,
+                                             os.path.basename(seq_fpath))
+            builder(seq_fpath, build_index_fpath)
+            # the ready mark keeps the entry size, so it is measured once
+            size = _get_dir_size(build_dir)
+            with open(os.path.join(build_dir, _READY_MARK), 'w') as fhand:
+                fhand.write(str(size))
+            os.rename(build_dir, entry_dir)
+        except:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+
+    def get_or_create(self, seq_fpath, kind, builder, version=''):
+        '''It returns the path to the index, it creates it if required.
+
+        builder is a function that takes the sequence file path and the
+        index path and it creates the index.
+        The index path has the sequence file basename in the index dir.
+        The index is locked in shared mode, so no process can evict it,
+        until it is released or the process ends.
+        '''
+        seq_hash = hash_file(seq_fpath)
+        key = hashlib.sha1('\t'.join([kind, version, seq_hash])).hexdigest()
+        key = '{}_{}'.format(kind, key)
+        entry_dir = self._get_entry_dir(key)
+        index_fpath = os.path.join(entry_dir, os.path.basename(seq_fpath))
+        if key in self._in_use:
+            self._in_use[key][1] += 1
+            return index_fpath
+
+        ready_fpath = os.path.join(entry_dir, _READY_MARK)
+        lock_fpath = self._get_lock_fpath(key)
+        built = False
+        while True:
+            lock = _FileLock(lock_fpath, shared=True)
+            if os.path.exists(ready_fpath):
+                break
+            lock.release()
+            with _FileLock(lock_fpath):
+                if not os.path.exists(ready_fpath):
+                    self._build(key, seq_fpath, builder)
+                    built = True
+        # the ready mark modification time keeps the last use
+        os.utime(ready_fpath, None)
+        self._in_use[key] = [lock, 1]
+        # the cache only grows when an index is built
+        if built:
+            self.evict()
+        return index_fpath
+
+    def release(self, index_fpath):
+        'It releases the index taken by get_or_create'
+        key = os.path.basename(os.path.dirname(index_fpath))
+        lock_and_users = self._in_use[key]
+        lock_and_users[1] -= 1
+        if not lock_and_users[1]:
+            lock_and_users[0].release()
+            del self._in_use[key]
+
+    @contextmanager
+    def use_index(self, seq_fpath, kind, builder, version=''):
+        'It yields the index path, the index is released at the end'
+        index_fpath = self.get_or_create(seq_fpath, kind, builder,
+                                         version=version)
+        try:
+            yield index_fpath
+        finally:
+            self.release(index_fpath)
+
+    def _get_entries(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._get_entry_dir(key)
+            ready_fpath = os.path.join(entry_dir, _READY_MARK)
+            try:
+                mtime = os.path.getmtime(ready_fpath)
+                size = open(ready_fpath).read().strip()
+            except (IOError, OSError):
+                continue
+            size = int(size) if size.isdigit() else _get_dir_size(entry_dir)
+            entries.append((mtime, key, size))
+        return entries
+
+    def _reap(self):
+        'It removes the builds of dead processes and the orphan lock files'
+        for fname in os.listdir(self.cache_dir):
+            if fname.startswith(_BUILD_PREFIX):
+                key = fname[len(_BUILD_PREFIX):].rsplit('.', 1)[0]
+            elif fname.endswith(_LOCK_EXT):
+                key = fname[:-len(_LOCK_EXT)]
+                if os.path.exists(self._get_entry_dir(key)):
+                    continue
+            else:
+                continue
+            try:
+                lock = _FileLock(self._get_lock_fpath(key), blocking=False)
+            except IOError:
+                # it is being built or used
+                continue
+            with lock:
+                if fname.startswith(_BUILD_PREFIX):
+                    shutil.rmtree(os.path.join(self.cache_dir, fname),
+                                  ignore_errors=True)
+                if not os.path.exists(self._get_entry_dir(key)):
+                    lock.remove()
+
+    def evict(self):
+        'It removes the least recently used indexes above the disk budget'
+        self._reap()
+        entries = self._get_entries()
+        total_size = sum(entry[2] for entry in entries)
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                lock = _FileLock(self._get_lock_fpath(key), blocking=False)
+            except IOError:
+                # it is being built or used by some process
+                continue
+            with lock:
+                shutil.rmtree(self._get_entry_dir(key), ignore_errors=True)
+                lock.remove()
+            total_size -= size
+
+
+_INDEX_CACHES = {}
+
+
+def get_index_cache():
+    '''It returns the default index cache or None if it is disabled.
+
+    The same cache is returned to every caller, so the indexes used by the
+    process are kept locked until it ends.
+    '''
+    cache_dir = get_setting('INDEX_CACHE_DIR')
+    if not cache_dir:
+        return None
+    if cache_dir not in _INDEX_CACHES:
+        _INDEX_CACHES[cache_dir] = IndexCache(cache_dir)
+    return _INDEX_CACHES[cache_dir]
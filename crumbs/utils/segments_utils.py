@@ -13,11 +13,9 @@
 # You should have received a copy of the GNU General Public License
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
-from operator import itemgetter
 import random
-import copy
 
-from crumbs.utils.tags import START, END
+import numpy
 
 
 def get_all_segments(segments, seq_len):
@@ -27,28 +25,29 @@ def get_all_segments(segments, seq_len):
     output: ---+----+++++++----
 
     '''
-    segments_ = copy.deepcopy(segments)
-    if not segments_:
+    if not segments:
         return [((0, seq_len - 1), False)]
 
     all_segments = []
     # If the first segment doesn't start at zero we create a new one
-    if segments_[0][0] == 0:
-        start = segments_[0][1] + 1
-        all_segments.append((segments_.pop(0), True))
+    if segments[0][0] == 0:
+        start = segments[0][1] + 1
+        all_segments.append((segments[0], True))
+        first_index = 1
     else:
         start = 0
+        first_index = 0
 
-    for loc in segments_:
+    for index in xrange(first_index, len(segments)):
+        loc = segments[index]
         all_segments.append(((start, loc[0] - 1), False))
         all_segments.append((loc, True))
         start = loc[1] + 1
-    else:
-        # if the last segment does not ends at the end of the sequence we add
-        # an extra one
-        end = seq_len - 1
-        if start <= end:
-            all_segments.append(((start, end), False))
+    # if the last segment does not ends at the end of the sequence we add
+    # an extra one
+    end = seq_len - 1
+    if start <= end:
+        all_segments.append(((start, end), False))
     return all_segments
 
 
@@ -106,52 +105,175 @@ def merge_overlaping_segments(segments, merge_segments_closer=1):
        number of residues will be merged.
     '''
 
-    # we collect all start and ends
-    limits = []
+    # we order the segments by their start
+    sorted_segments = []
     for segment in segments:
         start = segment[0]
         end = segment[1]
         if start > end:  # a reversed item
             start, end = end, start
-        limit_1 = (START, start)
-        limit_2 = (END, end)
-        limits.append(limit_1)
-        limits.append(limit_2)
-
-    # sort by secondary key: start before end
-    limits.sort(key=itemgetter(0))
-    # sort by location (primary key)
-    limits.sort(key=itemgetter(1))
-
-    # merge the ends and start that differ in only one base
-    filtered_limits = []
-    previous_limit = None
-    for limit in limits:
-        if previous_limit is None:
-            previous_limit = limit
-            continue
-        if (previous_limit[0] == END and limit[0] == START and
-            previous_limit[1] >= limit[1] - merge_segments_closer):
-            # These limits cancelled each other
-            previous_limit = None
-            continue
-        filtered_limits.append(previous_limit)
-        previous_limit = limit
-    else:
-        filtered_limits.append(limit)
-    limits = filtered_limits
-
-    # now we create the merged hsps
-    starts = 0
-    segments = []
-    for limit in limits:
-        if limit[0] == START:
-            starts += 1
-            if starts == 1:
-                segment_start = limit[1]
-        elif limit[0] == END:
-            starts -= 1
-            if starts == 0:
-                segment = (segment_start, limit[1])
-                segments.append(segment)
-    return segments
+        sorted_segments.append((start, end))
+    sorted_segments.sort()
+
+    # we extend the ongoing segment while the next one overlaps it or it is
+    # close enough
+    merged_segments = []
+    segment_start, segment_end = None, None
+    for start, end in sorted_segments:
+        if segment_start is None:
+            segment_start, segment_end = start, end
+        elif start <= segment_end + merge_segments_closer:
+            if end > segment_end:
+                segment_end = end
+        else:
+            merged_segments.append((segment_start, segment_end))
+            segment_start, segment_end = start, end
+    if segment_start is not None:
+        merged_segments.append((segment_start, segment_end))
+    return merged_segments
+
+
+# The batch functions work with the segments of many sequences at once.
+# The segments are kept in three numpy arrays: the index of the sequence
+# (group), the starts and the ends. The merged segments are sorted by group
+# and start.
+
+def _segments_to_arrays(segments_list):
+    'It returns the group, start and end arrays for the given segments'
+    n_segments = [len(segments) for segments in segments_list]
+    groups = numpy.repeat(numpy.arange(len(segments_list)), n_segments)
+    limits = [limit for segments in segments_list for segment in segments
+                                                  for limit in segment[:2]]
+    limits = numpy.array(limits, dtype=int).reshape(-1, 2)
+    return groups, limits[:, 0], limits[:, 1]
+
+
+def _arrays_to_segments(groups, starts, ends, n_groups):
+    'It returns a list of segments for every group'
+    segments_list = [[] for _ in xrange(n_groups)]
+    for group, start, end in zip(groups.tolist(), starts.tolist(),
+                                 ends.tolist()):
+        segments_list[group].append((start, end))
+    return segments_list
+
+
+def _merge_arrays(groups, starts, ends, merge_segments_closer=1):
+    'It merges the overlaping segments of every group'
+    if not starts.size:
+        return groups, starts, ends
+    reversed_ = starts > ends
+    starts, ends = (numpy.where(reversed_, ends, starts),
+                    numpy.where(reversed_, starts, ends))
+
+    # The groups are moved apart, so their segments never overlap and all
+    # of them can be merged at once
+    span = ends.max() - starts.min() + abs(merge_segments_closer) + 2
+    shifts = groups * span
+    starts = starts + shifts
+    ends = ends + shifts
+    order = numpy.lexsort((ends, starts))
+    starts, ends, shifts = starts[order], ends[order], shifts[order]
+
+    reached_ends = numpy.maximum.accumulate(ends)
+    new_segment = numpy.empty(starts.shape, dtype=bool)
+    new_segment[0] = True
+    new_segment[1:] = starts[1:] > reached_ends[:-1] + merge_segments_closer
+    first_indexes = numpy.flatnonzero(new_segment)
+    merged_ends = numpy.maximum.reduceat(ends, first_indexes)
+    shifts = shifts[first_indexes]
+    return (shifts // span, starts[first_indexes] - shifts,
+            merged_ends - shifts)
+
+
+def _complement_arrays(groups, starts, ends, seq_lens):
+    'Given merged segments it returns the not covered segments'
+    seq_lens = numpy.asarray(seq_lens, dtype=int)
+    n_groups = seq_lens.size
+    # the regions before every segment
+    first_in_group = numpy.ones(groups.shape, dtype=bool)
+    first_in_group[1:] = groups[1:] != groups[:-1]
+    prev_ends = numpy.empty(ends.shape, dtype=int)
+    prev_ends[1:] = ends[:-1]
+    prev_ends[first_in_group] = -1
+
+    # the regions after the last segment of every group
+    last_in_group = numpy.ones(groups.shape, dtype=bool)
+    last_in_group[:-1] = groups[:-1] != groups[1:]
+    last_ends = numpy.full(n_groups, -1, dtype=int)
+    last_ends[groups[last_in_group]] = ends[last_in_group]
+
+    groups = numpy.concatenate((groups, numpy.arange(n_groups)))
+    starts, ends = (numpy.concatenate((prev_ends + 1, last_ends + 1)),
+                    numpy.concatenate((starts - 1, seq_lens - 1)))
+    not_empty = starts <= ends
+    groups, starts, ends = groups[not_empty], starts[not_empty], ends[not_empty]
+    order = numpy.lexsort((starts, groups))
+    return groups[order], starts[order], ends[order]
+
+
+def merge_overlaping_segments_in_batch(segments_list, merge_segments_closer=1):
+    '''It merges the overlaping segments for a list of segment lists.
+
+    It is equivalent to calling merge_overlaping_segments for every segment
+    list, but it is faster for big batches.
+    '''
+    groups, starts, ends = _merge_arrays(*_segments_to_arrays(segments_list),
+                                 merge_segments_closer=merge_segments_closer)
+    return _arrays_to_segments(groups, starts, ends, len(segments_list))
+
+
+def get_complementary_segments_in_batch(segments_list, seq_lens):
+    'It returns the regions not covered by the segments for every sequence'
+    groups, starts, ends = _merge_arrays(*_segments_to_arrays(segments_list))
+    groups, starts, ends = _complement_arrays(groups, starts, ends, seq_lens)
+    return _arrays_to_segments(groups, starts, ends, len(segments_list))
+
+
+def intersect_segments_in_batch(segments_list1, segments_list2, seq_lens):
+    '''It returns the regions covered by both segment lists.
+
+    segments_list1 and segments_list2 have the segments for the same
+    sequences.
+    '''
+    if len(segments_list1) != len(segments_list2):
+        raise ValueError('Both segment lists should have the same length')
+    # the intersection is the complement of the complements union
+    complements = []
+    for segments_list in (segments_list1, segments_list2):
+        groups, starts, ends = _merge_arrays(
+                                        *_segments_to_arrays(segments_list))
+        complements.append(_complement_arrays(groups, starts, ends, seq_lens))
+    groups, starts, ends = [numpy.concatenate(arrays)
+                                              for arrays in zip(*complements)]
+    groups, starts, ends = _merge_arrays(groups, starts, ends)
+    groups, starts, ends = _complement_arrays(groups, starts, ends, seq_lens)
+    # the segments could go beyond the sequence end
+    ends = numpy.minimum(ends, numpy.asarray(seq_lens, dtype=int)[groups] - 1)
+    inside = starts <= ends
+    return _arrays_to_segments(groups[inside], starts[inside], ends[inside],
+                               len(segments_list1))
+
+
+def get_longest_complementary_segment_in_batch(segments_list, seq_lens):
+    '''It returns the longest region not covered for every sequence.
+
+    It is the batch version of get_longest_complementary_segment, None is
+    returned for the sequences completely covered.
+    '''
+    n_groups = len(segments_list)
+    groups, starts, ends = _merge_arrays(*_segments_to_arrays(segments_list))
+    groups, starts, ends = _complement_arrays(groups, starts, ends, seq_lens)
+
+    # the ties are broken randomly, as get_longest_segment does
+    sizes = (ends - starts) + numpy.random.uniform(0, 0.5, size=starts.size)
+    order = numpy.lexsort((sizes, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+    longest = numpy.ones(groups.shape, dtype=bool)
+    longest[:-1] = groups[:-1] != groups[1:]
+
+    longest_segments = [None] * n_groups
+    for group, start, end in zip(groups[longest].tolist(),
+                                 starts[longest].tolist(),
+                                 ends[longest].tolist()):
+        longest_segments[group] = (start, end)
+    return longest_segments
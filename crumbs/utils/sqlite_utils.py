@@ -5,19 +5,83 @@ Created on 2014 aza 3
 '''
 import os
 import sqlite3
+from collections import OrderedDict
 import cPickle as pickle
 
+from crumbs.settings import get_setting
 
-class SqliteCache(object):
-    def __init__(self, fpath):
-        self._cache_table_name = 'cachedata'
-        self._fhand = None
-        if not os.path.exists(fpath):
-            self._fhand = open(fpath, 'w')
-            fpath = self._fhand.name
+_MAX_SQL_PARAMS = 500
+# the store can grow this fraction above max_size before being evicted
+_EVICTION_SLACK = 0.1
+
+
+def _dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _loads(value):
+    return pickle.loads(str(value))
+
+
+class SqliteStore(object):
+    '''A key-value store kept in an sqlite table.
+
+    The keys are the primary key of the table and the values are pickled.
+    The writes are grouped in transactions of commit_every items and, if
+    lru_size is given, the last values used are kept in memory as well.
+    If max_size is given the oldest written items are removed when the
+    pickled values take more than max_size bytes.
+    The SQL statements are always the same strings, so sqlite3 prepares
+    them just once.
+    '''
+    def __init__(self, fpath, table='store', key_type='TEXT', lru_size=0,
+                 max_size=None, commit_every=1, journal_mode='WAL',
+                 synchronous='NORMAL'):
+        self._table = table
+        self._key_type = key_type
+        self._lru_size = lru_size
+        self._lru = OrderedDict()
+        self._max_size = max_size
+        if max_size is None:
+            self._eviction_interval = None
+        else:
+            self._eviction_interval = max(1, int(max_size * _EVICTION_SLACK))
+        self._bytes_to_evict = 0
+        self._commit_every = commit_every
+        self._uncommitted = 0
 
         self.connection = sqlite3.connect(fpath)
-        self._create_init_table()
+        self.connection.execute('PRAGMA journal_mode={}'.format(journal_mode))
+        self.connection.execute('PRAGMA synchronous={}'.format(synchronous))
+        self._create_table()
+
+        self._get_sql = 'select value from {} where key = ?'.format(table)
+        self._set_sql = 'insert or replace into {} values(?, ?)'.format(table)
+        self._del_sql = 'delete from {} where key = ?'.format(table)
+        self._contains_sql = 'select 1 from {} where key = ?'.format(table)
+
+    def _create_table(self):
+        conn = self.connection
+        table = self._table
+        columns = conn.execute('PRAGMA table_info({})'.format(table))
+        pk_columns = [col[1] for col in columns if col[5]]
+        create = 'create table {} (key {} PRIMARY KEY, value BLOB)'
+        if not pk_columns:
+            exists = conn.execute("select 1 from sqlite_master where "
+                                  "type='table' and name=?", (table,))
+            if exists.fetchone():
+                # a table created without the primary key, we migrate it
+                tmp_table = table + '_with_pk'
+                conn.execute(create.format(tmp_table, self._key_type))
+                sql = 'insert or replace into {} select key, value from {} '
+                sql += 'order by rowid'
+                conn.execute(sql.format(tmp_table, table))
+                conn.execute('drop table {}'.format(table))
+                conn.execute('alter table {} rename to {}'.format(tmp_table,
+                                                                  table))
+            else:
+                conn.execute(create.format(table, self._key_type))
+        conn.commit()
 
     def __enter__(self):
         return self
@@ -27,66 +91,163 @@ class SqliteCache(object):
         if type:
             return 0
 
-    def _create_init_table(self):
-        c = self.connection.cursor()
-        c.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        result = c.fetchall()
-        if not result or self._cache_table_name not in result[0]:
-            sql = 'create table {table_name} (key TEXT, value BLOB)'
-            c.execute(sql.format(table_name=self._cache_table_name))
-        self.connection.commit()
+    def _remember(self, key, value):
+        lru = self._lru
+        if key in lru:
+            del lru[key]
+        lru[key] = value
+        if len(lru) > self._lru_size:
+            lru.popitem(last=False)
 
-    def __getitem__(self, key):
-        c = self.connection.cursor()
-        sql = "select * from {cache_table} where key = '{key}'"
-        c.execute(sql.format(key=key, cache_table=self._cache_table_name))
+    def get(self, key, default=None):
+        'It returns the value for the key or default if it is not found'
+        if self._lru_size:
+            try:
+                value = self._lru.pop(key)
+                self._lru[key] = value
+                return value
+            except KeyError:
+                pass
+        row = self.connection.execute(self._get_sql, (key,)).fetchone()
+        if row is None:
+            return default
+        value = _loads(row[0])
+        if self._lru_size:
+            self._remember(key, value)
+        return value
 
-        result = c.fetchall()
-        if not result:
-            return None
-        if len(result) > 1:
-            msg = 'More than one ocurrence of the key:{}'.format(key)
-            raise RuntimeError(msg)
+    def get_many(self, keys):
+        'It returns a dict with the values of the given keys found'
+        values = {}
+        keys_to_look = []
+        for key in keys:
+            if self._lru_size and key in self._lru:
+                values[key] = self._lru[key]
+            else:
+                keys_to_look.append(key)
+        # sqlite limits the number of parameters in a query
+        sql = 'select key, value from {} where key in ({})'
+        for index in range(0, len(keys_to_look), _MAX_SQL_PARAMS):
+            chunk = keys_to_look[index: index + _MAX_SQL_PARAMS]
+            chunk_sql = sql.format(self._table, ', '.join(['?'] * len(chunk)))
+            for key, value in self.connection.execute(chunk_sql, chunk):
+                value = _loads(value)
+                values[key] = value
+                if self._lru_size:
+                    self._remember(key, value)
+        return values
 
-        return pickle.loads(str(result[0][1]))
+    def _written(self, num_items, num_bytes=0):
+        self._uncommitted += num_items
+        self._bytes_to_evict += num_bytes
+        if self._uncommitted >= self._commit_every:
+            self.commit()
 
-    def __setitem__(self, key, value):
-        c = self.connection.cursor()
-        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
-        if key in self:
-            sql = "update {cache_table} set value = ? where key = ?"
-            sql = sql.format(cache_table=self._cache_table_name, key=key)
-            c.execute(sql, [sqlite3.Binary(value), key])
-        else:
-            sql = "insert into {cache_table} values(?, ?)"
-            sql = sql.format(cache_table=self._cache_table_name)
-            c.execute(sql, [key, sqlite3.Binary(value)])
+    def set(self, key, value):
+        'It sets the value of the key'
+        value_ = _dumps(value)
+        self.connection.execute(self._set_sql, (key, value_))
+        if self._lru_size:
+            self._remember(key, value)
+        self._written(1, len(value_))
+
+    def set_many(self, items):
+        'It sets several keys and values in one transaction'
+        items = list(items)
+        rows = [(key, _dumps(value)) for key, value in items]
+        self.connection.executemany(self._set_sql, rows)
+        if self._lru_size:
+            for key, value in items:
+                self._remember(key, value)
+        self._written(len(rows), sum(len(row[1]) for row in rows))
+        self.commit()
+
+    def delete(self, key):
+        'It removes the key from the store'
+        self.connection.execute(self._del_sql, (key,))
+        self._lru.pop(key, None)
+        self._written(1)
+
+    def __contains__(self, key):
+        if self._lru_size and key in self._lru:
+            return True
+        return bool(self.connection.execute(self._contains_sql,
+                                            (key,)).fetchone())
+
+    def __len__(self):
+        sql = 'select count(*) from {}'.format(self._table)
+        return self.connection.execute(sql).fetchone()[0]
+
+    def items(self, order_by='rowid'):
+        'It yields the keys and values in the order they were written'
+        sql = 'select key, value from {} order by {}'.format(self._table,
+                                                             order_by)
+        for key, value in self.connection.execute(sql):
+            yield key, _loads(value)
+
+    def get_size(self):
+        'It returns the bytes taken by the pickled values'
+        sql = 'select sum(length(value)) from {}'.format(self._table)
+        return self.connection.execute(sql).fetchone()[0] or 0
+
+    def evict(self):
+        'It removes the oldest written items above max_size'
+        self._bytes_to_evict = 0
+        if self._max_size is None or self.get_size() <= self._max_size:
+            return
+        # the rowid of the items replaced grows, so the oldest items are
+        # the ones with the lowest rowid
+        sql = 'select rowid, length(value) from {} order by rowid desc'
+        size = 0
+        for rowid, length in self.connection.execute(sql.format(self._table)):
+            size += length
+            if size > self._max_size:
+                break
+        sql = 'delete from {} where rowid <= ?'.format(self._table)
+        self.connection.execute(sql, (rowid,))
         self.connection.commit()
+        self._lru.clear()
+
+    def commit(self):
+        'It commits the pending writes'
+        self.connection.commit()
+        self._uncommitted = 0
+        if (self._eviction_interval is not None and
+                self._bytes_to_evict >= self._eviction_interval):
+            self.evict()
 
     def close(self):
-        if self._fhand is not None:
-            self._fhand.close()
+        self.commit()
         self.connection.close()
 
-    def __contains__(self, value):
-        c = self.connection.cursor()
-        sql = "select key from {cache_table} where key='{key}'"
-        c.execute(sql.format(cache_table=self._cache_table_name, key=value))
-        return True if c.fetchone() else False
+
+class SqliteCache(SqliteStore):
+    '''A persistent dict like cache.
+
+    The values of the keys not found are None.
+    '''
+    def __init__(self, fpath, lru_size=0, max_size=None, commit_every=1):
+        super(SqliteCache, self).__init__(fpath, table='cachedata',
+                                          lru_size=lru_size,
+                                          max_size=max_size,
+                                          commit_every=commit_every)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def update(self, items):
+        'It sets several keys and values in one transaction'
+        self.set_many(items)
 
     def dump(self):
-        c = self.connection.cursor()
-        sql = "select * from {}".format(self._cache_table_name)
-        for key, value in c.execute(sql):
-            value = pickle.loads(str(value))
-            yield key, value
+        return self.items()
 
     def __str__(self):
-        c = self.connection.cursor()
         text = None
-        sql = "select * from {}".format(self._cache_table_name)
-        for key, value in c.execute(sql):
-            value = pickle.loads(str(value))
+        for key, value in self.items():
             if text is None:
                 key_order = value.keys()
                 text = ['\t'.join(['key'] + key_order)]
@@ -99,3 +260,19 @@ class SqliteCache(object):
                 line.append(v)
             text.append('\t'.join(line))
         return '\n'.join(text) + '\n'
+
+
+def open_sqlite_cache(fpath):
+    '''It opens the cache in the given path, it creates its directory.
+
+    It returns None if the cache can not be opened. The cache is evicted
+    above the SQLITE_CACHE_MAX_SIZE setting.
+    '''
+    cache_dir = os.path.dirname(fpath)
+    try:
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        max_size = get_setting('SQLITE_CACHE_MAX_SIZE')
+        return SqliteCache(fpath, max_size=max_size)
+    except (OSError, IOError, sqlite3.Error):
+        return None
@@ -53,6 +53,12 @@ SEQS_PASSED = 'seqs_passed'
 SEQS_FILTERED_OUT = 'seqs_filtered_out'
 
 ORPHAN_SEQS = 'orphan_seqs'
+DIVERTED_SEQS = 'diverted_seqs'
+
+# status of the mates in a MatePacket
+MATE_PASSED = 0
+MATE_FILTERED_OUT = 1
+MATE_LOST = 2
 
 SEQITEM = 'seqitem'
 SEQRECORD = 'seqrecord'
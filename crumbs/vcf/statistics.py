@@ -1,6 +1,11 @@
 from __future__ import division
 from operator import itemgetter
+from collections import Counter, OrderedDict
+from itertools import islice, imap
+from multiprocessing import Pool
 
+import numpy
+import pysam
 from vcf import Reader
 
 from crumbs.seq.seq import get_name, get_length
@@ -12,7 +17,7 @@ from crumbs.vcf.snv import (VARSCAN, GATK, FREEBAYES, HOM_REF, HET, HOM_ALT,
                             pyvcfReader)
 
 # TODO: This must be optional
-from crumbs.bam.coord_transforms import ReadRefCoord
+from crumbs.bam.coord_transforms import sweep_read_positions
 
 
 # Missing docstring
@@ -539,57 +544,156 @@ class VcfStats(object):
         return self._snv_counters[DEPTHS]
 
 
-def calc_snv_read_pos_stats(sam, snvs, max_snps=None, max_pos=None):
+# number of read hits to hold before they are added to the read pos. stats
+_READ_POS_HITS_TO_BUFFER = 100000
+
+
+class _ReadPosHistograms(object):
+    '''It accumulates the per SNV read position histograms of a chrom.
+
+    The read hits are buffered as arrays and the histograms for every SNV
+    and read position are computed at once with numpy.
+    '''
+    def __init__(self, snv_quals, max_pos=None):
+        self._snv_quals = snv_quals
+        self._max_pos = max_pos
+        self._hits = {}
+        self._n_hits = 0
+        self.stats = {}
+
+    def add_read(self, read_group, snv_idxs, read_poss, read_len):
+        if read_group not in self._hits:
+            self._hits[read_group] = ([], [], [])
+        snv_idxs_, read_poss_, read_lens = self._hits[read_group]
+        snv_idxs_.append(snv_idxs)
+        read_poss_.append(read_poss)
+        read_lens.append(numpy.repeat(read_len, len(read_poss)))
+        self._n_hits += len(read_poss)
+        if self._n_hits >= _READ_POS_HITS_TO_BUFFER:
+            self.flush()
+
+    def _add_hists(self, read_group, kind, snv_idxs, poss):
+        if self._max_pos:
+            in_range = poss <= self._max_pos
+            snv_idxs = snv_idxs[in_range]
+            poss = poss[in_range]
+        if not len(poss):
+            return
+        counts, box = self.stats[read_group][kind]
+        for pos, count in enumerate(numpy.bincount(poss)):
+            if count:
+                counts[pos] += int(count)
+
+        # The histogram of every SNV
+        n_snvs = len(self._snv_quals)
+        keys, key_counts = numpy.unique(poss * n_snvs + snv_idxs,
+                                        return_counts=True)
+        snv_quals = self._snv_quals
+        for key, count in zip(keys, key_counts):
+            pos, snv_idx = divmod(int(key), n_snvs)
+            box[pos, snv_quals[snv_idx]] += int(count)
+
+    def flush(self):
+        for read_group, (snv_idxs, read_poss, read_lens) in self._hits.items():
+            if read_group not in self.stats:
+                self.stats[read_group] = {5: (Counter(), Counter()),
+                                          3: (Counter(), Counter())}
+            snv_idxs = numpy.concatenate(snv_idxs)
+            read_poss = numpy.concatenate(read_poss)
+            read_lens = numpy.concatenate(read_lens)
+            self._add_hists(read_group, 5, snv_idxs, read_poss + 1)
+            self._add_hists(read_group, 3, snv_idxs, read_lens - read_poss)
+        self._hits = {}
+        self._n_hits = 0
+
+
+def _calc_chrom_read_pos_stats(sam, chrom, snv_poss, snv_quals,
+                               max_pos=None):
+    if isinstance(sam, basestring):
+        sam = pysam.AlignmentFile(sam)
+    hists = _ReadPosHistograms(snv_quals, max_pos=max_pos)
+    covered = numpy.zeros(len(snv_poss), dtype=numpy.bool_)
+    for read_coord, snv_idxs, read_poss in sweep_read_positions(sam, chrom,
+                                                                snv_poss):
+        try:
+            read_group = read_coord.alig_read.opt('RG')
+        except KeyError:
+            read_group = None
+        hists.add_read(read_group, snv_idxs, read_poss, read_coord.read_len)
+        covered[snv_idxs] = True
+    if not covered.all():
+        snv_pos = snv_poss[int(numpy.flatnonzero(~covered)[0])]
+        raise RuntimeError('No pileup found for snv {}:{}'.format(chrom,
+                                                                  snv_pos))
+    hists.flush()
+    return hists.stats
+
+
+def _calc_chrom_read_pos_stats_star(args):
+    return _calc_chrom_read_pos_stats(*args)
+
+
+def calc_snv_read_pos_stats(sam, snvs, max_snps=None, max_pos=None,
+                            processes=1):
+    '''It calculates the read positions in which the SNVs are found.
+
+    The SNVs and the alignments of every chromosome are walked together in
+    a single sweep. The chromosomes are processed in parallel when more than
+    one process is requested. A RuntimeError is raised if an SNV is not
+    covered by any read.
+    '''
+    snvs_by_chrom = OrderedDict()
+    for snv in islice(snvs, max_snps):
+        chrom = snv.chrom
+        if chrom not in snvs_by_chrom:
+            snvs_by_chrom[chrom] = []
+        snvs_by_chrom[chrom].append((snv.pos, snv.qual))
+
+    if processes > 1:
+        # pysam files can not be sent to the workers, they reopen the bam
+        sam_for_jobs = sam.filename
+    else:
+        sam_for_jobs = sam
+    jobs = []
+    for chrom, chrom_snvs in snvs_by_chrom.viewitems():
+        chrom_snvs.sort(key=itemgetter(0))
+        snv_poss = [snv[0] for snv in chrom_snvs]
+        snv_quals = [snv[1] for snv in chrom_snvs]
+        jobs.append((sam_for_jobs, chrom, snv_poss, snv_quals, max_pos))
+
+    if processes > 1:
+        workers = Pool(processes=processes)
+        chrom_stats = workers.imap(_calc_chrom_read_pos_stats_star, jobs)
+    else:
+        workers = None
+        chrom_stats = imap(_calc_chrom_read_pos_stats_star, jobs)
 
-    pileup_cols = sam.pileup()
     read_5_pos_cnts_rg = {}
     read_3_pos_cnts_rg = {}
     read_5_pos_box_rg = {}
     read_3_pos_box_rg = {}
-
-    for index, snv in enumerate(snvs):
-        if max_snps and index >= max_snps:
-            break
-        chrom = snv.chrom
-        ref_pos = snv.pos
-        snv_qual = snv.qual
-        snv_col = None
-        for col in pileup_cols:
-            ref_name = sam.getrname(col.reference_id)
-            if ref_name == chrom and col.reference_pos == ref_pos:
-                snv_col = col
-                break
-        if snv_col is None:
-            raise RuntimeError('No pileup found for snv {}:{}'.format(chrom,
-                                                                      ref_pos))
-
-        for pileup_read in snv_col.pileups:
-            try:
-                read_group = pileup_read.alignment.opt('RG')
-            except KeyError:
-                read_group = None
-            read_ref_coord = ReadRefCoord(pileup_read.alignment, sam)
-            read_pos = read_ref_coord.get_read_pos((chrom, ref_pos))
-            read_pos_end = read_ref_coord.get_read_pos_counting_from_end((chrom,
-                                                                          ref_pos))
-            if read_group not in read_5_pos_cnts_rg:
-                read_5_pos_cnts_rg[read_group] = IntCounter()
-                read_3_pos_cnts_rg[read_group] = IntCounter()
-                read_5_pos_box_rg[read_group] = IntBoxplot()
-                read_3_pos_box_rg[read_group] = IntBoxplot()
-            read_5_pos_cnts = read_5_pos_cnts_rg[read_group]
-            read_3_pos_cnts = read_3_pos_cnts_rg[read_group]
-            read_5_pos_box = read_5_pos_box_rg[read_group]
-            read_3_pos_box = read_3_pos_box_rg[read_group]
-
-            if (read_pos is not None and
-                (not max_pos or read_pos + 1 <= max_pos)):
-                    read_5_pos_cnts[read_pos + 1] += 1
-                    read_5_pos_box.append(read_pos + 1, snv_qual)
-            if (read_pos_end is not None and (not max_pos or
-                abs(read_pos_end) <= max_pos)):
-                    read_3_pos_cnts[abs(read_pos_end)] += 1
-                    read_3_pos_box.append(abs(read_pos_end), snv_qual)
+    try:
+        for stats in chrom_stats:
+            for read_group, rg_stats in stats.viewitems():
+                if read_group not in read_5_pos_cnts_rg:
+                    read_5_pos_cnts_rg[read_group] = IntCounter()
+                    read_3_pos_cnts_rg[read_group] = IntCounter()
+                    read_5_pos_box_rg[read_group] = IntBoxplot()
+                    read_3_pos_box_rg[read_group] = IntBoxplot()
+                read_5_pos_cnts_rg[read_group].update(rg_stats[5][0])
+                read_3_pos_cnts_rg[read_group].update(rg_stats[3][0])
+                for (pos, snv_qual), count in rg_stats[5][1].viewitems():
+                    read_5_pos_box_rg[read_group].append(pos, snv_qual, count)
+                for (pos, snv_qual), count in rg_stats[3][1].viewitems():
+                    read_3_pos_box_rg[read_group].append(pos, snv_qual, count)
+    except:
+        if workers is not None:
+            workers.terminate()
+        raise
+    finally:
+        if workers is not None:
+            workers.close()
+            workers.join()
 
     return {'5_read_pos_counts': read_5_pos_cnts_rg,
             '3_read_pos_counts': read_3_pos_cnts_rg,
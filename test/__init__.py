@@ -0,0 +1,20 @@
+'''
+Created on 2015 urt 16
+
+@author: peio
+'''
+
+import os
+import atexit
+import shutil
+from tempfile import mkdtemp
+
+# the tests and the bins that they run do not write in the user caches
+_CACHE_DIR = mkdtemp(prefix='seq_crumbs_test_cache_')
+atexit.register(shutil.rmtree, _CACHE_DIR, True)
+os.environ.setdefault('SEQ_CRUMBS_RECORD_INDEX_CACHE_DIR',
+                      os.path.join(_CACHE_DIR, 'record_indexes'))
+os.environ.setdefault('SEQ_CRUMBS_REF_COUNTS_CACHE_DIR',
+                      os.path.join(_CACHE_DIR, 'ref_counts'))
+os.environ.setdefault('SEQ_CRUMBS_INDEX_CACHE_DIR',
+                      os.path.join(_CACHE_DIR, 'indexes'))
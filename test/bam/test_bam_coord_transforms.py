@@ -3,7 +3,10 @@ from tempfile import NamedTemporaryFile
 
 import pysam
 
-from crumbs.bam.coord_transforms import ReadRefCoord
+from crumbs.bam.coord_transforms import (ReadRefCoord, NO_READ_POS,
+                                         iter_read_positions,
+                                         sweep_read_positions,
+                                         pos_counter_by_pos)
 
 
 SAM = '''@HD\tVN:1.3\tSO:coordinate
@@ -103,6 +106,71 @@ class BasePositionTest(unittest.TestCase):
         assert coords[7].get_read_pos(('ref', 16)) == 12
         assert coords[7].get_read_pos_counting_from_end(('ref', 16)) == -2
 
+    def test_batched_read_positions(self):
+        fhand = NamedTemporaryFile(suffix='.sam')
+        fhand.write(SAM)
+        fhand.flush()
+        sam = pysam.AlignmentFile(fhand.name)
+        coords = [ReadRefCoord(read, sam) for read in sam]
+
+        ref_poss = [3, 12, 16, 18]
+        read_poss = list(coords[0].get_read_positions('ref', ref_poss))
+        assert read_poss == [NO_READ_POS, 6, 12, NO_READ_POS]
+        read_poss = list(coords[6].get_read_positions('ref', [9, 16]))
+        assert read_poss == [12, 3]
+        read_poss = list(coords[1].get_read_positions('ref', [6, 16]))
+        assert read_poss == [NO_READ_POS, 12]
+
+        # the single and the batched queries agree
+        for coord in coords:
+            for ref_pos in range(45):
+                read_pos = coord.get_read_pos(('ref', ref_pos))
+                read_pos2 = coord.get_read_positions('ref', [ref_pos])[0]
+                if read_pos is None:
+                    assert read_pos2 == NO_READ_POS
+                else:
+                    assert read_pos == read_pos2
+
+        try:
+            coords[0].get_read_positions('ref2', [9])
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+        # many reads against many positions
+        results = list(iter_read_positions(coords, 'ref', [9, 16, 40]))
+        assert [list(res[1]) for res in results] == [[0, 1], [0, 1], [0],
+                                                     [1], [2], [0, 1], [0, 1]]
+        assert list(results[0][2]) == [3, 12]
+        assert list(results[4][2]) == [4]
+
+    def test_sweep_read_positions(self):
+        fhand = NamedTemporaryFile(suffix='.sam')
+        fhand.write(SAM)
+        fhand.flush()
+        bam_fhand = NamedTemporaryFile(suffix='.bam')
+        pysam.sort('-o', bam_fhand.name, fhand.name, catch_stdout=False)
+        pysam.index(bam_fhand.name)
+        sam = pysam.AlignmentFile(bam_fhand.name)
+
+        # a small gap makes every read to be found in several regions
+        for max_gap in (1000, 1):
+            hits = sweep_read_positions(sam, 'ref', [9, 16, 18, 40],
+                                        max_gap=max_gap)
+            hits = [(coord.alig_read.query_name, list(pos_idxs),
+                     list(read_poss)) for coord, pos_idxs, read_poss in hits]
+            assert hits == [('r001', [0, 1], [3, 12]),
+                            ('r009', [0, 1, 2], [12, 3, 1]),
+                            ('r002', [0, 1], [4, 12]),
+                            ('r003', [0], [1]),
+                            ('r010', [0, 1], [1, 9]),
+                            ('r004', [1, 2], [1, 3]),
+                            ('r008', [3], [4])]
+
+        counters = list(pos_counter_by_pos(bam_fhand.name, [('ref', 9),
+                                                            ('ref', 40)]))
+        assert counters == [{1: 2, 3: 1, 4: 1, 12: 1}, {4: 1}]
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'CalmdTest']
     unittest.main()
@@ -1,7 +1,9 @@
 
 import os.path
 import unittest
+import shutil
 from subprocess import check_output
+from tempfile import mkdtemp
 
 import pysam
 
@@ -12,7 +14,8 @@ from crumbs.bam.statistics import (count_reads, ReferenceStats, ReadStats,
                                    get_reference_counts,
                                    get_reference_counts_dict,
                                    get_genome_coverage, get_bam_readgroups,
-                                   mapped_count_by_rg, GenomeCoverages)
+                                   mapped_count_by_rg, GenomeCoverages,
+                                   ReferenceCounts, calc_rpkms)
 
 # pylint: disable=R0201
 # pylint: disable=R0904
@@ -93,15 +96,64 @@ class StatsTest(unittest.TestCase):
 
     def test_ref_counts(self):
         bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
-        counts = list(get_reference_counts(bam_fpath))
-        assert counts[2] == {'unmapped_reads': 0, 'reference': None,
-                             'length': None, 'mapped_reads': 0}
-        assert counts[1] == {'unmapped_reads': 0, 'reference': 'reference2',
-                             'length': 1714, 'mapped_reads': 9}
-        counts = get_reference_counts_dict([bam_fpath])
-        assert  None in counts.keys()
-        assert  'reference2' in counts.keys()
-        assert  'reference2' in counts.keys()
+        cache_dir = mkdtemp()
+        try:
+            counts = list(get_reference_counts(bam_fpath, cache_dir))
+            assert counts[2] == {'unmapped_reads': 0, 'reference': None,
+                                 'length': None, 'mapped_reads': 0}
+            assert counts[1] == {'unmapped_reads': 0,
+                                 'reference': 'reference2',
+                                 'length': 1714, 'mapped_reads': 9}
+            counts = get_reference_counts_dict([bam_fpath], cache_dir)
+            assert  None in counts.keys()
+            assert  'reference2' in counts.keys()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_ref_counts_cache(self):
+        tmp_dir = mkdtemp()
+        try:
+            bam_fpath = os.path.join(tmp_dir, 'seqs.bam')
+            shutil.copy(os.path.join(TEST_DATA_DIR, 'seqs.bam'), bam_fpath)
+            shutil.copy(os.path.join(TEST_DATA_DIR, 'seqs.bam.bai'),
+                        bam_fpath + '.bai')
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            counts = list(get_reference_counts(bam_fpath, cache_dir))
+            # nothing is written next to the bam
+            assert sorted(os.listdir(tmp_dir)) == ['cache', 'seqs.bam',
+                                                   'seqs.bam.bai']
+            cache_fpath = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            assert list(get_reference_counts(bam_fpath, cache_dir)) == counts
+
+            # the cache is used while the bam does not change
+            cache = open(cache_fpath).read().replace('\t9\t', '\t7\t')
+            open(cache_fpath, 'w').write(cache)
+            counts2 = list(get_reference_counts(bam_fpath, cache_dir))
+            assert counts2[0]['mapped_reads'] == 7
+            os.utime(bam_fpath, (0, 0))
+            assert list(get_reference_counts(bam_fpath, cache_dir)) == counts
+
+            ref_counts = ReferenceCounts(bam_fpath, cache_dir)
+            assert ref_counts.references == ['reference1', 'reference2']
+            assert list(ref_counts.lengths) == [833, 1714]
+            assert ref_counts.n_reads == 18
+            rpkms = ref_counts.rpkms
+            assert abs(rpkms[0] - 600240.1) < 0.1
+            assert abs(rpkms[1] - 291715.28) < 0.1
+            assert list(calc_rpkms([1, 2], [1000, 1000], 1e6)) == [1, 2]
+
+            # the least recently used counts are removed above the budget
+            bam_fpath2 = os.path.join(tmp_dir, 'seqs2.bam')
+            shutil.copy(bam_fpath, bam_fpath2)
+            shutil.copy(bam_fpath + '.bai', bam_fpath2 + '.bai')
+            max_size = os.path.getsize(cache_fpath) * 2 - 1
+            counts2 = list(get_reference_counts(bam_fpath2, cache_dir,
+                                                max_size=max_size))
+            assert counts2 == counts
+            assert len(os.listdir(cache_dir)) == 1
+            assert not os.path.exists(cache_fpath)
+        finally:
+            shutil.rmtree(tmp_dir)
 
     def test_get_readgroup(self):
         bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
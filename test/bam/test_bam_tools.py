@@ -1,6 +1,7 @@
 
 import os.path
 import unittest
+from collections import namedtuple
 import shutil
 from subprocess import check_output, check_call
 from tempfile import NamedTemporaryFile
@@ -10,7 +11,7 @@ import pysam
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.bam.bam_tools import (filter_bam, calmd_bam, realign_bam,
-                                  index_bam, merge_sams)
+                                  index_bam, merge_sams, _group_regions)
 
 # pylint: disable=C0111
 
@@ -73,6 +74,114 @@ class FilterTest(unittest.TestCase):
         filter_bam(bam_fpath, out_fhand.name, min_mapq=100)
         assert len(open(out_fhand.name).read(20)) == 20
 
+    def test_filter_predicates(self):
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
+        reads = list(pysam.AlignmentFile(bam_fpath))
+        for processes in (1, 2):
+            out_fhand = NamedTemporaryFile(suffix='.bam')
+            rejected = filter_bam(bam_fpath, out_fhand.name, min_mapq=1,
+                                  read_groups=['group1+454'],
+                                  processes=processes)
+            out_reads = list(pysam.AlignmentFile(out_fhand.name))
+            expected = [read.query_name for read in reads
+                        if read.get_tag('RG') == 'group1+454' and read.mapq]
+            assert [read.query_name for read in out_reads] == expected
+            assert sum(rejected.values()) == len(reads) - len(out_reads)
+            assert rejected['read_groups'] > 0
+
+    def test_filter_soft_clip_and_regions(self):
+        sam = '''@HD\tVN:1.3\tSO:coordinate
+@SQ\tSN:ref\tLN:45
+@SQ\tSN:ref2\tLN:45
+r001\t0\tref\t7\t30\t8M2I4M1D3M\t*\t0\t0\tTAAGATAAAGGATACTG\t*\tNM:i:4
+r002\t0\tref\t9\t30\t3S6M1P1I4M\t*\t0\t0\tAAAAGATAAGGATA\t*
+r003\t0\tref\t9\t30\t5H6M\t*\t0\t0\tAGCTAA\t*\tNM:i:1
+r004\t0\tref\t16\t30\t6M14N5M\t*\t0\t0\tATAGCTTCAGC\t*
+r005\t0\tref2\t16\t30\t6M\t*\t0\t0\tATAGCT\t*
+'''
+        sam_fhand = NamedTemporaryFile(suffix='.sam')
+        sam_fhand.write(sam)
+        sam_fhand.flush()
+        bam_fhand = NamedTemporaryFile(suffix='.bam')
+        pysam.view('-bS', '-o' + bam_fhand.name, sam_fhand.name,
+                   catch_stdout=False)
+        pysam.index(bam_fhand.name)
+
+        out_fhand = NamedTemporaryFile(suffix='.bam')
+        rejected = filter_bam(bam_fhand.name, out_fhand.name,
+                              max_soft_clip_fraction=0.1, max_edit_distance=2)
+        assert rejected == {'max_soft_clip_fraction': 1,
+                            'max_edit_distance': 1}
+        names = [read.query_name for read in pysam.AlignmentFile(out_fhand.name)]
+        assert names == ['r003', 'r004', 'r005']
+
+        # overlapping regions do not duplicate the reads
+        regions = namedtuple('Regions', ['segments'])([('ref', 1, 10),
+                                                       ('ref', 17, 20),
+                                                       ('ref', 8, 12)])
+        out_fhand = NamedTemporaryFile(suffix='.bam')
+        filter_bam(bam_fhand.name, out_fhand.name, regions=regions,
+                   processes=2)
+        names = [read.query_name for read in pysam.AlignmentFile(out_fhand.name)]
+        assert names == ['r001', 'r002', 'r003', 'r004']
+
+        # the shards of several jobs are concatenated in order
+        out_fhand = NamedTemporaryFile(suffix='.bam')
+        filter_bam(bam_fhand.name, out_fhand.name, processes=3)
+        names = [read.query_name for read in pysam.AlignmentFile(out_fhand.name)]
+        assert names == ['r001', 'r002', 'r003', 'r004', 'r005']
+        os.remove(bam_fhand.name + '.bai')
+
+    def test_filter_region_like_references(self):
+        'The reference names can look like regions'
+        sam = '''@HD\tVN:1.3\tSO:coordinate
+@SQ\tSN:ref:1-10\tLN:45
+@SQ\tSN:ref\tLN:45
+r001\t0\tref:1-10\t20\t30\t6M\t*\t0\t0\tATAGCT\t*
+r002\t0\tref\t5\t30\t6M\t*\t0\t0\tATAGCT\t*
+r003\t0\tref\t30\t30\t6M\t*\t0\t0\tATAGCT\t*
+r004\t4\t*\t0\t0\t*\t*\t0\t0\tATAGCT\t*
+'''
+        sam_fhand = NamedTemporaryFile(suffix='.sam')
+        sam_fhand.write(sam)
+        sam_fhand.flush()
+        bam_fhand = NamedTemporaryFile(suffix='.bam')
+        pysam.view('-bS', '-o' + bam_fhand.name, sam_fhand.name,
+                   catch_stdout=False)
+        pysam.index(bam_fhand.name)
+        try:
+            for processes in (1, 2):
+                out_fhand = NamedTemporaryFile(suffix='.bam')
+                filter_bam(bam_fhand.name, out_fhand.name,
+                           processes=processes)
+                out_sam = pysam.AlignmentFile(out_fhand.name)
+                names = [read.query_name for read in out_sam]
+                assert names == ['r001', 'r002', 'r003', 'r004']
+        finally:
+            os.remove(bam_fhand.name + '.bai')
+
+    def test_group_regions(self):
+        in_sam = namedtuple('Sam', ['references', 'lengths'])
+        in_sam = in_sam(['ref1', 'ref2', 'ref3', 'ref4'], [100, 10, 10, 80])
+        regions = [(ref, None, None, None) for ref in in_sam.references]
+        regions.append(('*', None, None, None))
+        jobs = _group_regions(in_sam, regions, 2)
+        assert [[region[0] for region in job] for job in jobs] == [
+                                        ['ref1'], ['ref2', 'ref3', 'ref4', '*']]
+        assert len(_group_regions(in_sam, regions, 1)) == 1
+        regions = [('ref1', 0, 20, None), ('ref1', 30, 50, 20)]
+        assert len(_group_regions(in_sam, regions, 2)) == 2
+
+    def test_filter_bam_bin(self):
+        bin_ = os.path.join(BIN_DIR, 'filter_bam')
+        bam_fpath = os.path.join(TEST_DATA_DIR, 'seqs.bam')
+        out_fhand = NamedTemporaryFile(suffix='.bam')
+        report_fhand = NamedTemporaryFile()
+        check_call([bin_, bam_fpath, '-o', out_fhand.name, '--read_group',
+                    'group2+454', '--processes', '2', '-r',
+                    report_fhand.name])
+        assert 'read_groups\t' in open(report_fhand.name).read()
+
 
 class RealignTest(unittest.TestCase):
     def test_realign_bamself(self):
@@ -0,0 +1,63 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+'''
+It compares OligoMatcher with blastn-short and it times both.
+
+usage, from the root of the repository:
+    python -m test.seq.benchmark_oligo_matcher [reads] [oligos] [repeats]
+
+By default it uses the 454 reads and the linkers of the test data. The
+reads are matched with the settings used by the trimmers, the hits that
+differ are reported. blastn and makeblastdb have to be in the path.
+'''
+
+import sys
+import os.path
+
+from crumbs.seq.seqio import read_seqs
+from crumbs.utils.test_utils import TEST_DATA_DIR
+
+from test.seq.test_oligo_matcher import compare_with_blast_short
+
+# pylint: disable=C0111
+
+
+def main():
+    args = sys.argv[1:]
+    reads_fpath = args[0] if args else os.path.join(TEST_DATA_DIR,
+                                                    '454_reads.fastq')
+    oligos_fpath = args[1] if len(args) > 1 else os.path.join(TEST_DATA_DIR,
+                                                              'linkers.fasta')
+    repeats = int(args[2]) if len(args) > 2 else 1
+    seqs = list(read_seqs([open(reads_fpath)]))
+    oligos = list(read_seqs([open(oligos_fpath)]))
+
+    oligo_times, blast_times = [], []
+    for _ in range(repeats):
+        oligo_time, blast_time, differences = compare_with_blast_short(seqs,
+                                                                       oligos)
+        oligo_times.append(oligo_time)
+        blast_times.append(blast_time)
+    print 'reads: {:d}, oligos: {:d}'.format(len(seqs), len(oligos))
+    print 'OligoMatcher: {:.3f} s'.format(min(oligo_times))
+    print 'blastn-short: {:.3f} s'.format(min(blast_times))
+    print 'reads with different hits: {:d}'.format(len(differences))
+    for name, oligo_hit, blast_hit in differences:
+        print '{}\tOligoMatcher: {}\tblastn-short: {}'.format(name, oligo_hit,
+                                                            blast_hit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+'''
+It compares run_crumbs with the equivalent shell pipeline and it times both.
+
+usage, from the root of the repository:
+    python -m test.seq.benchmark_run_crumbs [reads] [processes] [repeats]
+
+The chain is trim_quality | trim_edges | filter_by_length |
+filter_by_complexity. Without a reads file, or with -, 100000 random 150 bp
+reads are used, they are made with a fixed seed, so every run gets the same
+reads. It reports the best time of every run and if both outputs are the
+same. The crumbs package has to be importable by the bins.
+'''
+
+import sys
+import os.path
+from time import time
+from subprocess import Popen, PIPE, check_call
+
+import numpy
+
+from crumbs.utils.bin_utils import BIN_DIR
+from crumbs.utils.file_utils import TemporaryDir
+
+# pylint: disable=C0111
+
+NUM_READS = 100000
+READ_LENGTH = 150
+
+_SHELL_STEPS = [['trim_quality'],
+                ['trim_edges', '-l', '5', '-r', '5'],
+                ['filter_by_length', '-n', '50'],
+                ['filter_by_complexity']]
+_CRUMB_STEPS = ['trim_quality', 'trim_edges:left=5,right=5',
+                'filter_by_length:minimum=50', 'filter_by_complexity']
+
+
+def _make_reads(fpath, num_reads=NUM_READS, length=READ_LENGTH):
+    'It writes random reads with low quality tails and some low complexity'
+    rand = numpy.random.RandomState(42)
+    nucls = numpy.array(list('ACGT'))
+    low_complexity = ('CA' * length)[:length]
+    with open(fpath, 'w') as fhand:
+        for index in xrange(num_reads):
+            if rand.random_sample() < 0.05:
+                seq = low_complexity
+            else:
+                seq = ''.join(nucls[rand.randint(0, 4, length)])
+            good_len = rand.randint(length // 4, length + 1)
+            quals = numpy.append(rand.randint(30, 41, good_len),
+                                 rand.randint(2, 16, length - good_len))
+            qual = (quals + 33).astype(numpy.uint8).tostring()
+            fhand.write('@read{:d}\n{}\n+\n{}\n'.format(index, seq, qual))
+
+
+def _run_shell_pipeline(in_fpath, out_fpath, processes):
+    'It runs the crumbs connected by pipes, as a shell would do'
+    process_args = ['-p', str(processes)]
+    processes_ = []
+    stdin = open(in_fpath)
+    out_fhand = open(out_fpath, 'w')
+    for index, step in enumerate(_SHELL_STEPS):
+        is_last = index == len(_SHELL_STEPS) - 1
+        cmd = [os.path.join(BIN_DIR, step[0])] + step[1:] + process_args
+        process = Popen(cmd, stdin=stdin,
+                        stdout=out_fhand if is_last else PIPE)
+        if processes_:
+            # the previous process gets a SIGPIPE if this one exits
+            stdin.close()
+        processes_.append(process)
+        stdin = process.stdout
+    for process in processes_:
+        if process.wait():
+            raise RuntimeError('The shell pipeline failed')
+    out_fhand.close()
+
+
+def _run_crumbs(in_fpath, out_fpath, processes):
+    cmd = [os.path.join(BIN_DIR, 'run_crumbs'), '-p', str(processes),
+           '-o', out_fpath, in_fpath]
+    for step in _CRUMB_STEPS:
+        cmd.extend(['-s', step])
+    check_call(cmd)
+
+
+def _time(function, *args):
+    start = time()
+    function(*args)
+    return time() - start
+
+
+def main():
+    args = sys.argv[1:]
+    processes = int(args[1]) if len(args) > 1 else 1
+    repeats = int(args[2]) if len(args) > 2 else 1
+    tmp_dir = TemporaryDir()
+    try:
+        if args and args[0] != '-':
+            reads_fpath = args[0]
+        else:
+            reads_fpath = os.path.join(tmp_dir.name, 'reads.fastq')
+            _make_reads(reads_fpath)
+        shell_fpath = os.path.join(tmp_dir.name, 'shell.fastq')
+        crumbs_fpath = os.path.join(tmp_dir.name, 'run_crumbs.fastq')
+
+        shell_times, crumbs_times = [], []
+        for _ in range(repeats):
+            shell_times.append(_time(_run_shell_pipeline, reads_fpath,
+                                     shell_fpath, processes))
+            crumbs_times.append(_time(_run_crumbs, reads_fpath, crumbs_fpath,
+                                      processes))
+        same = open(shell_fpath).read() == open(crumbs_fpath).read()
+    finally:
+        tmp_dir.close()
+    print 'processes: {:d}, repeats: {:d}'.format(processes, repeats)
+    print 'shell pipeline: {:.2f} s'.format(min(shell_times))
+    print 'run_crumbs: {:.2f} s'.format(min(crumbs_times))
+    print 'same output: {}'.format(same)
+
+
+if __name__ == '__main__':
+    main()
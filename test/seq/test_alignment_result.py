@@ -25,6 +25,7 @@ import os
 from StringIO import StringIO
 from tempfile import NamedTemporaryFile
 import math
+import copy
 
 
 from crumbs.seq.alignment_result import (BlastParser, TabularBlastParser,
@@ -33,7 +34,8 @@ from crumbs.seq.alignment_result import (BlastParser, TabularBlastParser,
                                          filter_alignments,
                                          covered_segments_from_match_parts,
                                          elongate_match_parts_till_global,
-                                         TextBlastParser, QUERY, SUBJECT)
+                                         TextBlastParser, QUERY, SUBJECT,
+                                         MatchPart)
 
 
 from crumbs.utils.test_utils import TEST_DATA_DIR
@@ -210,6 +212,29 @@ class BlastParserTest(unittest.TestCase):
             n_blasts += 1
         assert n_blasts == 2
 
+    def test_match_part(self):
+        'The match part can be used as a dict'
+        match_part = MatchPart(query_start=1, query_end=10,
+                               scores={'expect': 1e-4})
+        assert match_part['query_start'] == 1
+        assert 'query_end' in match_part
+        assert 'subject_start' not in match_part
+        assert match_part.get('subject_start') is None
+        try:
+            match_part['subject_start']
+            self.fail('KeyError expected')
+        except KeyError:
+            pass
+        match_part['subject_start'] = 3
+        assert sorted(match_part.keys()) == ['query_end', 'query_start',
+                                             'scores', 'subject_start']
+        assert match_part == {'query_start': 1, 'query_end': 10,
+                              'subject_start': 3, 'scores': {'expect': 1e-4}}
+        match_part2 = copy.deepcopy(match_part)
+        assert match_part2 == match_part
+        match_part2['scores']['expect'] = 1
+        assert match_part['scores']['expect'] == 1e-4
+
     def test_blast_no_result(self):
         'It test that the xml output can be and empty string'
         blast_file = NamedTemporaryFile()
@@ -669,6 +694,9 @@ class AlignmentFilters(unittest.TestCase):
         _check_blast(filtered_alignments[0], expected_align1)
         assert len(filtered_alignments) == 1
         assert len(filtered_alignments[0]['matches'][0]['match_parts']) == 1
+        # the given alignments are not modified
+        assert len(align1['matches'][0]['match_parts']) == 2
+        assert 'start' not in align1['matches'][0]
 
         filter_ = {'kind': 'min_length',
                     'min_num_residues': 100,
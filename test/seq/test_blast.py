@@ -15,18 +15,24 @@
 
 import unittest
 import os.path
+import threading
 from tempfile import NamedTemporaryFile
+from multiprocessing import Pool
 
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
 from crumbs.blast import (do_blast, BlasterForFewSubjects,
-                          get_or_create_blastdb, _blastdb_exists, Blaster)
+                          get_or_create_blastdb, _blastdb_exists, Blaster,
+                          BlastRunner, SharedBlastRunner, get_blast_runner)
+from crumbs.utils.sqlite_utils import SqliteCache
+from crumbs.seq.seqio import read_seqs
 from crumbs.utils.file_utils import TemporaryDir
 from crumbs.settings import get_setting
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import NUCL, SEQITEM, SEQRECORD
-from crumbs.seq.seq import SeqWrapper, SeqItem, assing_kind_to_seqs
+from crumbs.seq.seq import (SeqWrapper, SeqItem, assing_kind_to_seqs,
+                            get_name)
 
 TITANIUM_LINKER = get_setting('TITANIUM_LINKER')
 FLX_LINKER = get_setting('FLX_LINKER')
@@ -36,6 +42,11 @@ FLX_LINKER = get_setting('FLX_LINKER')
 # pylint: disable=C0111
 
 
+def _search_names(args):
+    runner, seqs = args
+    return [blast['query']['name'] for blast in runner.search(seqs)]
+
+
 class BlastTest(unittest.TestCase):
     'It tests the blast infrastructure'
 
@@ -75,6 +86,76 @@ class BlastTest(unittest.TestCase):
         finally:
             db_dir.close()
 
+    def test_blast_runner(self):
+        'It blasts in batches and it caches the results'
+        db_name = 'arabidopsis_genes'
+        seq_fpath = os.path.join(TEST_DATA_DIR, db_name)
+        db_dir = TemporaryDir(prefix='blast_dbs_')
+        try:
+            db_fpath = get_or_create_blastdb(seq_fpath, directory=db_dir.name,
+                                             dbtype='nucl')
+            seqs = list(read_seqs([open(seq_fpath)]))[:5]
+            cache_fpath = os.path.join(db_dir.name, 'cache', 'blasts.sqlite')
+            runner = BlastRunner(db_fpath, 'blastn', dbtype=NUCL,
+                                 batch_size=2, max_processes=2,
+                                 cache_fpath=cache_fpath)
+            blasts = list(runner.search(seqs))
+            names = [get_name(seq) for seq in seqs]
+            assert [blast['query']['name'] for blast in blasts] == names
+
+            cache = SqliteCache(cache_fpath)
+            assert len(list(cache.dump())) == 5
+            cache.close()
+
+            # the results are taken from the cache
+            runner = BlastRunner(db_fpath, 'blastn', dbtype=NUCL,
+                                 cache_fpath=cache_fpath)
+            assert list(runner.search(seqs)) == blasts
+        finally:
+            db_dir.close()
+
+    def test_batches_across_searches(self):
+        'The queries of the searches done at the same time are batched'
+        db_name = 'arabidopsis_genes'
+        seq_fpath = os.path.join(TEST_DATA_DIR, db_name)
+        db_dir = TemporaryDir(prefix='blast_dbs_')
+        try:
+            db_fpath = get_or_create_blastdb(seq_fpath, directory=db_dir.name,
+                                             dbtype='nucl')
+            seqs = list(read_seqs([open(seq_fpath)]))[:6]
+            runner = BlastRunner(db_fpath, 'blastn', dbtype=NUCL,
+                                 batch_size=4, max_processes=1,
+                                 cache_fpath='')
+            expected = [list(runner.search([seq])) for seq in seqs]
+
+            results = {}
+
+            def search(idx):
+                results[idx] = list(runner.search([seqs[idx]]))
+            threads = [threading.Thread(target=search, args=(idx,))
+                       for idx in range(len(seqs))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert [results[idx] for idx in range(len(seqs))] == expected
+
+            # the runner is served to the worker processes
+            runner = get_blast_runner(db_fpath, 'blastn', dbtype=NUCL)
+            assert isinstance(runner, SharedBlastRunner)
+            assert get_blast_runner(db_fpath, 'blastn', dbtype=NUCL) is runner
+            workers = Pool(processes=2)
+            try:
+                names = workers.map(_search_names,
+                                    [(runner, [seq]) for seq in seqs])
+            finally:
+                workers.close()
+                workers.join()
+            assert names == [[blast['query']['name'] for blast in blasts]
+                             for blasts in expected]
+        finally:
+            db_dir.close()
+
     def xtest_remote_blast(self):
         'It does a remote blast search'
         seq_fhand = NamedTemporaryFile()
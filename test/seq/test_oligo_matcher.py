@@ -0,0 +1,167 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os.path
+from time import time
+
+from crumbs.seq.oligo_matcher import (OligoMatcher, _banded_local_alignment,
+                                      _ungapped_local_alignment)
+from crumbs.settings import get_setting
+from crumbs.utils.tags import SEQITEM
+from crumbs.seq.seq import SeqWrapper, SeqItem, get_name
+from crumbs.seq.seqio import read_seqs, write_seqs
+from crumbs.utils.test_utils import TEST_DATA_DIR
+from crumbs.blast import BlasterForFewSubjects
+
+TITANIUM_LINKER = get_setting('TITANIUM_LINKER')
+TITANIUM_LINKER_REV = get_setting('TITANIUM_LINKER_REV')
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+SEQ_5 = 'CTAGTCTAGTCGTAGTCATGGCTGTAGTCTAGTCTACGATTCGTATCAGTTGTGTGAC'
+SEQ_3 = 'ATCGATCATGTTGTATTGTGTACTATACACACACGTAGGTCGACTATCGTAGCTAGT'
+
+
+def _make_seq(name, str_seq):
+    return SeqWrapper(SEQITEM, SeqItem(name, ['>' + name + '\n',
+                                              str_seq + '\n']), 'fasta')
+
+
+class OligoMatcherTest(unittest.TestCase):
+    def test_alignments(self):
+        query = 'ACTGACTGGTCA'
+        subject = 'TTT' + query + 'TTT'
+        assert _ungapped_local_alignment(query, subject, 3) == (12, 0, 11, 3,
+                                                                14, 12, 12)
+        # a mismatch
+        subject = 'TTT' + 'ACTGACAGGTCAGGCT' + 'TTT'
+        query = 'ACTGACTGGTCAGGCT'
+        res = _ungapped_local_alignment(query, subject, 3)
+        assert res == (12, 0, 15, 3, 18, 15, 16)
+
+        # a deletion in the subject
+        query = 'ACTGACTGGTCATTGCATGCAGCTAGC'
+        subject = 'GG' + query[:12] + query[13:] + 'GG'
+        res = _banded_local_alignment(query, subject, -1, 5)
+        assert res == (19, 0, 26, 2, 27, 26, 27)
+
+        assert _ungapped_local_alignment('AAAA', 'CCCC', 0) is None
+
+    def test_matching_segments(self):
+        linker = TITANIUM_LINKER
+        seqs = [_make_seq('seq1', SEQ_5 + linker + SEQ_3),
+                _make_seq('seq2', SEQ_5 + TITANIUM_LINKER_REV + SEQ_3),
+                _make_seq('seq3', SEQ_5 + linker[:20] + 'A' + linker[21:] +
+                          SEQ_3),
+                _make_seq('seq4', SEQ_5 + linker[2:25] + SEQ_3),
+                _make_seq('seq5', SEQ_5 + SEQ_3)]
+        linkers = [_make_seq('titan', linker)]
+        filters = [{'kind': 'score_threshold', 'score_key': 'identity',
+                    'min_score': 87},
+                   {'kind': 'min_length', 'min_num_residues': 13,
+                    'length_in_query': False}]
+        matcher = OligoMatcher(seqs, linkers, filters=filters)
+        expected = [(len(SEQ_5), len(SEQ_5 + linker) - 1)]
+        assert matcher.get_matched_segments_for_read('seq1') == (expected,
+                                                                 False)
+        assert matcher.get_matched_segments_for_read('seq2') == (expected,
+                                                                 False)
+        assert matcher.get_matched_segments_for_read('seq3') == (expected,
+                                                                 False)
+        assert matcher.get_matched_segments_for_read('seq5') is None
+        segments = matcher.get_matched_segments_for_read('seq4')
+        assert not segments[1]
+
+        matcher = OligoMatcher(seqs, linkers, filters=filters,
+                               expect=0.0001, elongate_for_global=True)
+        segments = matcher.get_matched_segments_for_read('seq4')
+        assert segments == ([(len(SEQ_5) - 2, len(SEQ_5) + 39)], True)
+
+        # a high expect threshold
+        matcher = OligoMatcher(seqs, linkers, filters=filters,
+                               expect=1e-20)
+        assert matcher.get_matched_segments_for_read('seq1') == (expected,
+                                                                 False)
+        assert matcher.get_matched_segments_for_read('seq4') is None
+
+
+    def test_palindromic_oligo(self):
+        'As blastn-short, it reports the hits of both strands'
+        flx_linker = get_setting('FLX_LINKER')
+        seqs = [_make_seq('seq1', SEQ_3 + flx_linker + SEQ_5)]
+        matcher = OligoMatcher(seqs, [_make_seq('flx', flx_linker)],
+                               expect=0.001)
+        match_parts = matcher._match_parts['seq1']
+        start, end = len(SEQ_3), len(SEQ_3 + flx_linker) - 1
+        assert sorted((m_p['subject_start'], m_p['subject_end'])
+                      for m_p in match_parts) == [(start, end), (end, start)]
+
+
+_TRIM_FILTERS = [{'kind': 'score_threshold', 'score_key': 'identity',
+                  'min_score': 87},
+                 {'kind': 'min_length', 'min_num_residues': 13,
+                  'length_in_query': False}]
+
+
+def compare_with_blast_short(seqs, oligos, expect=0.0001):
+    '''It matches the oligos with OligoMatcher and blastn-short.
+
+    The settings are the ones used by the trimmers. It returns the time
+    taken by each one and the reads with different matched segments, as
+    (name, oligo_matcher_hit, blast_hit) tuples.
+    benchmark_oligo_matcher.py runs it on any read set.
+    '''
+    start = time()
+    matcher = OligoMatcher(seqs, oligos, filters=_TRIM_FILTERS,
+                           expect=expect, elongate_for_global=True)
+    oligo_hits = [matcher.get_matched_segments_for_read(get_name(seq))
+                  for seq in seqs]
+    oligo_time = time() - start
+
+    start = time()
+    db_fhand = write_seqs(seqs, file_format='fasta')
+    db_fhand.flush()
+    params = {'task': 'blastn-short', 'expect': str(expect)}
+    blaster = BlasterForFewSubjects(db_fhand.name, oligos, program='blastn',
+                                    filters=_TRIM_FILTERS, params=params,
+                                    elongate_for_global=True)
+    blast_hits = [blaster.get_matched_segments_for_read(get_name(seq))
+                  for seq in seqs]
+    blast_time = time() - start
+    db_fhand.close()
+
+    differences = []
+    for seq, oligo_hit, blast_hit in zip(seqs, oligo_hits, blast_hits):
+        if oligo_hit != blast_hit:
+            differences.append((get_name(seq), oligo_hit, blast_hit))
+    return oligo_time, blast_time, differences
+
+
+class BlastShortComparisonTest(unittest.TestCase):
+    def test_compare_with_blast_short(self):
+        'OligoMatcher finds the same linkers than blastn-short in real reads'
+        reads_fpath = os.path.join(TEST_DATA_DIR, '454_reads.fastq')
+        linkers_fpath = os.path.join(TEST_DATA_DIR, 'linkers.fasta')
+        seqs = list(read_seqs([open(reads_fpath)]))
+        linkers = list(read_seqs([open(linkers_fpath)]))
+        differences = compare_with_blast_short(seqs, linkers)[2]
+        assert not differences, differences
+
+if __name__ == "__main__":
+#     import sys;sys.argv = ['', 'OligoMatcherTest.test_matching_segments']
+    unittest.main()
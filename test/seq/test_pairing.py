@@ -26,12 +26,14 @@ from crumbs.seq.pairs import (match_pairs, interleave_pairs,
                               deinterleave_pairs,
                               group_pairs, group_pairs_by_name,
                               _parse_pair_direction_and_name_from_title,
-                              _parse_pair_direction_and_name)
+                              _parse_pair_direction_and_name,
+                              PairNameParser, interleaved_to_mate_packets,
+                              two_streams_to_mate_packets)
 from crumbs.iterutils import flat_zip_longest
-from crumbs.utils.tags import FWD, SEQRECORD, SEQITEM
+from crumbs.utils.tags import FWD, REV, SEQRECORD, SEQITEM
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
-from crumbs.seq.seq import get_str_seq
+from crumbs.seq.seq import get_str_seq, get_name
 from crumbs.seq.seqio import read_seqs, assing_kind_to_seqs
 from crumbs.exceptions import (InterleaveError, PairDirectionError,
                                ItemsNotSortedError)
@@ -325,6 +327,27 @@ CCCFFFFFGHH
         assert name == 'seq8:136:FC706VJ:2:2104:15343:197393'
         assert dir_ == FWD
 
+    def test_pair_name_parser(self):
+        'it parses the names with the scheme of the first read'
+        parse_pair_name = PairNameParser()
+        titles = ['seq1/1', 'seq1/2', 'seq2 1:N:0:ATC', 'seq2/2', 'seq3.r',
+                  'seq3 1:N:0:ATC', 'seq4/1 desc', 'seq5.r']
+        expected = [('seq1', FWD), ('seq1', REV), ('seq2', FWD),
+                    ('seq2', REV), ('seq3', REV), ('seq3', FWD),
+                    ('seq4', FWD), ('seq5', REV)]
+        for title, name_dir in zip(titles, expected):
+            assert parse_pair_name.parse_title(title) == name_dir
+
+        seq = SeqItem('seq8/2', ['@seq8/2\n', 'ACT\n', '+\n', 'III\n'])
+        seq = SeqWrapper(SEQITEM, seq, 'fastq')
+        assert parse_pair_name(seq) == ('seq8', REV)
+
+        try:
+            parse_pair_name.parse_title('seq8.mp12')
+            self.fail('PairDirectionError expected')
+        except PairDirectionError:
+            pass
+
 
 class PairMatcherbinTest(unittest.TestCase):
     'It test the matepair binary'
@@ -419,6 +442,44 @@ class InterleavePairsTest(unittest.TestCase):
         assert result1.strip() == open(fhand1).read().strip()
         assert result2.strip() == open(fhand2).read().strip()
 
+    def test_mate_packets(self):
+        'It makes the mate packets from interleaved and two files reads'
+        fhand1 = os.path.join(TEST_DATA_DIR, 'pairend1.sfastq')
+        fhand2 = os.path.join(TEST_DATA_DIR, 'pairend1b.sfastq')
+        fwd_seqs = list(read_seqs([open(fhand1)], 'fastq'))
+        rev_seqs = list(read_seqs([open(fhand2)], 'fastq'))
+        seqs = list(interleave_pairs(fwd_seqs, rev_seqs))
+
+        # a pair is split between the first two packets
+        seq_packets = [seqs[:3], seqs[3:6], seqs[6:]]
+        packets = list(interleaved_to_mate_packets(seq_packets))
+        assert [len(packet) for packet in packets] == [1, 2, 1]
+        mates1 = [get_name(s) for packet in packets for s in packet.mates[0]]
+        mates2 = [get_name(s) for packet in packets for s in packet.mates[1]]
+        assert mates1 == [get_name(seq) for seq in fwd_seqs]
+        assert mates2 == [get_name(seq) for seq in rev_seqs]
+        assert not packets[0].status.any()
+
+        try:
+            list(interleaved_to_mate_packets([seqs[:3]]))
+            self.fail('InterleaveError expected')
+        except InterleaveError:
+            pass
+        try:
+            list(interleaved_to_mate_packets([seqs[1:5]]))
+            self.fail('InterleaveError expected')
+        except InterleaveError:
+            pass
+
+        packets = list(two_streams_to_mate_packets([fwd_seqs], [rev_seqs]))
+        assert len(packets) == 1
+        assert packets[0].mates == (fwd_seqs, rev_seqs)
+        try:
+            list(two_streams_to_mate_packets([fwd_seqs], [rev_seqs[:3]]))
+            self.fail('InterleaveError expected')
+        except InterleaveError:
+            pass
+
 
 class InterleaveBinTest(unittest.TestCase):
     'test of the interleave and deinterleave'
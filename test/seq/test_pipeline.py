@@ -0,0 +1,179 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os.path
+from tempfile import NamedTemporaryFile, mkdtemp
+from subprocess import check_output, Popen, PIPE
+from cStringIO import StringIO
+from shutil import rmtree
+
+from crumbs.seq.pipeline import (CrumbPipeline, parse_step, build_step,
+                                 FILTER, TRIM)
+from crumbs.seq.filters import seq_to_filterpackets
+from crumbs.seq.trim import TrimOrMask
+from crumbs.seq.pairs import interleaved_to_mate_packets
+from crumbs.seq.seqio import read_seq_packets
+from crumbs.seq.seq import get_str_seq, get_name
+from crumbs.utils.bin_utils import BIN_DIR
+from crumbs.utils.tags import SEQS_PASSED, DIVERTED_SEQS
+
+FASTQ = '@seq1\naaTCGTTTGAc\n+\n0000AAAA000\n@seq2\naaaaa\n+\n00000\n'
+FASTQ += '@seq3\nATCGTATAGT\n+\nAAAAAAAAAA\n'
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+
+
+def _make_fhand(content=''):
+    'It makes temporary fhands'
+    fhand = NamedTemporaryFile()
+    fhand.write(content)
+    fhand.flush()
+    return fhand
+
+
+class PipelineTest(unittest.TestCase):
+    'It tests the fused filter and trim pipeline'
+
+    def test_parse_step(self):
+        'It parses the step specs'
+        name, kwargs = parse_step('filter_by_length:minimum=5,ignore_masked=t'
+                                  'rue')
+        assert name == 'filter_by_length'
+        assert kwargs == {'minimum': 5, 'ignore_masked': True}
+
+        name, kwargs = parse_step('trim_quality:window=1')
+        assert kwargs['window'] == 1
+        assert 'threshold' in kwargs
+
+        self.assertRaises(ValueError, parse_step, 'trim_everything')
+        self.assertRaises(ValueError, parse_step, 'trim_edges:left')
+        self.assertRaises(ValueError, build_step, 'trim_edges', {'up': 1})
+
+        # the packet trimmers can not be used
+        packet_trimmer = TrimOrMask()
+        self.assertRaises(ValueError, CrumbPipeline, [(TRIM, packet_trimmer)])
+
+    def test_pipeline(self):
+        'It filters and trims every packet'
+        steps = [build_step('trim_by_case', {}),
+                 build_step('filter_by_length', {'minimum': 9})]
+        assert [kind for kind, _ in steps] == [TRIM, FILTER]
+        pipeline = CrumbPipeline(steps)
+
+        seq_packets = read_seq_packets([StringIO(FASTQ)])
+        packet = pipeline(list(seq_to_filterpackets(seq_packets))[0])
+        res = [get_str_seq(s) for l in packet[SEQS_PASSED] for s in l]
+        assert res == ['ATCGTATAGT']
+        trim_diverted, filter_diverted = packet[DIVERTED_SEQS]
+        assert not trim_diverted
+        assert [get_name(seq) for seq in filter_diverted] == ['seq1']
+
+    def test_pipeline_in_pairs(self):
+        'The mates of the lost seqs are diverted as orphans'
+        fasta = '>s.f\naattACT\n>s.r\naattACT\n>s1.f\naattACT\n>s1.r\naatt\n'
+        steps = [build_step('trim_by_case', {})]
+        pipeline = CrumbPipeline(steps)
+        seq_packets = read_seq_packets([StringIO(fasta)])
+        packets = seq_to_filterpackets(seq_packets, group_paired_reads=True)
+        packet = pipeline(list(packets)[0])
+        res = [get_str_seq(s) for l in packet[SEQS_PASSED] for s in l]
+        assert res == ['ACT', 'ACT']
+        assert [get_name(s) for s in packet[DIVERTED_SEQS][0]] == ['s1.f']
+
+    def test_mate_packets(self):
+        'The mates are marked with the step that removes them'
+        fasta = '>s.f\naattACT\n>s.r\naattACT\n>s1.f\naattACT\n>s1.r\naatt\n'
+        fasta += '>s2.f\nACT\n>s2.r\nAC\n'
+        steps = [build_step('trim_by_case', {}),
+                 build_step('filter_by_length', {'minimum': 3})]
+        pipeline = CrumbPipeline(steps)
+        seq_packets = read_seq_packets([StringIO(fasta)])
+        packet = list(interleaved_to_mate_packets(seq_packets))[0]
+        result = pipeline(packet)
+        assert result[SEQS_PASSED] is packet
+        assert result[DIVERTED_SEQS].tolist() == [[0, 0, 2], [0, 1, 2]]
+        assert get_str_seq(packet.mates[0][1]) == 'ACT'
+
+    def test_bin(self):
+        'It runs the same steps as the piped crumbs'
+        pipeline_bin = os.path.join(BIN_DIR, 'run_crumbs')
+        assert 'usage' in check_output([pipeline_bin, '-h'])
+
+        fastq_fhand = _make_fhand(FASTQ)
+        trim_bin = os.path.join(BIN_DIR, 'trim_edges')
+        trim = Popen([trim_bin, '-l', '1', fastq_fhand.name], stdout=PIPE)
+        filter_bin = os.path.join(BIN_DIR, 'filter_by_length')
+        filter_ = Popen([filter_bin, '-n', '6'], stdin=trim.stdout,
+                        stdout=PIPE)
+        trim.stdout.close()
+        expected = filter_.communicate()[0]
+
+        out_dir = mkdtemp()
+        try:
+            prefix = os.path.join(out_dir, 'diverted_')
+            result = check_output([pipeline_bin, '-s', 'trim_edges:left=1',
+                                   '-s', 'filter_by_length:minimum=6',
+                                   '-d', prefix, fastq_fhand.name])
+            assert result == expected
+            assert result.startswith('@seq1\naTCGTTTGAc\n')
+            filtered = open(prefix + '2_filter_by_length.fastq').read()
+            assert filtered == '@seq2\naaaa\n+\n0000\n'
+            assert not open(prefix + '1_trim_edges.fastq').read()
+        finally:
+            rmtree(out_dir)
+
+    def test_bin_in_pairs(self):
+        'It writes the orphans and filtered pairs of every step'
+        pipeline_bin = os.path.join(BIN_DIR, 'run_crumbs')
+        fwd = '>s.f\naattACT\n>s1.f\naattACT\n>s2.f\nACT\n'
+        rev = '>s.r\naattACT\n>s1.r\naatt\n>s2.r\nAC\n'
+        fwd_fhand = _make_fhand(fwd)
+        rev_fhand = _make_fhand(rev)
+        interleaved_fhand = _make_fhand(''.join(
+            '>' + fwd_seq + '>' + rev_seq
+            for fwd_seq, rev_seq in zip(fwd.split('>')[1:],
+                                        rev.split('>')[1:])))
+        out_dir = mkdtemp()
+        try:
+            prefix = os.path.join(out_dir, 'diverted_')
+            steps = ['-s', 'trim_by_case', '-s', 'filter_by_length:minimum=3']
+            result = check_output([pipeline_bin, '--paired_reads', '-d',
+                                   prefix, interleaved_fhand.name] + steps)
+            assert result == '>s.f\nACT\n>s.r\nACT\n'
+            orphans = open(prefix + '1_trim_by_case.fasta').read()
+            assert orphans == '>s1.f\nACT\n'
+            filtered = open(prefix + '2_filter_by_length.fasta').read()
+            assert filtered == '>s2.f\nACT\n>s2.r\nAC\n'
+
+            result2 = check_output([pipeline_bin, '--mate_files',
+                                    fwd_fhand.name, rev_fhand.name] + steps)
+            assert result2 == result
+
+            # the reads are not interleaved
+            stderr = NamedTemporaryFile()
+            process = Popen([pipeline_bin, '--paired_reads', fwd_fhand.name,
+                             '-s', 'trim_by_case'], stdout=PIPE,
+                            stderr=stderr)
+            process.communicate()
+            assert process.returncode
+            assert 'do not match' in open(stderr.name).read()
+        finally:
+            rmtree(out_dir)
+
+if __name__ == '__main__':
+    #import sys;sys.argv = ['', 'PipelineTest.test_bin']
+    unittest.main()
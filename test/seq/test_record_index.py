@@ -0,0 +1,176 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+from gzip import GzipFile
+from cStringIO import StringIO
+from subprocess import check_output
+from os.path import join
+
+from crumbs.seq.utils.record_index import get_record_index
+from crumbs.seq.seqio import read_seqs
+from crumbs.seq.seq import get_name
+from crumbs.statistics import count_seqs
+from crumbs.utils.file_utils import TemporaryDir, uncompress_if_required
+from crumbs.utils.bin_utils import BIN_DIR
+from crumbs.utils.optional_modules import BgzfWriter
+from crumbs.exceptions import NotIndexableError
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+FASTQ = '@s1/1\nACTG\n+\n!!!!\n@s1/2\nAAAA\n+\n!!!!\n'
+FASTQ += '@s2/1\nCCCC\n+\n!!!!\n@s2/2\nGGGG\n+\n!!!!\n'
+
+
+class RecordIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDir()
+        self.cache_dir = join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.tmp_dir.close()
+
+    def _make_file(self, content, fname='seqs'):
+        fpath = join(self.tmp_dir.name, fname)
+        fhand = open(fpath, 'w')
+        fhand.write(content)
+        fhand.close()
+        return fpath
+
+    def test_index(self):
+        fhand = open(self._make_file(FASTQ))
+        index = get_record_index(fhand, 'fastq', cache_dir='')
+        assert list(index.offsets) == [0, 18, 36, 54]
+        assert list(index.lengths) == [18] * 4
+        assert index.total_length == 16
+        seqs = list(index.read_records(fhand, [1, 3]))
+        assert [seq.object.lines for seq in seqs] == [
+            ['@s1/2\n', 'AAAA\n', '+\n', '!!!!\n'],
+            ['@s2/2\n', 'GGGG\n', '+\n', '!!!!\n']]
+        assert [get_name(seq) for seq in seqs] == ['s1/2', 's2/2']
+
+        # several records at once
+        seqs = index.read_records(fhand, [2], records_per_read=2)
+        assert [get_name(seq) for seq in seqs] == ['s2/1', 's2/2']
+        seqs = index.slice_records(fhand, 1, 3)
+        assert [get_name(seq) for seq in seqs] == ['s1/2', 's2/1']
+
+        assert index.get_byte_ranges(2) == [(0, 36, 2), (36, 36, 2)]
+
+        # the index is stored in the cache dir, not next to the file
+        cache_dir = self.cache_dir
+        index = get_record_index(fhand, 'fastq', cache_dir=cache_dir)
+        assert sorted(os.listdir(self.tmp_dir.name)) == ['cache', 'seqs']
+        assert len(os.listdir(cache_dir)) == 1
+        index2 = get_record_index(fhand, 'fastq', cache_dir=cache_dir)
+        assert list(index2.offsets) == list(index.offsets)
+        # it is rebuilt if the file changes
+        open(fhand.name, 'a').write('@s3\nA\n+\n!\n')
+        fhand = open(fhand.name)
+        assert len(get_record_index(fhand, 'fastq', cache_dir=cache_dir)) == 5
+        assert len(os.listdir(cache_dir)) == 1
+
+        # multiline fasta
+        fhand = open(self._make_file('>s1 desc\nACTG\nAC\n\n>s2\nCC'))
+        index = get_record_index(fhand, 'fasta', cache_dir=cache_dir)
+        assert list(index.offsets) == [0, 18]
+        assert index.total_length == 8
+        seqs = list(index.read_records(fhand, [0, 1]))
+        assert [seq.object.lines for seq in seqs] == [['>s1 desc\n',
+                                                       'ACTGAC\n'],
+                                                      ['>s2\n', 'CC\n']]
+        assert list(read_seqs([fhand]))[0].object == seqs[0].object
+
+    def test_cache_eviction(self):
+        'The least recently used indexes are removed above the disk budget'
+        fpaths = [self._make_file(FASTQ, fname='seqs{:d}'.format(idx))
+                  for idx in range(3)]
+        index_fpaths = []
+        for fpath in fpaths:
+            stat_ = os.stat(fpath)
+            fname = '{:d}_{:d}.npz'.format(stat_.st_dev, stat_.st_ino)
+            index_fpaths.append(join(self.cache_dir, fname))
+
+        for fpath in fpaths[:2]:
+            get_record_index(open(fpath), 'fastq', cache_dir=self.cache_dir)
+        os.utime(index_fpaths[0], (100, 100))
+        os.utime(index_fpaths[1], (200, 200))
+        # the first index is used again, so the second one is the oldest
+        get_record_index(open(fpaths[0]), 'fastq', cache_dir=self.cache_dir)
+        max_size = os.path.getsize(index_fpaths[0]) * 2
+        get_record_index(open(fpaths[2]), 'fastq', cache_dir=self.cache_dir,
+                         max_size=max_size)
+        assert [os.path.exists(fpath) for fpath in index_fpaths] == [True,
+                                                                     False,
+                                                                     True]
+
+    def test_bgzf(self):
+        fastq = ''.join('@seq{0}\n{1}\n+\n{2}\n'.format(idx, 'A' * idx,
+                                                        '!' * idx)
+                        for idx in range(1, 1000))
+        fpath = join(self.tmp_dir.name, 'seqs.fastq.bgz')
+        bgzf_fhand = BgzfWriter(fpath)
+        bgzf_fhand.write(fastq)
+        bgzf_fhand.close()
+
+        fhand = uncompress_if_required(open(fpath))
+        index = get_record_index(fhand, 'fastq', cache_dir=self.cache_dir)
+        assert len(index) == 999
+        assert index.total_length == sum(range(1000))
+        # the records are in several bgzf blocks
+        assert int(index.offsets[-1]) >> 16
+        seqs = list(index.read_records(fhand, [0, 500, 998]))
+        assert [get_name(seq) for seq in seqs] == ['seq1', 'seq501', 'seq999']
+        assert seqs[1].object.lines[1] == 'A' * 501 + '\n'
+
+    def test_not_indexable(self):
+        # multiline fastq
+        fhand = open(self._make_file('@s1\nACTG\nAC\n+\n!!!!\n!!\n'))
+        self.assertRaises(NotIndexableError, get_record_index, fhand,
+                          'fastq', cache_dir=self.cache_dir)
+        # gzip compressed
+        fpath = join(self.tmp_dir.name, 'seqs.gz')
+        gz_fhand = GzipFile(fpath, mode='w')
+        gz_fhand.write(FASTQ)
+        gz_fhand.close()
+        fhand = uncompress_if_required(open(fpath))
+        self.assertRaises(NotIndexableError, get_record_index, fhand,
+                          'fastq')
+        # not a file
+        self.assertRaises(NotIndexableError, get_record_index,
+                          StringIO(FASTQ), 'fastq')
+
+    def test_bins(self):
+        fpath = self._make_file(FASTQ, fname='seqs.fastq')
+        head_bin = os.path.join(BIN_DIR, 'seq_head')
+        result = check_output([head_bin, '-n', '2', '-s', '1', fpath])
+        assert [get_name(seq) for seq in read_seqs([StringIO(result)])] == [
+                                                             's1/2', 's2/1']
+        result = check_output([head_bin, '-n', '2', '-s', '3'],
+                              stdin=open(fpath))
+        assert [get_name(seq) for seq in read_seqs([StringIO(result)])] == [
+                                                                     's2/2']
+
+        count_bin = os.path.join(BIN_DIR, 'count_seqs')
+        result = check_output([count_bin, fpath, fpath])
+        counts = count_seqs(read_seqs([open(fpath), open(fpath)]))
+        assert result == '{num_seqs} {total_length}\n'.format(**counts)
+
+if __name__ == "__main__":
+#     import sys;sys.argv = ['', 'RecordIndexTest']
+    unittest.main()
@@ -0,0 +1,96 @@
+# Copyright 2012 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from tempfile import NamedTemporaryFile
+
+from crumbs.seq.sampling import sample_seqs
+from crumbs.seq.seq import get_name
+from crumbs.utils.file_utils import TemporaryDir
+from crumbs.exceptions import SampleSizeError, InterleaveError
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+FASTQ = '@s1/1\nACTG\n+\n!!!!\n@s1/2\nAAAA\n+\n!!!!\n'
+FASTQ += '@s2/1\nCCCC\n+\n!!!!\n@s2/2\nGGGG\n+\n!!!!\n'
+
+
+class SampleSeqsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDir()
+
+    def tearDown(self):
+        self.tmp_dir.close()
+
+    def _make_fhand(self, content):
+        fhand = NamedTemporaryFile(dir=self.tmp_dir.name)
+        fhand.write(content)
+        fhand.flush()
+        return fhand
+
+    def test_sample_seqs(self):
+        # with the offsets
+        fhand = self._make_fhand(FASTQ)
+        seqs = list(sample_seqs([fhand], 3))
+        names = [get_name(seq) for seq in seqs]
+        assert len(set(names)) == 3
+        assert names == sorted(names)
+
+        # paired
+        seqs = list(sample_seqs([fhand], 1, paired=True))
+        names = [get_name(seq) for seq in seqs]
+        assert names in (['s1/1', 's1/2'], ['s2/1', 's2/2'])
+        try:
+            list(sample_seqs([fhand], 3, paired=True))
+            self.fail('SampleSizeError expected')
+        except SampleSizeError:
+            pass
+
+        reads = [FASTQ[idx:idx + 18] for idx in range(0, len(FASTQ), 18)]
+        not_interleaved = self._make_fhand(''.join(reads[::2] + reads[1::2]))
+        # the error is raised before any seq is returned
+        try:
+            sample_seqs([not_interleaved], 2, paired=True)
+            self.fail('InterleaveError expected')
+        except InterleaveError:
+            pass
+
+        # with a reservoir
+        fastq = '@s1/1\nAC\nTG\n+\n!!\n!!\n@s1/2\nAC\n+\n!!\n'
+        fhand = self._make_fhand(fastq)
+        seqs = list(sample_seqs([fhand], 1, paired=True))
+        assert [get_name(seq) for seq in seqs] == ['s1/1', 's1/2']
+        fhand.seek(0)
+        assert len(list(sample_seqs([fhand], 2))) == 2
+
+    def test_orphans(self):
+        'Both samplings fail with the orphan reads'
+        names = ['s1/1', 's1/2', 's2/1', 's3/1', 's3/2', 's4/2']
+        fastq = ''.join('@{}\nAC\n+\n!!\n'.format(name) for name in names)
+        multiline = ''.join('@{}\nA\nC\n+\n!\n!\n'.format(name)
+                            for name in names)
+        for content, num_pairs in ((fastq, 3), (multiline, 1)):
+            fhand = self._make_fhand(content)
+            try:
+                sample_seqs([fhand], num_pairs, paired=True)
+                self.fail('InterleaveError expected')
+            except InterleaveError:
+                pass
+
+if __name__ == "__main__":
+#     import sys;sys.argv = ['', 'SampleSeqsTest']
+    unittest.main()
@@ -22,7 +22,8 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
 from crumbs.seq.annotation import (EstscanOrfAnnotator, _detect_polya_tail,
-                                   PolyaAnnotator, BlastAnnotator)
+                                   PolyaAnnotator, BlastAnnotator,
+                                   _detect_polya_tails, get_polya_tails)
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.seq.seqio import read_seqs
 from crumbs.seq.seq import SeqWrapper
@@ -123,6 +124,17 @@ class AnnotationTest(unittest.TestCase):
         seq = 'TTTTT'
         assert _detect_polya_tail(seq, FIVE_PRIME, 2, 0) == (0, 5)
 
+        # several seqs at once
+        seqs = ['CAATAAAAA', '', 'TTTTcTTc', 'AAAAAC', 'gcgcaaaa']
+        assert _detect_polya_tails(seqs, THREE_PRIME, 4, 1) == [(4, 9), None,
+                                                                None, (0, 6),
+                                                                (4, 8)]
+        assert _detect_polya_tails(seqs, FIVE_PRIME, 2, 1) == [None, None,
+                                                               (0, 7), None,
+                                                               None]
+        assert get_polya_tails(seqs, 4, 1) == [(4, 9, 1), None, (0, 4, -1),
+                                               (0, 6, 1), (4, 8, 1)]
+
     def test_blast_annotator(self):
         'It finds the seq direction looking to a blast result'
         blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs', 'arabidopsis_genes')
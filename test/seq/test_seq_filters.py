@@ -37,8 +37,9 @@ from crumbs.seq.filters import (FilterByLength, FilterById, FilterByQuality,
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import (NUCL, SEQS_FILTERED_OUT, SEQS_PASSED, SEQITEM,
-                               SEQRECORD)
-from crumbs.seq.seq import get_name, get_str_seq, SeqWrapper
+                               SEQRECORD, MATE_PASSED, MATE_FILTERED_OUT,
+                               MATE_LOST)
+from crumbs.seq.seq import get_name, get_str_seq, SeqWrapper, MatePacket
 from crumbs.seq.seqio import read_seq_packets
 
 
@@ -127,6 +128,30 @@ class LengthFilterTest(unittest.TestCase):
         filter_by_length = FilterByLength(minimum=7, maximum=8)
         assert len(filter_by_length(filter_packet)[SEQS_PASSED]) == 2
 
+    def test_filter_mates(self):
+        'It marks the filtered out pairs of a MatePacket'
+        mates1 = [_create_seqrecord('ACTG'), _create_seqrecord('AC'),
+                  _create_seqrecord('ACTG'), _create_seqrecord('AC')]
+        mates2 = [_create_seqrecord('ACTG'), _create_seqrecord('ACTG'),
+                  _create_seqrecord('AC'), _create_seqrecord('AC')]
+
+        packet = MatePacket(list(mates1), list(mates2))
+        FilterByLength(minimum=4).filter_mates(packet)
+        assert packet.status.tolist() == [[0, 1, 1, 1], [0, 1, 1, 1]]
+
+        packet = MatePacket(list(mates1), list(mates2))
+        filter_ = FilterByLength(minimum=4, failed_drags_pair=False)
+        filter_.filter_mates(packet)
+        assert packet.status.tolist() == [[0, 0, 0, 1], [0, 0, 0, 1]]
+
+        # the orphans are not checked
+        packet = MatePacket(list(mates1), list(mates2))
+        packet.status[1, 3] = MATE_LOST
+        FilterByLength(maximum=3).filter_mates(packet)
+        filtered = MATE_FILTERED_OUT
+        assert packet.status.tolist() == [[filtered] * 3 + [MATE_PASSED],
+                                          [filtered] * 3 + [MATE_LOST]]
+
     def test_filter_by_length_bin(self):
         'It uses the filter_by_length binary'
         filter_bin = os.path.join(BIN_DIR, 'filter_by_length')
@@ -216,6 +241,10 @@ class SeqListFilterTest(unittest.TestCase):
         assert '>s2\n' in result
         assert '>s1\n' not in result
 
+        result = check_output([filter_bin, '--exact', '-l', list_fhand.name,
+                               fasta_fhand.name])
+        assert result == '>s1\naCTg\n'
+
 
 class QualityFilterTest(unittest.TestCase):
     'It tests the filtering by a quality threshold'
@@ -575,6 +604,24 @@ class FilterBowtie2Test(unittest.TestCase):
                 assert _seqs_to_names(filter_packets[SEQS_FILTERED_OUT]) == [
                                                     'read1', 'read2', 'read3']
 
+    @staticmethod
+    def test_filter_packets_by_bowtie2():
+        index_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
+        fastq_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
+
+        # one bowtie2 maps all the packets
+        seq_packets = read_seq_packets([open(fastq_fpath)], size=2)
+        filter_packets = seq_to_filterpackets(seq_packets)
+        filter_ = FilterBowtie2Match(index_fpath)
+        filter_packets = list(filter_.filter_packets(filter_packets))
+        assert len(filter_packets) == 2
+        passed = [name for packet in filter_packets
+                  for name in _seqs_to_names(packet[SEQS_PASSED])]
+        filtered_out = [name for packet in filter_packets
+                        for name in _seqs_to_names(packet[SEQS_FILTERED_OUT])]
+        assert passed == ['no_arabi']
+        assert filtered_out == ['read1', 'read2', 'read3']
+
     @staticmethod
     def test_filter_by_bowtie2_bin():
         filter_bin = os.path.join(BIN_DIR, 'filter_by_bowtie2')
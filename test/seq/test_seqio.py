@@ -30,8 +30,10 @@ from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.seq.seqio import (guess_seq_type, fastaqual_to_fasta, seqio,
                               _write_seqrecords, _read_seqrecords,
-                              _itemize_fastx, read_seqs, write_seqs)
-from crumbs.utils.tags import SEQITEM, SEQRECORD
+                              _itemize_fastx, read_seqs, write_seqs,
+                              write_seq_packets, write_filter_packets)
+from crumbs.utils.tags import (SEQITEM, SEQRECORD, SEQS_PASSED,
+                               SEQS_FILTERED_OUT)
 from crumbs.exceptions import IncompatibleFormatError, MalformedFile
 
 
@@ -72,6 +74,31 @@ class SeqIOTest(unittest.TestCase):
         fastq = open(out_fhand.name).read()
         assert fastq == "@seq1\nattct\n+\n#####\n@seq2\natc\n+\n###\n"
 
+        # the number of qualities does not match the sequence length
+        seq_fhand = StringIO('>seq1\nattct\n')
+        qual_fhand = StringIO('>seq1\n2 2 2 2\n')
+        try:
+            fastaqual_to_fasta(seq_fhand, qual_fhand, NamedTemporaryFile())
+            raise AssertionError('MalformedFile expected')
+        except MalformedFile:
+            pass
+
+        # the fasta and qual records do not match
+        seq_fhand = StringIO('>seq1\nattct\n')
+        qual_fhand = StringIO('>seq2\n2 2 2 2 2\n')
+        try:
+            fastaqual_to_fasta(seq_fhand, qual_fhand, NamedTemporaryFile())
+            raise AssertionError('ValueError expected')
+        except ValueError:
+            pass
+
+        # as Biopython, the negative scores are clamped to 0
+        seq_fhand = StringIO('>seq1\natc\n')
+        qual_fhand = StringIO('>seq1\n30 -1 20\n')
+        out_fhand = NamedTemporaryFile()
+        fastaqual_to_fasta(seq_fhand, qual_fhand, out_fhand)
+        assert open(out_fhand.name).read() == '@seq1\natc\n+\n?!5\n'
+
     def test_seqio(self):
         'It tets the seqio function'
 
@@ -91,6 +118,18 @@ class SeqIOTest(unittest.TestCase):
 
         assert "@seq3\natcgt\n+\n^^^^^\n@seq1" in open(out_fhand.name).read()
 
+        # fastq-illumina to fastq
+        in_fhand = self._make_fhand('@seq1\natcgt\n+\n^^^^h\n')
+        out_fhand = NamedTemporaryFile()
+        seqio([in_fhand], out_fhand, 'fastq')
+        assert open(out_fhand.name).read() == '@seq1\natcgt\n+\n????I\n'
+
+        # the empty reads are kept
+        in_fhand = self._make_fhand('@a\n\n+\n\n@b\nAC\n+\n??\n')
+        out_fhand = NamedTemporaryFile()
+        seqio([in_fhand], out_fhand, 'fasta')
+        assert open(out_fhand.name).read() == '>a\n>b\nAC\n'
+
         # fasta to fastq
         out_fhand = NamedTemporaryFile()
         try:
@@ -212,6 +251,15 @@ class SimpleIOTest(unittest.TestCase):
         write_seqs(seqs, fhand)
         assert fhand.getvalue() == '>s1\nACTG\n>s2 desc\nACTG\n'
 
+        # the fastq qualities are recoded without SeqRecords
+        fhand = StringIO('@s1\nACTG\n+\n?!I~\n')
+        seqs = list(read_seqs([fhand], out_format='fastq-illumina',
+                              prefered_seq_classes=[SEQITEM]))
+        assert seqs[0].kind == SEQITEM
+        fhand = StringIO()
+        write_seqs(seqs, fhand, 'fastq-illumina')
+        assert fhand.getvalue() == '@s1\nACTG\n+\n^@h~\n'
+
 
 class PipingTest(unittest.TestCase):
     'It tests that we get no error when trying to write in a closed pipe'
@@ -260,6 +308,28 @@ class PipingTest(unittest.TestCase):
         assert 'LOCUS' in open(stdout.name).read()
         stdout.close()
 
+    def test_packet_writers(self):
+        seqs = list(read_seqs([StringIO(FASTQ)]))
+        packets = [{SEQS_PASSED: [seqs[:1], seqs[1:2]],
+                    SEQS_FILTERED_OUT: [seqs[2:]]}] * 2
+        passed_fhand = StringIO()
+        filtered_fhand = StringIO()
+        stats = write_filter_packets(passed_fhand, filtered_fhand, packets)
+        assert passed_fhand.getvalue() == FASTQ[:40] * 2
+        assert filtered_fhand.getvalue() == FASTQ[40:] * 2
+        assert stats[SEQS_PASSED]['bytes_written'] == 80
+        assert stats[SEQS_FILTERED_OUT]['bytes_written'] == 40
+        assert stats[SEQS_PASSED]['queue_depth'] == 0
+
+        # a closed pipe
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        fhand = os.fdopen(write_fd, 'w', 0)
+        stats = write_seq_packets(fhand, [seqs] * 10)
+        assert stats['broken_pipe']
+        assert stats['bytes_written'] == 0
+        fhand.close()
+
 if __name__ == '__main__':
     #import sys;sys.argv = ['', 'SeqIOTest.test_guess_seq_type']
     unittest.main()
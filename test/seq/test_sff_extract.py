@@ -21,6 +21,8 @@ from subprocess import check_output, CalledProcessError
 from crumbs.seq.sff_extract import SffExtractor
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.bin_utils import BIN_DIR
+from crumbs.utils.tags import SEQRECORD, SEQITEM
+from crumbs.seq.seq import SeqWrapper, get_str_seq, get_int_qualities
 
 # pylint: disable=R0201
 # pylint: disable=R0904
@@ -78,6 +80,30 @@ class SffExtractTest(unittest.TestCase):
         except ValueError:
             pass
 
+    def test_seq_items_in_sff(self):
+        'It extracts the sff reads as fastq SeqItems'
+        sff_fpath = os.path.join(TEST_DATA_DIR, '10_454_reads.sff')
+        for trim in (False, True):
+            for min_left_clip in (0, 5):
+                extractor = SffExtractor([open(sff_fpath, 'rb')], trim=trim,
+                                         min_left_clip=min_left_clip)
+                seqrecords = [SeqWrapper(SEQRECORD, seq, None)
+                              for seq in extractor.seqs]
+                extractor2 = SffExtractor([open(sff_fpath, 'rb')], trim=trim,
+                                          min_left_clip=min_left_clip)
+                seqs = list(extractor2.seq_items)
+                assert len(seqs) == 10
+                assert seqs[0].kind == SEQITEM
+                assert ([get_str_seq(seq) for seq in seqs] ==
+                        [get_str_seq(seq) for seq in seqrecords])
+                assert ([get_int_qualities(seq) for seq in seqs] ==
+                        [get_int_qualities(seq) for seq in seqrecords])
+                assert extractor.clip_advice == extractor2.clip_advice
+
+        seqs = list(SffExtractor([open(sff_fpath, 'rb')]).seq_items)
+        assert get_str_seq(seqs[0]).startswith('tcagGGTCTACATGTTGGTTAACCCG')
+        assert seqs[0].object.annotations['clip_qual_left'] == 4
+
     def test_check_nucl_counts(self):
         'It checks that the nucleotide freqs are all below the given threshold'
         sff_fpath = os.path.join(TEST_DATA_DIR, '10_454_reads.sff')
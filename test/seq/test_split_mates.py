@@ -182,7 +182,7 @@ class MateSplitterTest(unittest.TestCase):
         xpect += 'TG'
         xpect += 'TGTACTATACACACACGTAGGTCGACTATCGTAGCTAGT\n'
         xpect += '>seq5_mlc.part2\n'
-        xpect += 'ACCTAGTCTAGTCGTAGTCATGGCTGTAGTCTAGTCTACGATTCGTATCAGTTGTGTGAC'
+        xpect += 'CTAGTCTAGTCGTAGTCATGGCTGTAGTCTAGTCTACGATTCGTATCAGTTGTGTGAC'
         xpect += '\n'
         xpect += r'>seq6\1'
         xpect += '\n'
@@ -28,6 +28,8 @@ from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.utils.tags import SEQRECORD
 from crumbs.seq.seq import get_str_seq, SeqWrapper
 from crumbs.seq.seqio import read_seqs
+from crumbs.utils.sqlite_utils import SqliteCache
+from crumbs.utils.file_utils import TemporaryDir
 
 POLYA_ANNOTATOR_MISMATCHES = get_setting('POLYA_ANNOTATOR_MISMATCHES')
 
@@ -132,6 +134,35 @@ class TestTranscriptomeOrientator(unittest.TestCase):
         rev_str_seq6 = str(seqs[6].object.seq.reverse_complement())
         assert get_str_seq(seq7) == rev_str_seq6
 
+    def test_annotation_cache(self):
+        'The blast annotations are cached'
+        seq_forward = 'CTAAATCTCCGCCGTCCGATCTTCTCTCAATCCAACGACCTCGATCTCTTCTCTT'
+        seq_forward += 'TCTCCGATCAACTCGTTTTCTACGGCAAGAATATCGCCGGAAAACTCAGTTACG'
+        seq_reverse = 'TTTAACAGATCCGTAACTGAGTTTTCCGGCGATATTCTTGCCGTAGAAAACGAGT'
+        seq_reverse += 'CGGAGATTTAG'
+        ara_blastdb = os.path.join(TEST_DATA_DIR, 'blastdbs',
+                                   'arabidopsis_genes')
+        blast_params = [{'blastdb': ara_blastdb, 'program': 'blastn'}]
+        # the sqlite -wal and -shm files are removed with the directory
+        cache_dir = TemporaryDir()
+        cache_fpath = os.path.join(cache_dir.name, 'annotations.sqlite')
+        try:
+            for _ in range(2):
+                seq1 = SeqRecord(seq=Seq(seq_forward), id='seq_blast_forward')
+                seq2 = SeqRecord(seq=Seq(seq_reverse), id='seq_blast_reverse')
+                orientator = TranscriptOrientator(blast_params=blast_params,
+                                                  cache_fpath=cache_fpath)
+                seqs = orientator([_wrap_seq(seq1), _wrap_seq(seq2)])
+                assert get_str_seq(seqs[0]) == seq_forward
+                rev_str_seq = str(seqs[1].object.seq.reverse_complement())
+                assert rev_str_seq == seq_reverse
+                assert seqs[0].object.features
+            cache = SqliteCache(cache_fpath)
+            assert len(list(cache.dump())) == 2
+            cache.close()
+        finally:
+            cache_dir.close()
+
     def test_bin_transcrip_orientator(self):
         'it tests the transcript orientator binary'
         orientate_bin = os.path.join(BIN_DIR, 'orientate_transcripts')
@@ -24,14 +24,16 @@ from Bio.SeqRecord import SeqRecord
 
 from crumbs.seq.trim import (TrimLowercasedLetters, TrimEdges, TrimOrMask,
                              TrimByQuality, TrimWithBlastShort,
-                             seq_to_trim_packets, TrimMatePairChimeras)
+                             seq_to_trim_packets, TrimMatePairChimeras,
+                             FusedTrimmer)
 from crumbs.utils.bin_utils import BIN_DIR
 from crumbs.utils.tags import (SEQRECORD, SEQITEM, TRIMMING_RECOMMENDATIONS,
-                               VECTOR, ORPHAN_SEQS, SEQS_PASSED, OTHER)
+                               VECTOR, ORPHAN_SEQS, SEQS_PASSED, OTHER,
+                               MATE_LOST)
 from crumbs.seq.seq import (get_str_seq, get_annotations, get_int_qualities,
                             get_name)
 from crumbs.seq.seqio import read_seq_packets, read_seqs
-from crumbs.seq.seq import SeqWrapper, SeqItem
+from crumbs.seq.seq import SeqWrapper, SeqItem, MatePacket
 from crumbs.utils.test_utils import TEST_DATA_DIR
 
 FASTQ = '@seq1\naTCgt\n+\n?????\n@seq2\natcGT\n+\n?????\n'
@@ -302,6 +304,64 @@ class TrimAndMaskTest(unittest.TestCase):
         trim_packet2[SEQS_PASSED][0][0]
         assert TRIMMING_RECOMMENDATIONS not in get_annotations(trim_packet2[SEQS_PASSED][0][0])
 
+    def test_fused_trimming(self):
+        'Several trimmers are run and the seqs are trimmed once'
+        fastq = '@seq1\naaTCGTTTGAc\n+\n0000AAAA000\n@seq2\naaaaa\n+\n00000\n'
+        fastq += '@seq3\nATCGTATAGT\n+\nAAAAAAAAAA\n'
+
+        def get_trimmers():
+            return [TrimEdges(left=1), TrimLowercasedLetters(),
+                    TrimByQuality(window=1, threshold=20)]
+
+        for mask in (False, True):
+            seq_packets = read_seq_packets([StringIO(fastq)])
+            trim_packet = list(seq_to_trim_packets(seq_packets))[0]
+            for trimmer in get_trimmers() + [TrimOrMask(mask=mask)]:
+                trim_packet = trimmer(trim_packet)
+            expected = [[get_str_seq(s) for s in l]
+                                            for l in trim_packet[SEQS_PASSED]]
+
+            seq_packets = read_seq_packets([StringIO(fastq)])
+            trim_packet = list(seq_to_trim_packets(seq_packets))[0]
+            trim_packet = FusedTrimmer(get_trimmers(), mask=mask)(trim_packet)
+            res = [[get_str_seq(s) for s in l]
+                                            for l in trim_packet[SEQS_PASSED]]
+            assert res == expected
+            if mask:
+                assert res == [['aatcGTTTgac'], ['aaaaa'], ['aTCGTATAGT']]
+            else:
+                assert res == [['GTTT'], ['TCGTATAGT']]
+
+    def test_trim_mates(self):
+        'The mates trimmed away are marked as lost'
+        def get_packet():
+            seqs = list(read_seqs([StringIO(FASTQ)]))
+            return MatePacket([seqs[0]], [seqs[1]])
+
+        packet = get_packet()
+        TrimOrMask().trim_mates(TrimLowercasedLetters().trim_mates(packet))
+        assert get_str_seq(packet.mates[0][0]) == 'TC'
+        assert get_str_seq(packet.mates[1][0]) == 'GT'
+        assert not packet.status.any()
+
+        packet = get_packet()
+        FusedTrimmer([TrimLowercasedLetters(),
+                      TrimEdges(left=2)]).trim_mates(packet)
+        assert get_str_seq(packet.mates[0][0]) == 'C'
+        assert get_str_seq(packet.mates[1][0]) == 'GT'
+        assert packet.status.tolist() == [[0], [0]]
+
+        packet = get_packet()
+        FusedTrimmer([TrimLowercasedLetters(),
+                      TrimEdges(right=2)]).trim_mates(packet)
+        assert get_str_seq(packet.mates[0][0]) == 'TC'
+        assert packet.status.tolist() == [[0], [MATE_LOST]]
+
+        # the lost mates are not trimmed again
+        FusedTrimmer([TrimEdges(left=1)]).trim_mates(packet)
+        assert get_str_seq(packet.mates[0][0]) == 'C'
+        assert get_str_seq(packet.mates[1][0]) == 'atcGT'
+
 
 class TrimByQualityTest(unittest.TestCase):
     'It test the quality trimming'
@@ -557,6 +617,14 @@ class TrimChimericRegions(unittest.TestCase):
                             for l in trim_packets2[SEQS_PASSED] for s in l]
         assert res == [[(49, 105)], []]
 
+        # one bwa maps all the packets
+        trim_chimeras = TrimMatePairChimeras(index_fpath)
+        trim_packets2 = list(trim_chimeras.trim_packets(trim_packets))[0]
+        res = [get_annotations(s).get(TRIMMING_RECOMMENDATIONS, {}).get(OTHER,
+                                                                        [])
+                            for l in trim_packets2[SEQS_PASSED] for s in l]
+        assert res == [[(49, 105)], []]
+
     def test_trim_chimeras_bin(self):
         trim_chimeras_bin = os.path.join(BIN_DIR, 'trim_mp_chimeras')
         assert 'usage' in check_output([trim_chimeras_bin, '-h'])
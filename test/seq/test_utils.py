@@ -16,10 +16,10 @@
 import unittest
 import os
 import sys
-import hashlib
 from subprocess import Popen, PIPE, check_output, CalledProcessError
 from tempfile import NamedTemporaryFile
 from cStringIO import StringIO
+import cPickle as pickle
 
 from crumbs.utils.file_utils import (TemporaryDir, rel_symlink,
                                      wrap_in_buffered_reader)
@@ -30,8 +30,8 @@ from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.tags import ERROR_ENVIRON_VARIABLE
 from crumbs.seq.seqio import guess_seq_type
 from crumbs.settings import get_setting
-from crumbs.seq.utils.file_formats import (get_format, FILEFORMAT_INVENTORY,
-                                           set_format)
+from crumbs.seq.utils.file_formats import (get_format, set_format,
+                                           FormatDetector)
 from crumbs.utils.sqlite_utils import SqliteCache
 
 
@@ -122,32 +122,63 @@ class UtilsTest(unittest.TestCase):
         fhand = NamedTemporaryFile()
         fhand.write('>seq\natgctacgacta\n')
         fhand.flush()
-        name = fhand.name
-        id_ = id(fhand)
 
-        file_format = get_format(fhand)
-        assert FILEFORMAT_INVENTORY[(id_, name)] == file_format
-        num_keys = len(FILEFORMAT_INVENTORY)
-
-        file_format = get_format(fhand)
-        assert FILEFORMAT_INVENTORY[(id_, name)] == file_format
-        assert len(FILEFORMAT_INVENTORY) == num_keys
+        detector = FormatDetector()
+        assert detector.get_format(fhand) == 'fasta'
+        num_keys = len(detector._cache)
+        assert detector.get_format(fhand) == 'fasta'
+        # the same file opened again is not guessed again
+        assert detector.get_format(open(fhand.name)) == 'fasta'
+        assert len(detector._cache) == num_keys
+
+        # the file has changed
+        fhand.seek(0)
+        fhand.write('@seq\natgctacgacta\n+\n000000000000\n')
+        fhand.flush()
+        assert detector.get_format(fhand) == 'fastq'
 
         fhand = NamedTemporaryFile()
         set_format(fhand, 'fasta')
 
         assert 'fasta' == get_format(fhand)
+        try:
+            set_format(fhand, 'fastq')
+            self.fail('RuntimeError expected')
+        except RuntimeError:
+            pass
 
     def test_get_format_stringio(self):
         "It checks the get/set format functions"
         #stiongIO
+        detector = FormatDetector(cache_size=2)
         stringIO_fhand = StringIO('>seq\natgctacgacta\n')
-
-        striongIOhash = hashlib.sha224(stringIO_fhand.getvalue()[:100]).hexdigest()
-        id_ = id(stringIO_fhand)
-
-        file_format = get_format(stringIO_fhand)
-        assert FILEFORMAT_INVENTORY[(id_, striongIOhash)] == file_format
+        assert detector.get_format(stringIO_fhand) == 'fasta'
+        assert detector.get_format(stringIO_fhand) == 'fasta'
+
+        # the ids of the freed instances are not reused
+        for _ in range(4):
+            fhand = StringIO('@seq\natgctacgacta\n+\n000000000000\n')
+            assert detector.get_format(fhand) == 'fastq'
+            fhand = StringIO('>seq\natgctacgacta\n')
+            assert detector.get_format(fhand) == 'fasta'
+        assert len(detector._cache) == 2
+
+    def test_forced_format_is_not_evicted(self):
+        "The formats set by the user are not evicted by the LRU"
+        detector = FormatDetector(cache_size=2)
+        forced_fhand = NamedTemporaryFile()
+        forced_fhand.write('>seq\natgctacgacta\n')
+        forced_fhand.flush()
+        detector.set_format(forced_fhand, 'fastq')
+        fhands = []
+        for _ in range(4):
+            fhand = NamedTemporaryFile()
+            fhand.write('>seq\natgctacgacta\n')
+            fhand.flush()
+            fhands.append(fhand)
+            assert detector.get_format(fhand) == 'fasta'
+        assert len(detector._cache) == 2
+        assert detector.get_format(forced_fhand) == 'fastq'
 
 
 class ErrorHandlingTest(unittest.TestCase):
@@ -219,6 +250,44 @@ class SqliteTest(unittest.TestCase):
             assert dump == [(u'seq1', {'1': 22, '3': 2}),
                             (u'seq2', {'1': 22, '3': 2})]
 
+    def test_bulk_lru_and_eviction(self):
+        fhand = NamedTemporaryFile()
+        value = 'A' * 1000
+        with SqliteCache(fhand.name, lru_size=2, max_size=10000) as cache:
+            cache.update(('seq{}'.format(idx), value) for idx in range(30))
+            cache.commit()
+            # the oldest items have been evicted
+            assert cache.get_size() <= 10000
+            assert len(cache) == 9
+            assert cache['seq0'] is None
+            assert cache['seq29'] == value
+            values = cache.get_many(['seq25', 'seq29', 'seq0'])
+            assert values == {'seq25': value, 'seq29': value}
+            # the big values take more room than the small ones
+            cache['seq30'] = 'A' * 5000
+            cache.evict()
+            assert len(cache) == 5
+            cache['seq29'] = 1
+            assert cache['seq29'] == 1
+
+        with SqliteCache(fhand.name) as cache:
+            assert cache['seq29'] == 1
+
+    def test_old_table(self):
+        'The caches created without a primary key are migrated'
+        fhand = NamedTemporaryFile()
+        with SqliteCache(fhand.name) as cache:
+            execute = cache.connection.execute
+            execute('drop table cachedata')
+            execute('create table cachedata (key TEXT, value BLOB)')
+            execute("insert into cachedata values('seq1', ?)",
+                    (buffer(pickle.dumps(1)),))
+            cache.connection.commit()
+        with SqliteCache(fhand.name) as cache:
+            assert cache['seq1'] == 1
+            cache['seq1'] = 2
+            assert list(cache.dump()) == [('seq1', 2)]
+
 
 if __name__ == '__main__':
     #import sys;sys.argv = ['', 'UtilsTest.test_get_format_stringio']
@@ -14,7 +14,8 @@
 # along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
-from crumbs.collectionz import OrderedSet, KeyedSet
+from crumbs.collectionz import (OrderedSet, KeyedSet, HashedNameSet,
+                                _hash_names)
 
 
 class TestCollections(unittest.TestCase):
@@ -69,6 +70,22 @@ class TestCollections(unittest.TestCase):
         for item in not_in_set:
             assert item not in keyed_set
 
+    def test_hashed_name_set(self):
+        names = ['seq1', 'seq2', 'seq3', 'seq2']
+        for exact in (False, True):
+            name_set = HashedNameSet(iter(names), exact=exact)
+            assert len(name_set) == 3
+            assert 'seq1' in name_set
+            assert 'seq4' not in name_set
+            found = name_set.contains_batch(['seq4', 'seq3', 'seq0', 'seq1'])
+            assert list(found) == [False, True, False, True]
+            name_set.update(['seq4'])
+            assert 'seq4' in name_set
+        assert 'seq1' not in HashedNameSet()
+
+        # the hashes do not depend on the platform
+        assert list(_hash_names(['seq1'])) == [-2853696150143578746]
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'TestCollections']
@@ -0,0 +1,140 @@
+# Copyright 2013 Jose Blanca, Peio Ziarsolo, COMAV-Univ. Politecnica Valencia
+# This file is part of seq_crumbs.
+# seq_crumbs is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# seq_crumbs is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR  PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with seq_crumbs. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os
+import shutil
+from tempfile import mkdtemp
+from os.path import join as pjoin
+
+from crumbs.utils.index_cache import IndexCache
+
+# pylint: disable=R0201
+# pylint: disable=R0904
+# pylint: disable=C0111
+
+
+class IndexCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.cache_dir = pjoin(self.tmp_dir, 'cache')
+        self.builds = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_seq(self, fname, content):
+        fpath = pjoin(self.tmp_dir, fname)
+        fhand = open(fpath, 'w')
+        fhand.write(content)
+        fhand.close()
+        return fpath
+
+    def _builder(self, seq_fpath, index_fpath):
+        self.builds.append(seq_fpath)
+        shutil.copy(seq_fpath, index_fpath)
+        fhand = open(index_fpath + '.idx', 'w')
+        fhand.write('index' * 20)
+        fhand.close()
+
+    def test_get_or_create(self):
+        cache = IndexCache(self.cache_dir, max_size=1024 ** 2)
+        seq_fpath = self._write_seq('ref.fasta', '>s1\nACTG\n')
+        index_fpath = cache.get_or_create(seq_fpath, 'fake', self._builder)
+        assert os.path.basename(index_fpath) == 'ref.fasta'
+        assert os.path.exists(index_fpath + '.idx')
+        assert len(self.builds) == 1
+
+        # it is not built again
+        index_fpath2 = cache.get_or_create(seq_fpath, 'fake', self._builder)
+        assert index_fpath == index_fpath2
+        assert len(self.builds) == 1
+
+        # the same content in other path uses the same index
+        seq_fpath2 = self._write_seq('ref2.fasta', '>s1\nACTG\n')
+        index_fpath3 = cache.get_or_create(seq_fpath2, 'fake', self._builder)
+        assert os.path.dirname(index_fpath3) == os.path.dirname(index_fpath)
+        assert len(self.builds) == 1
+
+        # other kind or version is other index
+        cache.get_or_create(seq_fpath, 'fake', self._builder, version='2')
+        assert len(self.builds) == 2
+
+        # a failed build leaves nothing behind
+        def failing_builder(seq_fpath, index_fpath):
+            raise RuntimeError()
+        try:
+            cache.get_or_create(seq_fpath, 'fake2', failing_builder)
+            self.fail('RuntimeError expected')
+        except RuntimeError:
+            pass
+        assert not [fname for fname in os.listdir(self.cache_dir)
+                    if fname.startswith('.building_')]
+
+    def test_eviction(self):
+        cache = IndexCache(self.cache_dir, max_size=150)
+        seq_fpath1 = self._write_seq('ref1.fasta', '>s1\nACTG\n')
+        seq_fpath2 = self._write_seq('ref2.fasta', '>s2\nGGGG\n')
+        with cache.use_index(seq_fpath1, 'fake', self._builder) as index1:
+            index_fpath1 = index1
+        with cache.use_index(seq_fpath2, 'fake', self._builder) as index2:
+            index_fpath2 = index2
+        # the least recently used index has been removed
+        assert not os.path.exists(index_fpath1)
+        assert os.path.exists(index_fpath2)
+        assert not os.path.exists(os.path.dirname(index_fpath1) + '.lock')
+        index_fpath1 = cache.get_or_create(seq_fpath1, 'fake', self._builder)
+        assert os.path.exists(index_fpath1)
+        assert len(self.builds) == 3
+        cache.release(index_fpath1)
+
+    def test_eviction_in_use(self):
+        cache = IndexCache(self.cache_dir, max_size=150)
+        other_cache = IndexCache(self.cache_dir, max_size=150)
+        seq_fpath1 = self._write_seq('ref1.fasta', '>s1\nACTG\n')
+        seq_fpath2 = self._write_seq('ref2.fasta', '>s2\nGGGG\n')
+        seq_fpath3 = self._write_seq('ref3.fasta', '>s3\nCCCC\n')
+        with cache.use_index(seq_fpath1, 'fake', self._builder) as index1:
+            # other user can not evict an index in use
+            with other_cache.use_index(seq_fpath2, 'fake', self._builder):
+                pass
+            other_cache.evict()
+            assert os.path.exists(index1)
+            # the same index can be taken several times
+            index_fpath = cache.get_or_create(seq_fpath1, 'fake',
+                                              self._builder)
+            cache.release(index_fpath)
+            assert os.path.exists(index1)
+        # once released it can be evicted
+        with other_cache.use_index(seq_fpath3, 'fake', self._builder):
+            pass
+        assert not os.path.exists(index1)
+
+    def test_reap(self):
+        cache = IndexCache(self.cache_dir, max_size=1024 ** 2)
+        # a build and a lock left by dead processes
+        build_dir = pjoin(self.cache_dir, '.building_fake_1234.abc')
+        os.mkdir(build_dir)
+        open(pjoin(self.cache_dir, 'fake_5678.lock'), 'w').close()
+        seq_fpath = self._write_seq('ref.fasta', '>s1\nACTG\n')
+        with cache.use_index(seq_fpath, 'fake', self._builder) as index:
+            assert os.path.exists(index)
+            fnames = os.listdir(self.cache_dir)
+        assert len(fnames) == 2
+        assert os.path.basename(os.path.dirname(index)) in fnames
+
+if __name__ == "__main__":
+#     import sys;sys.argv = ['', 'IndexCacheTest.test_get_or_create']
+    unittest.main()
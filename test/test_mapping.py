@@ -15,7 +15,9 @@
 
 import unittest
 import subprocess
+import sys
 import os.path
+import shutil
 from tempfile import NamedTemporaryFile
 
 from crumbs.utils.test_utils import TEST_DATA_DIR
@@ -23,10 +25,14 @@ from crumbs.mapping import (get_or_create_bowtie2_index, _bowtie2_index_exists,
                             map_with_bowtie2, get_or_create_bwa_index,
                             _bwa_index_exists, map_with_bwamem,
                             map_process_to_bam, sort_fastx_files,
-                            map_with_tophat)
+                            map_with_tophat, MappingSession,
+                            get_mapped_names_from_sam, use_bwa_index,
+                            use_bowtie2_index)
+from crumbs.utils.index_cache import get_index_cache
 from crumbs.utils.file_utils import TemporaryDir
 from crumbs.utils.bin_utils import get_binary_path
 from crumbs.seq.seq import get_name
+from crumbs.seq.seqio import read_seq_packets
 import pysam
 
 
@@ -55,6 +61,20 @@ class Bowtie2Test(unittest.TestCase):
         assert _bowtie2_index_exists(index_fpath)
         directory.close()
 
+    def test_cached_index(self):
+        'The cached index is released after its use'
+        directory = TemporaryDir()
+        try:
+            reference_fpath = os.path.join(directory.name, 'genes.fasta')
+            shutil.copy(os.path.join(TEST_DATA_DIR, 'arabidopsis_genes'),
+                        reference_fpath)
+            with use_bowtie2_index(reference_fpath) as index_fpath:
+                assert _bowtie2_index_exists(index_fpath)
+                assert os.path.dirname(index_fpath) != directory.name
+            assert not get_index_cache()._in_use
+        finally:
+            directory.close()
+
     def test_map_with_bowtie2(self):
         reference_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
         reads_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
@@ -192,6 +212,21 @@ class Bwa2Test(unittest.TestCase):
         assert _bwa_index_exists(index_fpath)
         directory.close()
 
+    def test_cached_index(self):
+        'The cache keeps only the index files and they are released'
+        reference_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
+        reads_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
+        bam_fhand = NamedTemporaryFile(suffix='.bam')
+        with use_bwa_index(reference_fpath) as index_fpath:
+            assert _bwa_index_exists(index_fpath)
+            assert not os.path.exists(index_fpath)
+            bwa = map_with_bwamem(index_fpath, unpaired_fpath=reads_fpath)
+            map_process_to_bam(bwa, bam_fhand.name)
+        assert not get_index_cache()._in_use
+        out = subprocess.check_output([get_binary_path('samtools'), 'view',
+                                       bam_fhand.name])
+        assert  'TTCTGATTCAATCTACTTCAAAGTTGGCTTTATCAATAAG' in out
+
     def test_map_with_bwa(self):
         reference_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
         reads_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
@@ -206,6 +241,49 @@ class Bwa2Test(unittest.TestCase):
 
         directory.close()
 
+    def test_mapping_session(self):
+        reference_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_genes')
+        reads_fpath = os.path.join(TEST_DATA_DIR, 'arabidopsis_reads.fastq')
+        directory = TemporaryDir()
+        index_fpath = get_or_create_bwa_index(reference_fpath, directory.name)
+        bwa = map_with_bwamem(index_fpath, unpaired_fpath='-',
+                              stdin=subprocess.PIPE)
+        session = MappingSession(bwa, binary='bwa')
+        packets = list(read_seq_packets([open(reads_fpath)], size=3))
+        mapped = []
+        for packet, sam_lines in session.map_packets(packets):
+            names = [get_name(seq) for seq in packet]
+            assert [l.split('\t')[0] for l in sam_lines] == names
+            mapped.append(list(get_mapped_names_from_sam(sam_lines)))
+        assert mapped == [['read1', 'read2', 'read3'], []]
+        assert any(l.startswith('@SQ') for l in session.header_lines)
+        directory.close()
+
+    def test_mapping_session_supplementary(self):
+        # an aligner that writes a supplementary record after every primary
+        aligner = ('import sys\n'
+                   'for line in sys.stdin:\n'
+                   '    if line.startswith(">"):\n'
+                   '        name = line[1:].split()[0]\n'
+                   '        for flag in (0, 2048):\n'
+                   '            fields = [name, str(flag), "*", "0", "60"]\n'
+                   '            fields += ["*", "*", "0", "0", "*", "*"]\n'
+                   '            sys.stdout.write("\\t".join(fields) + "\\n")\n')
+        process = subprocess.Popen([sys.executable, '-c', aligner],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        session = MappingSession(process, binary='aligner')
+        fhand = NamedTemporaryFile(suffix='.fasta')
+        fhand.write('>a\nACTG\n>b\nACTG\n>c\nACTG\n')
+        fhand.flush()
+        packets = list(read_seq_packets([open(fhand.name)], size=2))
+        records = []
+        for _, sam_lines in session.map_packets(packets):
+            records.append([':'.join(line.split('\t')[:2])
+                            for line in sam_lines])
+        assert records == [['a:0', 'a:2048', 'b:0', 'b:2048'],
+                           ['c:0', 'c:2048']]
+
     def test_rev_compl_fragmented_reads(self):
         index_fpath = os.path.join(TEST_DATA_DIR, 'ref_example.fasta')
 
@@ -20,7 +20,12 @@ import unittest
 
 from crumbs.utils.segments_utils import (get_longest_segment, get_all_segments,
                                          get_complementary_segments,
-                                         get_longest_complementary_segment)
+                                         get_longest_complementary_segment,
+                                         merge_overlaping_segments,
+                                 merge_overlaping_segments_in_batch,
+                                 get_complementary_segments_in_batch,
+                                 intersect_segments_in_batch,
+                                 get_longest_complementary_segment_in_batch)
 
 
 class SegmentsTest(unittest.TestCase):
@@ -62,6 +67,47 @@ class SegmentsTest(unittest.TestCase):
         result = get_longest_complementary_segment(segments, seq_len=200)
         assert result is None
 
+    @staticmethod
+    def test_merge_segments():
+        'It merges the overlaping segments'
+        segments = [(10, 20), (0, 5), (6, 8), (15, 25), (40, 30)]
+        assert merge_overlaping_segments(segments) == [(0, 8), (10, 25),
+                                                       (30, 40)]
+        assert merge_overlaping_segments(segments,
+                                         merge_segments_closer=0) == [(0, 5),
+                                                                      (6, 8),
+                                                                      (10, 25),
+                                                                      (30, 40)]
+        assert merge_overlaping_segments([]) == []
+
+    @staticmethod
+    def test_segments_in_batch():
+        'It works with the segments of several sequences at once'
+        segments_list = [[(10, 20), (0, 5), (6, 8), (15, 25)], [],
+                         [(0, 29)], [(3, 5), (20, 25)]]
+        seq_lens = [30, 10, 30, 30]
+        assert merge_overlaping_segments_in_batch(segments_list) == [
+                                    [(0, 8), (10, 25)], [], [(0, 29)],
+                                    [(3, 5), (20, 25)]]
+
+        assert get_complementary_segments_in_batch(segments_list,
+                                                   seq_lens) == [
+                                    [(9, 9), (26, 29)], [(0, 9)], [],
+                                    [(0, 2), (6, 19), (26, 29)]]
+
+        result = get_longest_complementary_segment_in_batch(segments_list,
+                                                            seq_lens)
+        assert result == [(26, 29), (0, 9), None, (6, 19)]
+        for segments, seq_len, longest in zip(segments_list, seq_lens,
+                                              result):
+            if segments:
+                assert longest == get_longest_complementary_segment(segments,
+                                                                    seq_len)
+
+        segments_list2 = [[(4, 12)], [(2, 3)], [(5, 40)], []]
+        assert intersect_segments_in_batch(segments_list, segments_list2,
+                                           seq_lens) == [
+                                    [(4, 8), (10, 12)], [], [(5, 29)], []]
 
 if __name__ == '__main__':
     #import sys;sys.argv = ['', 'SffExtractTest.test_items_in_gff']
@@ -14,18 +14,27 @@
 # along with vcf_crumbs. If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import os
+import errno
 from tempfile import NamedTemporaryFile
 from os.path import exists
 from os.path import join as pjoin
 from os import remove
 from StringIO import StringIO
 import gzip
+import bz2
+import sys
+from subprocess import Popen, PIPE
 
 from crumbs.utils.test_utils import TEST_DATA_DIR
 from crumbs.utils.file_utils import (compress_with_bgzip, uncompress_gzip,
                                      fhand_is_seekable,
                                      wrap_in_buffered_reader,
-                                     index_vcf_with_tabix)
+                                     index_vcf_with_tabix,
+                                     uncompress_if_required, compress_fhand,
+                                     AsyncWriter)
+from crumbs.utils.tags import BGZF, GZIP
+from crumbs.utils.compression import ParallelCompressedWriter, is_bgzf
 #                                          _build_template_fhand)
 # Method could be a function
 # pylint: disable=R0201
@@ -131,6 +140,125 @@ class CompressTest(unittest.TestCase):
         assert exists(compressed_fhand.name + '.tbi')
         remove(compressed_fhand.name + '.tbi')
 
+
+def _gzip(data):
+    fhand = StringIO()
+    gzip_fhand = gzip.GzipFile(fileobj=fhand, mode='wb')
+    gzip_fhand.write(data)
+    gzip_fhand.close()
+    return fhand.getvalue()
+
+
+class ThreadedCompressionTest(unittest.TestCase):
+    def test_parallel_writer(self):
+        lines = ['line{}\n'.format(idx) for idx in range(50000)]
+        data = ''.join(lines)
+        for kind in (GZIP, BGZF):
+            out_fhand = NamedTemporaryFile()
+            fhand = compress_fhand(open(out_fhand.name, 'wb'), kind)
+            fhand.writelines(lines)
+            # every flush leaves a valid file
+            fhand.flush()
+            assert gzip.open(out_fhand.name).read() == data
+            fhand.write('last\n')
+            fhand.close()
+            assert gzip.open(out_fhand.name).read() == data + 'last\n'
+            header = open(out_fhand.name).read(18)
+            assert is_bgzf(header) == (kind == BGZF)
+            in_fhand = uncompress_if_required(open(out_fhand.name))
+            assert in_fhand.readline() == 'line0\n'
+            assert in_fhand.read(6) == 'line1\n'
+            assert list(in_fhand)[-1] == 'last\n'
+
+        # the bgzf blocks can be written to a pipe
+        fhand = StringIO()
+        writer = ParallelCompressedWriter(fhand, bgzf=True)
+        writer.write(data)
+        writer.flush()
+        assert gzip.GzipFile(fileobj=StringIO(fhand.getvalue())).read() == data
+
+    def test_parallel_writer_errors(self):
+        # a closed pipe is not an error
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        writer = ParallelCompressedWriter(os.fdopen(write_fd, 'wb'))
+        writer.write('hola\n')
+        writer.close()
+        assert writer.closed
+
+        # but a full disk is
+        if os.path.exists('/dev/full'):
+            writer = ParallelCompressedWriter(open('/dev/full', 'wb'))
+            writer.write('hola\n')
+            try:
+                writer.close()
+                self.fail('IOError expected')
+            except IOError as error:
+                assert error.errno == errno.ENOSPC
+
+    def test_uncompress(self):
+        data = 'hola\ncaracola\n' * 1000
+        # several gzip members and bzip2 streams
+        compressed = [_gzip(data[:100]) + _gzip(data[100:]),
+                      bz2.compress(data[:100]) + bz2.compress(data[100:])]
+        for content in compressed:
+            fhand = NamedTemporaryFile()
+            fhand.write(content)
+            fhand.flush()
+            in_fhand = uncompress_if_required(open(fhand.name))
+            assert in_fhand.peek(4).startswith('hola')
+            assert in_fhand.read() == data
+
+        # gzip files padded with zeroes
+        for padding in ('\0' * 10, '\0' * (1024 * 1024 + 10)):
+            fhand = NamedTemporaryFile()
+            fhand.write(_gzip(data[:100]) + _gzip(data[100:]) + padding)
+            fhand.flush()
+            assert uncompress_if_required(open(fhand.name)).read() == data
+
+        # truncated file
+        fhand = NamedTemporaryFile()
+        fhand.write(_gzip(data)[:-20])
+        fhand.flush()
+        in_fhand = uncompress_if_required(open(fhand.name))
+        try:
+            in_fhand.read()
+            self.fail('EOFError expected')
+        except EOFError:
+            pass
+
+        # from stdin
+        cmd = [sys.executable, '-c',
+               'import sys\n'
+               'from crumbs.utils.file_utils import *\n'
+               'fhand = wrap_in_buffered_reader(sys.stdin)\n'
+               'sys.stdout.write(uncompress_if_required(fhand).read())']
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE)
+        assert process.communicate(_gzip(data))[0] == data
+
+
+class AsyncWriterTest(unittest.TestCase):
+    def test_async_writer(self):
+        fhand = StringIO()
+        writer = AsyncWriter(fhand, queue_size=2)
+        for idx in range(100):
+            writer.write('line{}\n'.format(idx))
+        writer.flush()
+        assert fhand.getvalue().startswith('line0\nline1\n')
+        writer.close()
+        assert writer.stats['bytes_written'] == len(fhand.getvalue())
+        assert writer.max_queue_depth <= 2
+
+        # the errors are raised in the main thread
+        writer = AsyncWriter(open(NamedTemporaryFile().name, 'w'))
+        writer.fhand.close()
+        writer.write('hola')
+        try:
+            writer.close()
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
 if __name__ == "__main__":
 #     import sys;sys.argv = ['', 'FilterTest.test_close_to_filter']
     unittest.main()
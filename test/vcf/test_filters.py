@@ -379,16 +379,15 @@ class BinaryFilterTest(unittest.TestCase):
         stdout = process2.communicate()[0]
         assert len(list(VCFReader(StringIO(stdout)).parse_snvs())) == 69
 
-        # You cannot pipe a compressed file
+        # You can pipe a compressed file
         vcf_fpath = os.path.join(TEST_DATA_DIR, 'scaff000025.vcf.gz')
         cmd1 = ['cat', vcf_fpath]
         process1 = Popen(cmd1, stdout=PIPE)
         binary = join(BIN_DIR, 'filter_vcf_by_maf')
         cmd = [binary,  '-m', '0.7', '-c', '2', '-l', log_fhand.name]
         process2 = Popen(cmd, stderr=PIPE, stdout=PIPE, stdin=process1.stdout)
-        stdout, stderr = process2.communicate()
-        assert not stdout
-        assert 'tell member' in stderr
+        stdout = process2.communicate()[0]
+        assert len(list(VCFReader(StringIO(stdout)).parse_snvs())) == 69
 
 
 def _create_vcf_file(vcf_string):
@@ -126,9 +126,33 @@ reference2\t400\tmicrosat1\tGTC\tG,GTCT\t50\tPASS\tNS=3;DP=9;AA=G\tGT:GQ:DP\t./.
         assert 'group1+454' in stats['5_read_pos_counts'].keys()
         assert '5_read_pos_boxplot' in stats
         assert '3_read_pos_boxplot' in stats
+        counts = stats['5_read_pos_counts']
+
+        # the chromosomes can be processed in parallel
+        snvs = VCFReader(StringIO(vcf)).parse_snvs()
+        stats2 = calc_snv_read_pos_stats(sam, snvs, processes=2)
+        assert stats2['5_read_pos_counts'] == counts
+        for read_group, box in stats['3_read_pos_boxplot'].items():
+            assert stats2['3_read_pos_boxplot'][read_group].counts == box.counts
+
+        snvs = VCFReader(StringIO(vcf)).parse_snvs()
+        stats2 = calc_snv_read_pos_stats(sam, snvs, max_pos=10)
+        for counter in stats2['5_read_pos_counts'].values():
+            assert all(pos <= 10 for pos in counter.keys())
 
         fhand = NamedTemporaryFile(suffix='.png')
         draw_read_pos_stats(stats, fhand)
+
+        # an SNV not covered by the reads
+        uncovered = vcf + 'reference1\t600\t.\tA\tG\t50\tPASS\tNS=3\tGT\t0/1'
+        uncovered += '\t0/1\t1/1\n'
+        for processes in (1, 2):
+            snvs = VCFReader(StringIO(uncovered)).parse_snvs()
+            try:
+                calc_snv_read_pos_stats(sam, snvs, processes=processes)
+                self.fail('RuntimeError expected')
+            except RuntimeError, error:
+                assert 'reference1:599' in str(error)
         #raw_input(fhand.name)
 
 if __name__ == "__main__":